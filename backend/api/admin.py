@@ -1,13 +1,24 @@
-from django.contrib import admin
+import io
+
+from django import forms
+from django.contrib import admin, messages
 from django.utils.html import format_html
+from django.core.exceptions import PermissionDenied
 from django.urls import reverse, path
-from django.db.models import Sum, Count, Q, F
+from django.db.models import Sum, Count, Q, F, OuterRef, Subquery
 from django.template.response import TemplateResponse
 from django.utils.safestring import mark_safe
 from django.db.models.functions import TruncDay
 from django.utils import timezone
+from django.http import Http404, HttpResponse
 import datetime
 
+from .catalog import CatalogImportError, catalog_format, import_catalog, read_catalog_rows
+from .changelist import EstimatedCountAdminMixin, IndexedSearchMixin
+from .images import thumbnail_url
+from .profiling import store as profile_store
+from .slow_queries import ORDERINGS as SLOW_QUERY_ORDERINGS, THRESHOLD_MS as SLOW_QUERY_THRESHOLD_MS, slow_query_log
+from .query_budget import QueryBudgetAdminMixin
 from .models import Product, Customer, Address, Order, OrderItem, Cart, CartItem
 
 
@@ -46,6 +57,16 @@ class CartItemInline(admin.TabularInline):
     fields = ('product', 'quantity')
 
 
+def related_aggregate(model, fk, aggregate):
+    """
+    Correlated subquery computing `aggregate` over the `model` rows whose
+    `fk` points at the outer row. Unlike annotating across two reverse
+    joins, aggregates computed this way don't multiply each other.
+    """
+    rows = model.objects.filter(**{fk: OuterRef('pk')}).order_by().values(fk)
+    return Subquery(rows.annotate(value=aggregate).values('value'))
+
+
 class HasOrderedFilter(admin.SimpleListFilter):
     title = 'has placed an order'
     parameter_name = 'has_ordered'
@@ -64,9 +85,10 @@ class HasOrderedFilter(admin.SimpleListFilter):
 
 
 @admin.register(Customer)
-class CustomerAdmin(admin.ModelAdmin):
+class CustomerAdmin(QueryBudgetAdminMixin, IndexedSearchMixin, EstimatedCountAdminMixin, admin.ModelAdmin):
     list_display = ('email', 'name', 'device', 'created_at', 'address_count', 'order_count', 'order_value', 'has_ordered')
     search_fields = ('email', 'name', 'device')
+    email_search_fields = ('email_normalized',)
     list_filter = ('created_at', HasOrderedFilter)
     inlines = [AddressInline, OrderInline]
     readonly_fields = ('created_at', 'order_value', 'last_order_date')
@@ -79,27 +101,44 @@ class CustomerAdmin(admin.ModelAdmin):
             'classes': ('collapse',),
         }),
     )
+    changelist_query_budget = 12
+    
+    def get_queryset(self, request):
+        # The list_display counts and totals come from the same query as the rows.
+        return super().get_queryset(request).annotate(
+            _address_count=related_aggregate(Address, 'customer', Count('pk')),
+            _order_count=related_aggregate(Order, 'customer', Count('pk')),
+            _order_value=related_aggregate(Order, 'customer', Sum('total_amount')),
+        )
     
     def address_count(self, obj):
-        count = obj.addresses.count()
+        count = obj._address_count or 0
         if count > 0:
             url = reverse('admin:api_address_changelist') + f'?customer__id__exact={obj.id}'
             return format_html('<a href="{}">{}</a>', url, count)
         return "0"
     address_count.short_description = 'Addresses'
+    address_count.admin_order_field = '_address_count'
     
     def order_count(self, obj):
-        count = obj.orders.count()
+        count = obj._order_count or 0
         if count > 0:
             url = reverse('admin:api_order_changelist') + f'?customer__id__exact={obj.id}'
             return format_html('<a href="{}">{}</a>', url, count)
         return "0"
     order_count.short_description = 'Orders'
+    order_count.admin_order_field = '_order_count'
     
     def order_value(self, obj):
-        total = obj.orders.aggregate(total=Sum('total_amount'))['total'] or 0
-        return f"${total:.2f}"
+        if obj.pk is None:
+            return "-"
+        if hasattr(obj, '_order_value'):
+            total = obj._order_value
+        else:
+            total = obj.orders.aggregate(total=Sum('total_amount'))['total']
+        return f"${total or 0:.2f}"
     order_value.short_description = 'Total Spent'
+    order_value.admin_order_field = '_order_value'
     
     def last_order_date(self, obj):
         last_order = obj.orders.order_by('-order_date').first()
@@ -109,20 +148,20 @@ class CustomerAdmin(admin.ModelAdmin):
     last_order_date.short_description = 'Last Order Date'
     
     def has_ordered(self, obj):
-        has_order = obj.orders.exists()
-        icon = "✅" if has_order else "❌"
-        return format_html('<span style="color: {};">{}</span>', 
-                         'green' if has_order else 'red', 
-                         icon)
+        # boolean=True makes the admin render the yes/no icon itself
+        return bool(obj._order_count)
     has_ordered.short_description = 'Has Ordered'
     has_ordered.boolean = True
 
 
 @admin.register(Address)
-class AddressAdmin(admin.ModelAdmin):
+class AddressAdmin(QueryBudgetAdminMixin, IndexedSearchMixin, admin.ModelAdmin):
     list_display = ('customer_link', 'street_address', 'city', 'country', 'default')
+    list_select_related = ('customer',)
+    changelist_query_budget = 12
     list_filter = ('country', 'state', 'city', 'default')
     search_fields = ('street_address', 'city', 'customer__email')
+    email_search_fields = ('customer__email_normalized',)
     autocomplete_fields = ('customer',)
     fieldsets = (
         ('Customer', {
@@ -145,16 +184,22 @@ class AddressAdmin(admin.ModelAdmin):
     customer_link.admin_order_field = 'customer__email'
 
 
+class CatalogImportForm(forms.Form):
+    file = forms.FileField(help_text='CSV with a header row, or JSONL. Rows are matched by sku.')
+    dry_run = forms.BooleanField(required=False, initial=True, help_text='Only report what would change.')
+
+
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'price', 'stock', 'active', 'product_image', 'total_sold', 'created_at')
+class ProductAdmin(QueryBudgetAdminMixin, admin.ModelAdmin):
+    list_display = ('name', 'sku', 'price', 'stock', 'active', 'product_image', 'total_sold', 'created_at')
     list_filter = ('active', 'created_at')
-    search_fields = ('name', 'description')
+    search_fields = ('name', 'sku', 'description')
     readonly_fields = ('created_at', 'updated_at', 'total_sold', 'revenue')
     list_editable = ('price', 'stock', 'active')
+    change_list_template = 'admin/api/product/change_list.html'
     fieldsets = (
         ('Product Information', {
-            'fields': ('name', 'description', 'price', 'image')
+            'fields': ('name', 'sku', 'description', 'price', 'image')
         }),
         ('Inventory', {
             'fields': ('stock', 'active')
@@ -168,16 +213,29 @@ class ProductAdmin(admin.ModelAdmin):
             'classes': ('collapse',),
         }),
     )
+    changelist_query_budget = 12
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            _total_sold=related_aggregate(OrderItem, 'product', Sum('quantity')),
+        )
     
     def product_image(self, obj):
         if obj.image:
-            return format_html('<img src="{}" width="50" height="50" style="object-fit: cover;" />', obj.image.url)
+            # Prefer the pre-rendered thumbnail over the full-size upload
+            url = thumbnail_url(obj.image_variants) or obj.image.url
+            return format_html('<img src="{}" width="50" height="50" style="object-fit: cover;" />', url)
         return "-"
     product_image.short_description = 'Image'
     
     def total_sold(self, obj):
+        if obj.pk is None:
+            return 0
+        if hasattr(obj, '_total_sold'):
+            return obj._total_sold or 0
         return OrderItem.objects.filter(product=obj).aggregate(total=Sum('quantity'))['total'] or 0
     total_sold.short_description = 'Units Sold'
+    total_sold.admin_order_field = '_total_sold'
     
     def revenue(self, obj):
         total = OrderItem.objects.filter(product=obj).aggregate(
@@ -185,6 +243,50 @@ class ProductAdmin(admin.ModelAdmin):
         )['total'] or 0
         return f"${total:.2f}"
     revenue.short_description = 'Total Revenue'
+    
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path('import/', self.admin_site.admin_view(self.import_catalog_view), name='api_product_import'),
+        ]
+        return custom_urls + urls
+    
+    def import_catalog_view(self, request):
+        """
+        Upload a CSV/JSONL catalog and apply the diff in bulk.
+        """
+        if not self.has_change_permission(request) or not self.has_add_permission(request):
+            raise PermissionDenied
+        
+        result = None
+        if request.method == 'POST':
+            form = CatalogImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                upload = form.cleaned_data['file']
+                try:
+                    rows = read_catalog_rows(
+                        io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline=''),
+                        catalog_format(upload.name)
+                    )
+                    result = import_catalog(rows, dry_run=form.cleaned_data['dry_run'])
+                except (CatalogImportError, UnicodeDecodeError) as e:
+                    form.add_error('file', str(e))
+                else:
+                    level = messages.ERROR if result.errors else messages.SUCCESS
+                    self.message_user(request, result.summary(), level)
+        else:
+            form = CatalogImportForm()
+        
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Import catalog',
+            'opts': self.model._meta,
+            'form': form,
+            'result': result,
+            'updated': list(result.updated.items())[:200] if result else [],
+            'created': result.created[:200] if result else [],
+        }
+        return TemplateResponse(request, 'admin/api/product/import_catalog.html', context)
 
 
 class OrderStatusFilter(admin.SimpleListFilter):
@@ -201,11 +303,16 @@ class OrderStatusFilter(admin.SimpleListFilter):
 
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(QueryBudgetAdminMixin, IndexedSearchMixin, EstimatedCountAdminMixin, admin.ModelAdmin):
     list_display = ('id', 'customer_link', 'status_colored', 'items_count', 'total_amount', 'order_date')
+    list_select_related = ('customer',)
+    changelist_query_budget = 14
     list_filter = (OrderStatusFilter, 'order_date')
     search_fields = ('id', 'customer__email', 'customer__name')
-    readonly_fields = ('id', 'order_date', 'total_amount', 'shipping_address_display')
+    uuid_search_fields = ('id',)
+    email_search_fields = ('customer__email_normalized',)
+    readonly_fields = ('id', 'order_date', 'total_amount', 'shipping_address_display',
+                       'stripe_payment_intent_id', 'stripe_checkout_session_id')
     inlines = [OrderItemInline]
     date_hierarchy = 'order_date'
     fieldsets = (
@@ -215,6 +322,10 @@ class OrderAdmin(admin.ModelAdmin):
         ('Shipping', {
             'fields': ('shipping_address', 'shipping_address_display'),
         }),
+        ('Payment', {
+            'fields': ('stripe_payment_intent_id', 'stripe_checkout_session_id'),
+            'classes': ('collapse',),
+        }),
         ('Additional Information', {
             'fields': ('notes',),
             'classes': ('collapse',),
@@ -222,6 +333,11 @@ class OrderAdmin(admin.ModelAdmin):
     )
     actions = ['mark_as_processing', 'mark_as_shipped', 'mark_as_delivered', 'mark_as_cancelled']
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            _items_count=related_aggregate(OrderItem, 'order', Count('pk')),
+        )
+    
     def customer_link(self, obj):
         if obj.customer:
             url = reverse('admin:api_customer_change', args=[obj.customer.id])
@@ -247,9 +363,9 @@ class OrderAdmin(admin.ModelAdmin):
     status_colored.admin_order_field = 'status'
     
     def items_count(self, obj):
-        count = obj.items.count()
-        return count
+        return obj._items_count or 0
     items_count.short_description = 'Items'
+    items_count.admin_order_field = '_items_count'
     
     def shipping_address_display(self, obj):
         if obj.shipping_address:
@@ -268,51 +384,58 @@ class OrderAdmin(admin.ModelAdmin):
     shipping_address_display.short_description = 'Shipping Address Details'
     
     def mark_as_processing(self, request, queryset):
-        updated = queryset.update(status='processing')
+        updated = queryset.update(status='processing', updated_at=timezone.now())
         self.message_user(request, f"{updated} orders marked as processing.")
     mark_as_processing.short_description = "Mark selected orders as processing"
     
     def mark_as_shipped(self, request, queryset):
-        updated = queryset.update(status='shipped')
+        updated = queryset.update(status='shipped', updated_at=timezone.now())
         self.message_user(request, f"{updated} orders marked as shipped.")
     mark_as_shipped.short_description = "Mark selected orders as shipped"
     
     def mark_as_delivered(self, request, queryset):
-        updated = queryset.update(status='delivered')
+        updated = queryset.update(status='delivered', updated_at=timezone.now())
         self.message_user(request, f"{updated} orders marked as delivered.")
     mark_as_delivered.short_description = "Mark selected orders as delivered"
     
     def mark_as_cancelled(self, request, queryset):
-        updated = queryset.update(status='cancelled')
+        updated = queryset.update(status='cancelled', updated_at=timezone.now())
         self.message_user(request, f"{updated} orders marked as cancelled.")
     mark_as_cancelled.short_description = "Mark selected orders as cancelled"
 
 
 @admin.register(OrderItem)
-class OrderItemAdmin(admin.ModelAdmin):
+class OrderItemAdmin(QueryBudgetAdminMixin, IndexedSearchMixin, EstimatedCountAdminMixin, admin.ModelAdmin):
     list_display = ('order_link', 'product_link', 'quantity', 'price', 'total_price')
+    list_select_related = ('product',)
+    changelist_query_budget = 12
     list_filter = ('order__status',)
     search_fields = ('order__id', 'product__name')
+    uuid_search_fields = ('order__id',)
     autocomplete_fields = ('order', 'product')
     readonly_fields = ('total_price',)
     
     def order_link(self, obj):
-        url = reverse('admin:api_order_change', args=[obj.order.id])
-        return format_html('<a href="{}">{}</a>', url, obj.order.id)
+        url = reverse('admin:api_order_change', args=[obj.order_id])
+        return format_html('<a href="{}">{}</a>', url, obj.order_id)
     order_link.short_description = 'Order'
     order_link.admin_order_field = 'order'
     
     def product_link(self, obj):
-        url = reverse('admin:api_product_change', args=[obj.product.id])
+        url = reverse('admin:api_product_change', args=[obj.product_id])
         return format_html('<a href="{}">{}</a>', url, obj.product.name)
     product_link.short_description = 'Product'
     product_link.admin_order_field = 'product__name'
 
 
 @admin.register(Cart)
-class CartAdmin(admin.ModelAdmin):
+class CartAdmin(QueryBudgetAdminMixin, IndexedSearchMixin, EstimatedCountAdminMixin, admin.ModelAdmin):
     list_display = ('cart_id', 'customer_link', 'total_items', 'total_price', 'updated_at')
-    search_fields = ('cart_id', 'customer__email')
+    list_select_related = ('customer',)
+    changelist_query_budget = 12
+    search_fields = ('^cart_id', 'customer__email')  # cart ids are UUIDs or device ids
+    uuid_search_fields = ('cart_id',)
+    email_search_fields = ('customer__email_normalized',)
     readonly_fields = ('cart_id', 'created_at', 'updated_at', 'total_items', 'total_price')
     inlines = [CartItemInline]
     fieldsets = (
@@ -324,6 +447,25 @@ class CartAdmin(admin.ModelAdmin):
         }),
     )
     
+    def get_queryset(self, request):
+        # Pricing every row through Cart.quote would be a query per cart.
+        return super().get_queryset(request).annotate(
+            _total_items=related_aggregate(CartItem, 'cart', Sum('quantity')),
+            _total_price=related_aggregate(CartItem, 'cart', Sum(F('quantity') * F('product__price'))),
+        )
+    
+    def total_items(self, obj):
+        if hasattr(obj, '_total_items'):
+            return obj._total_items or 0
+        return obj.total_items
+    total_items.short_description = 'Total items'
+    
+    def total_price(self, obj):
+        if hasattr(obj, '_total_price'):
+            return f"${obj._total_price or 0:.2f}"
+        return f"${obj.total_price:.2f}"
+    total_price.short_description = 'Total price'
+    
     def customer_link(self, obj):
         if obj.customer:
             url = reverse('admin:api_customer_change', args=[obj.customer.id])
@@ -331,6 +473,11 @@ class CartAdmin(admin.ModelAdmin):
         return "-"
     customer_link.short_description = 'Customer'
     customer_link.admin_order_field = 'customer__email'
+    
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Item edits in the inline change what the cart is priced at.
+        form.instance.mark_changed()
 
 
 # Custom Admin Dashboard
@@ -343,6 +490,11 @@ class AshtrayAdminSite(admin.AdminSite):
         urls = super().get_urls()
         custom_urls = [
             path('dashboard/', self.admin_view(self.dashboard_view), name='dashboard'),
+            path('profiles/', self.admin_view(self.profiles_view), name='profiles'),
+            path('profiles/<str:profile_id>/', self.admin_view(self.profile_view), name='profile'),
+            path('profiles/<str:profile_id>/<str:fmt>/', self.admin_view(self.profile_download_view),
+                 name='profile_download'),
+            path('slow-queries/', self.admin_view(self.slow_queries_view), name='slow_queries'),
         ]
         return custom_urls + urls
     
@@ -426,6 +578,67 @@ class AshtrayAdminSite(admin.AdminSite):
         }
         
         return TemplateResponse(request, 'admin/dashboard.html', context)
+    
+    def profiles_view(self, request):
+        """
+        Request profiles captured by api.profiling in this process.
+        """
+        if request.method == 'POST' and 'clear' in request.POST:
+            profile_store.clear()
+        context = {
+            **self.each_context(request),
+            'title': 'Request profiles',
+            'profiles': profile_store.all(),
+        }
+        return TemplateResponse(request, 'admin/profiles.html', context)
+    
+    def profile_view(self, request, profile_id):
+        profile = profile_store.get(profile_id)
+        if profile is None:
+            raise Http404("Profile not found; it may have been evicted or recorded by another process.")
+        context = {
+            **self.each_context(request),
+            'title': f'{profile.method} {profile.path}',
+            'profile': profile,
+        }
+        return TemplateResponse(request, 'admin/profile.html', context)
+    
+    def profile_download_view(self, request, profile_id, fmt):
+        """
+        Raw profile data: folded stacks for flamegraph.pl / speedscope, or
+        pstats for snakeviz and `python -m pstats`.
+        """
+        profile = profile_store.get(profile_id)
+        if profile is None:
+            raise Http404("Profile not found.")
+        if fmt == 'folded' and profile.folded:
+            response = HttpResponse(profile.folded, content_type='text/plain; charset=utf-8')
+        elif fmt == 'pstats' and profile.pstats_data:
+            response = HttpResponse(profile.pstats_data, content_type='application/octet-stream')
+        else:
+            raise Http404("This profile has no data in that format.")
+        response['Content-Disposition'] = f'attachment; filename="profile-{profile.id}.{fmt}"'
+        return response
+    
+    def slow_queries_view(self, request):
+        """
+        The slow query log kept by api.slow_queries in this process.
+        """
+        if request.method == 'POST' and 'clear' in request.POST:
+            slow_query_log.clear()
+        order_by = request.GET.get('o', 'total_ms')
+        if order_by not in SLOW_QUERY_ORDERINGS:
+            order_by = 'total_ms'
+        context = {
+            **self.each_context(request),
+            'title': 'Slow queries',
+            'entries': slow_query_log.entries(order_by),
+            'order_by': order_by,
+            'sort_options': [('total_ms', 'total time'), ('max_ms', 'slowest'), ('mean_ms', 'mean'),
+                             ('count', 'count'), ('last_seen', 'last seen')],
+            'threshold_ms': SLOW_QUERY_THRESHOLD_MS,
+        }
+        return TemplateResponse(request, 'admin/slow_queries.html', context)
 
 
 # Register with custom admin site
@@ -3,4 +3,12 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'api' 
\ No newline at end of file
+    name = 'api'
+    
+    def ready(self):
+        from . import signals  # noqa: F401 - connects the signal receivers
+        
+        from django.conf import settings
+        if settings.STRIPE_API_BASE:
+            import stripe
+            stripe.api_base = settings.STRIPE_API_BASE
@@ -0,0 +1,279 @@
+"""
+Benchmarks for the request paths that matter: cart and order rendering, the
+cart actions, webhook processing and the admin pages.
+
+The pytest suite in backend/benchmarks (`pytest -m benchmark`) and
+`manage.py benchmark` both seed a synthetic dataset at each requested size,
+time every scenario and count its queries, then save the results as a
+baseline or compare them against one. Timings are compared with a tolerance;
+query counts must not grow at all, since a new query per row is exactly the
+kind of regression that hides at small sizes.
+"""
+import json
+import os
+import platform
+import statistics
+import time
+import uuid
+from contextlib import redirect_stdout
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+
+from .admin import admin_site
+from .models import (
+    Customer, Product, Address, Order, OrderItem, Cart, CartItem, address_fingerprint,
+)
+from .serializers import CartSerializer, OrderSerializer
+from .stripe_emulator import sign_payload
+
+BASELINE_VERSION = 1
+CART_ITEMS = 20
+ORDER_ITEMS = 10
+SCENARIOS = (
+    'cart_serializer', 'order_serializer', 'cart_add_item', 'cart_checkout', 'stripe_webhook',
+    'admin_dashboard', 'admin_customer_changelist', 'admin_product_changelist',
+)
+
+
+def parse_size(value):
+    """
+    "1000", "100k" or "1m" -> rows.
+    """
+    value = value.strip().lower()
+    multiplier = {'k': 1000, 'm': 1000000}.get(value[-1:], 1)
+    if multiplier > 1:
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+
+class Dataset:
+    """
+    Synthetic shop data, grown in place: `grow(n)` adds customers (each with
+    an address and an order) and products until there are `n` of the former
+    and n / 10 of the latter.
+    """
+    def __init__(self, batch_size=5000):
+        self.batch_size = batch_size
+        self.size = 0
+        self.products = 0
+
+    def grow(self, size):
+        products = max(size // 10, CART_ITEMS + ORDER_ITEMS)
+        for start in range(self.products, products, self.batch_size):
+            Product.objects.bulk_create(
+                Product(name=f'Benchmark product {i:07d}', sku=f'bench-{i}', price=Decimal('12.50') + i % 40,
+                        description='Benchmark description', stock=1000000)
+                for i in range(start, min(start + self.batch_size, products))
+            )
+        self.products = max(self.products, products)
+        self.product = Product.objects.filter(sku='bench-0').get()
+        for start in range(self.size, size, self.batch_size):
+            self._add_customers(start, min(start + self.batch_size, size))
+        self.size = size
+
+    def _add_customers(self, start, stop):
+        customers = Customer.objects.bulk_create(
+            Customer(email=f'bench-{i}@example.com', email_normalized=f'bench-{i}@example.com', name=f'Customer {i}')
+            for i in range(start, stop)
+        )
+        addresses = []
+        for customer in customers:
+            fields = {'street_address': f'{customer.pk} Benchmark St', 'apartment_address': '',
+                      'city': 'Springfield', 'state': 'IL', 'country': 'US', 'postal_code': '62701'}
+            addresses.append(Address(customer=customer, fingerprint=address_fingerprint(**fields), **fields))
+        Address.objects.bulk_create(addresses)
+        orders = Order.objects.bulk_create(
+            Order(customer=address.customer, shipping_address=address, status='delivered', total_amount=Decimal('25.00'))
+            for address in addresses
+        )
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=self.product, quantity=2, price=Decimal('12.50')) for order in orders
+        )
+
+
+@dataclass
+class Scenario:
+    name: str
+    run: object  # callable timed each iteration
+    prepare: object = None  # untimed callable run before each iteration
+
+
+class Fixtures:
+    """
+    The objects the scenarios work on, created once on top of the dataset.
+    """
+    def __init__(self):
+        products = list(Product.objects.filter(sku__startswith='bench-').order_by('pk')[:CART_ITEMS + ORDER_ITEMS])
+        self.user = User.objects.create_superuser(f'bench-{uuid.uuid4().hex[:8]}', 'bench@example.com', 'bench')
+
+        self.cart = Cart.objects.create(cart_id=str(uuid.uuid4()))
+        CartItem.objects.bulk_create(CartItem(cart=self.cart, product=p, quantity=1) for p in products[:CART_ITEMS])
+        self.cart.mark_changed()
+        self.add_product = products[0]
+
+        self.checkout_cart = Cart.objects.create(cart_id=str(uuid.uuid4()))
+        self.checkout_products = products[:3]
+
+        customer = Customer.objects.create(email='bench-orders@example.com', name='Benchmark orders')
+        address = Address.objects.create(customer=customer, street_address='1 Benchmark St', city='Springfield',
+                                         state='IL', country='US', postal_code='62701')
+        self.order = Order.objects.create(customer=customer, shipping_address=address,
+                                          stripe_payment_intent_id=f'pi_bench_{uuid.uuid4().hex}')
+        OrderItem.objects.bulk_create(
+            OrderItem(order=self.order, product=p, quantity=1, price=p.price) for p in products[CART_ITEMS:]
+        )
+
+    def api_client(self, cart):
+        client = APIClient(SERVER_NAME='localhost')
+        client.cookies['cart_id'] = cart.cart_id
+        return client
+
+    def admin_client(self):
+        client = Client(SERVER_NAME='localhost')
+        client.force_login(self.user)
+        return client
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def expect_ok(response):
+    # A scenario that starts failing would otherwise look like a speedup.
+    if not 200 <= response.status_code < 300:
+        raise BenchmarkError(f"{response.request['PATH_INFO']} returned {response.status_code}")
+
+
+def scenarios(fixtures):
+    context = {'request': APIRequestFactory().get('/api/cart/', SERVER_NAME='localhost')}
+    cart_client = fixtures.api_client(fixtures.cart)
+    checkout_client = fixtures.api_client(fixtures.checkout_cart)
+    webhook_client = Client(SERVER_NAME='localhost')
+    admin_client = fixtures.admin_client()
+    dashboard_request = RequestFactory().get('/admin/', SERVER_NAME='localhost')
+    dashboard_request.user = fixtures.user
+
+    def fill_checkout_cart():
+        CartItem.objects.filter(cart=fixtures.checkout_cart).delete()
+        CartItem.objects.bulk_create(
+            CartItem(cart=fixtures.checkout_cart, product=p, quantity=1) for p in fixtures.checkout_products
+        )
+        fixtures.checkout_cart.mark_changed()
+
+    def checkout():
+        response = checkout_client.post('/api/cart/checkout/', {
+            'customer_email': 'bench-checkout@example.com',
+            'shipping_address': {'street_address': '2 Benchmark St', 'city': 'Springfield', 'state': 'IL',
+                                 'country': 'US', 'postal_code': '62701'},
+        }, format='json')
+        expect_ok(response)
+
+    def reset_order():
+        Order.objects.filter(pk=fixtures.order.pk).update(status='pending')
+
+    def webhook():
+        payload = json.dumps({
+            'id': f'evt_{uuid.uuid4().hex}', 'object': 'event', 'type': 'payment_intent.succeeded',
+            'data': {'object': {'id': fixtures.order.stripe_payment_intent_id, 'object': 'payment_intent',
+                                'amount': 2500, 'status': 'succeeded', 'metadata': {}}},
+        })
+        response = webhook_client.post('/webhook/stripe/', payload, content_type='application/json',
+                                       HTTP_STRIPE_SIGNATURE=sign_payload(payload, settings.STRIPE_WEBHOOK_SECRET))
+        expect_ok(response)
+
+    def get(client, url):
+        def run():
+            expect_ok(client.get(url))
+        return run
+
+    return [
+        Scenario('cart_serializer', lambda: JSONRenderer().render(
+            CartSerializer(Cart.objects.get(pk=fixtures.cart.pk).prefetch_items(), context=context).data)),
+        Scenario('order_serializer', lambda: JSONRenderer().render(
+            OrderSerializer(Order.objects.with_related().get(pk=fixtures.order.pk), context=context).data)),
+        Scenario('cart_add_item', lambda: expect_ok(cart_client.post(
+            '/api/cart/add_item/', {'product_id': fixtures.add_product.pk, 'quantity': 1}, format='json'))),
+        Scenario('cart_checkout', checkout, prepare=fill_checkout_cart),
+        Scenario('stripe_webhook', webhook, prepare=reset_order),
+        Scenario('admin_dashboard', lambda: admin_site.dashboard_view(dashboard_request).render()),
+        Scenario('admin_customer_changelist', get(admin_client, '/admin/api/customer/')),
+        Scenario('admin_product_changelist', get(admin_client, '/admin/api/product/')),
+    ]
+
+
+def measure(scenario, iterations):
+    """
+    Count the queries of one untimed run (which also warms caches), then time
+    `iterations` runs. The views' debug prints are discarded.
+
+    Queries are counted with an execute wrapper rather than connection.queries,
+    which every request through the test client resets.
+    """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        if scenario.prepare:
+            scenario.prepare()
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+            scenario.run()
+        timings = []
+        for _ in range(iterations):
+            if scenario.prepare:
+                scenario.prepare()
+            start = time.perf_counter()
+            scenario.run()
+            timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'median_ms': round(statistics.median(timings), 3),
+        'min_ms': round(min(timings), 3),
+        'queries': len(queries),
+    }
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError) as e:
+        raise BenchmarkError(f"Could not read baseline {path}: {e}")
+    if baseline.get('version') != BASELINE_VERSION:
+        raise BenchmarkError(f"{path} is not a version {BASELINE_VERSION} baseline.")
+    return baseline
+
+
+def save_baseline(path, results, iterations):
+    with open(path, 'w') as f:
+        json.dump({
+            'version': BASELINE_VERSION,
+            'created': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'iterations': iterations,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """
+    Yield (size, scenario, current, previous, regressed) for every result the
+    baseline also has. A scenario regresses when it runs more queries, or
+    when its median is more than `tolerance` (a fraction) and `min_delta_ms`
+    slower.
+    """
+    for size, scenarios in results.items():
+        for name, current in scenarios.items():
+            previous = baseline.get('results', {}).get(size, {}).get(name)
+            if previous is None:
+                continue
+            slower = current['median_ms'] - previous['median_ms']
+            regressed = current['queries'] > previous['queries'] or (
+                slower > min_delta_ms and current['median_ms'] > previous['median_ms'] * (1 + tolerance)
+            )
+            yield size, name, current, previous, regressed
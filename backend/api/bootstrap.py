@@ -0,0 +1,92 @@
+"""
+Storefront bootstrap.
+
+/api/bootstrap/ hands the storefront everything its first paint needs in one
+response: the first page of the active catalog, the visitor's cart and the
+Stripe publishable key. Both data parts are cached fragments:
+
+- The catalog page is cached under the catalog version, a token kept in
+  the cache that product saves and deletes (see api.signals) and catalog
+  imports replace once they commit. Image variants are written without
+  bumping it, and with a per-process cache other processes don't see the
+  bump, so the fragment also expires after BOOTSTRAP_CACHE_TIMEOUT.
+- The cart is cached under its version and updated_at, which every change to
+  its items (and to the prices or names of its products) moves.
+
+A warm bootstrap costs one small query: the cart row.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.urls import reverse
+
+from .fast_serializers import CartValuesSerializer, ProductValuesSerializer
+from .models import Product
+
+BOOTSTRAP_CACHE_TIMEOUT = getattr(settings, 'BOOTSTRAP_CACHE_TIMEOUT', 300)
+CATALOG_VERSION_KEY = 'bootstrap:catalog-version'
+
+
+def _site_root(request):
+    # Media URLs are absolute, so fragments are kept per site root.
+    return request.build_absolute_uri('/')
+
+
+def catalog_version():
+    """
+    A token that changes whenever a product is added, edited or deleted.
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(CATALOG_VERSION_KEY, version, None):
+            version = cache.get(CATALOG_VERSION_KEY, version)
+    return version
+
+
+def bump_catalog_version():
+    """
+    Retire the cached catalog page once the current transaction commits;
+    bumping earlier would let a request cache the old rows under the new
+    version.
+    """
+    transaction.on_commit(lambda: cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, None))
+
+
+def catalog_fragment(request):
+    """
+    The first page of /api/products/, as that endpoint renders it.
+    """
+    key = f'bootstrap:catalog:{_site_root(request)}:{catalog_version()}'
+    fragment = cache.get(key)
+    if fragment is None:
+        page_size = settings.REST_FRAMEWORK.get('PAGE_SIZE') or 10
+        serializer = ProductValuesSerializer(context={'request': request})
+        queryset = Product.objects.filter(active=True)
+        count = queryset.count()
+        rows = queryset.values(*serializer.columns)[:page_size]
+        fragment = {
+            'count': count,
+            'next': (
+                request.build_absolute_uri(reverse('product-list')) + '?page=2'
+                if count > page_size else None
+            ),
+            'previous': None,
+            'results': serializer.render_many(rows),
+        }
+        cache.set(key, fragment, BOOTSTRAP_CACHE_TIMEOUT)
+    return fragment
+
+
+def cart_fragment(cart, request):
+    """
+    The cart as /api/cart/current/ renders it.
+    """
+    key = f'bootstrap:cart:{_site_root(request)}:{cart.pk}:{cart.version}:{cart.updated_at.timestamp()}'
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = CartValuesSerializer(context={'request': request}).render(cart)
+        cache.set(key, fragment, BOOTSTRAP_CACHE_TIMEOUT)
+    return fragment
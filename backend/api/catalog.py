@@ -0,0 +1,243 @@
+"""
+Bulk catalog import.
+
+Rows are keyed by SKU and may carry any of name, price, description, stock
+and active; columns that are missing from a row are left alone, so a price
+and stock sync only needs `sku,price,stock`. The incoming rows are diffed
+against the current catalog and only real changes are written, with
+bulk_create and a batched executemany() UPDATE inside a single transaction.
+"""
+import csv
+import json
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .bootstrap import bump_catalog_version
+from .models import Product
+from .pricing import invalidate_product_quotes
+
+CATALOG_FIELDS = ('name', 'price', 'description', 'stock', 'active')
+REQUIRED_FOR_CREATE = ('name', 'price')
+PRICE_FIELD = Product._meta.get_field('price')
+
+_TRUE = {'1', 'true', 'yes', 'y', 't'}
+_FALSE = {'0', 'false', 'no', 'n', 'f', ''}
+
+
+class CatalogImportError(ValueError):
+    pass
+
+
+@dataclass
+class CatalogImportResult:
+    created: list = field(default_factory=list)
+    updated: dict = field(default_factory=dict)  # sku -> {field: (old, new)}
+    unchanged: int = 0
+    errors: list = field(default_factory=list)  # (row number, message)
+    dry_run: bool = False
+
+    @property
+    def applied(self):
+        return not self.errors and not self.dry_run
+
+    def summary(self):
+        if self.errors:
+            return f"Import aborted: {len(self.errors)} invalid rows, nothing was changed."
+        prefix = "Dry run: would create" if self.dry_run else "Created"
+        return (
+            f"{prefix} {len(self.created)} products, updated {len(self.updated)}, "
+            f"{self.unchanged} unchanged."
+        )
+
+
+def catalog_format(filename):
+    """
+    Guess the catalog format from a file name.
+    """
+    if filename.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if filename.lower().endswith('.csv'):
+        return 'csv'
+    raise CatalogImportError(f"Can't tell the format of {filename}; use a .csv or .jsonl file.")
+
+
+def read_catalog_rows(text_stream, fmt):
+    """
+    Yield raw row dicts from a CSV (with a header row) or JSONL text stream.
+    """
+    if fmt == 'csv':
+        yield from csv.DictReader(text_stream)
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(text_stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise CatalogImportError(f"Line {line_number}: invalid JSON ({e}).")
+    else:
+        raise CatalogImportError(f"Unknown catalog format {fmt!r}.")
+
+
+def clean_row(raw):
+    """
+    Validate and convert one raw row. Returns (sku, {field: value}) holding
+    only the catalog fields present in the row.
+    """
+    if not isinstance(raw, dict):
+        raise CatalogImportError(f"Expected an object, got {type(raw).__name__}.")
+    sku = str(raw.get('sku') or '').strip()
+    if not sku:
+        raise CatalogImportError("Missing sku.")
+    _check_length('sku', sku)
+
+    values = {}
+    for name in CATALOG_FIELDS:
+        if name not in raw or raw[name] is None:
+            continue
+        value = raw[name]
+        if name == 'price':
+            try:
+                value = Decimal(str(value).strip())
+                if not value.is_finite():
+                    raise InvalidOperation
+                value = value.quantize(Decimal(1).scaleb(-PRICE_FIELD.decimal_places))
+            except InvalidOperation:
+                raise CatalogImportError(f"Invalid price {raw[name]!r}.")
+            if value < 0:
+                raise CatalogImportError("Price can't be negative.")
+            if len(value.as_tuple().digits) > PRICE_FIELD.max_digits:
+                raise CatalogImportError(f"Price {value} has more than {PRICE_FIELD.max_digits} digits.")
+        elif name == 'stock':
+            try:
+                value = int(str(value).strip() or 0)
+            except ValueError:
+                raise CatalogImportError(f"Invalid stock {value!r}.")
+        elif name == 'active':
+            if not isinstance(value, bool):
+                text = str(value).strip().lower()
+                if text not in _TRUE | _FALSE:
+                    raise CatalogImportError(f"Invalid active flag {value!r}.")
+                value = text in _TRUE
+        else:
+            value = str(value).strip()
+            if name == 'name' and not value:
+                raise CatalogImportError("Name can't be blank.")
+            if name == 'description':
+                value = value or None
+            _check_length(name, value)
+        values[name] = value
+    return sku, values
+
+
+def _check_length(name, value):
+    # Too long a value is a DataError on PostgreSQL, which would abort the
+    # whole import transaction instead of being reported against its row.
+    max_length = Product._meta.get_field(name).max_length
+    if max_length is not None and value is not None and len(value) > max_length:
+        raise CatalogImportError(f"{name.capitalize()} is longer than {max_length} characters.")
+
+
+def _existing_products(skus, chunk_size=900):
+    # Chunked to stay under SQLite's bound parameter limit.
+    existing = {}
+    skus = list(skus)
+    for start in range(0, len(skus), chunk_size):
+        chunk = skus[start:start + chunk_size]
+        for product in Product.objects.filter(sku__in=chunk).only('id', 'sku', *CATALOG_FIELDS):
+            existing[product.sku] = product
+    return existing
+
+
+def bulk_update_rows(products, field_names, batch_size=1000):
+    """
+    Write `field_names` of every product with one parametrized UPDATE run
+    through executemany(). QuerySet.bulk_update() builds a CASE/WHEN
+    expression per field and row, which costs far more than the writes
+    themselves at catalog sizes.
+    """
+    connection = connections[router.db_for_write(Product)]
+    quote_name = connection.ops.quote_name
+    fields = [Product._meta.get_field(name) for name in field_names]
+    assignments = ', '.join(f'{quote_name(field.column)} = %s' for field in fields)
+    sql = (
+        f'UPDATE {quote_name(Product._meta.db_table)} SET {assignments} '
+        f'WHERE {quote_name(Product._meta.pk.column)} = %s'
+    )
+    with connection.cursor() as cursor:
+        for start in range(0, len(products), batch_size):
+            cursor.executemany(sql, [
+                [field.get_db_prep_save(getattr(product, field.attname), connection) for field in fields]
+                + [product.pk]
+                for product in products[start:start + batch_size]
+            ])
+
+
+def import_catalog(rows, dry_run=False, batch_size=1000):
+    """
+    Diff `rows` against the catalog and apply the changes in one transaction.
+    Any invalid row aborts the whole import.
+    """
+    result = CatalogImportResult(dry_run=dry_run)
+
+    cleaned = {}
+    for row_number, raw in enumerate(rows, start=1):
+        try:
+            sku, values = clean_row(raw)
+        except CatalogImportError as e:
+            result.errors.append((row_number, str(e)))
+            continue
+        if sku in cleaned:
+            result.errors.append((row_number, f"Duplicate sku {sku}."))
+            continue
+        cleaned[sku] = values
+
+    existing = _existing_products(cleaned)
+    now = timezone.now()
+    to_create, to_update, changed_fields = [], [], set()
+
+    for sku, values in cleaned.items():
+        product = existing.get(sku)
+        if product is None:
+            missing = [name for name in REQUIRED_FOR_CREATE if name not in values]
+            if missing:
+                result.errors.append((sku, f"New product needs {', '.join(missing)}."))
+                continue
+            to_create.append(Product(sku=sku, **values))
+            result.created.append(sku)
+            continue
+
+        changes = {
+            name: (getattr(product, name), value)
+            for name, value in values.items()
+            if getattr(product, name) != value
+        }
+        if not changes:
+            result.unchanged += 1
+            continue
+        for name, (_, value) in changes.items():
+            setattr(product, name, value)
+        # Bulk writes skip auto_now, so stamp the rows that really changed.
+        product.updated_at = now
+        changed_fields.update(changes)
+        to_update.append(product)
+        result.updated[sku] = changes
+
+    if result.errors or dry_run:
+        return result
+
+    with transaction.atomic():
+        Product.objects.bulk_create(to_create, batch_size=batch_size)
+        if to_update:
+            bulk_update_rows(to_update, sorted(changed_fields) + ['updated_at'], batch_size=batch_size)
+            # The bulk UPDATE skips the post_save hook that reprices carts.
+            if changed_fields & {'price', 'name'}:
+                invalidate_product_quotes(product.pk for product in to_update)
+        # bulk_create and the bulk UPDATE skip the receivers that bump the catalog version.
+        if to_create or to_update:
+            bump_catalog_version()
+    return result
@@ -0,0 +1,262 @@
+"""
+Helpers that keep admin changelists fast on very large tables.
+
+Above ADMIN_ESTIMATED_COUNT_THRESHOLD rows, changelists use the planner's row
+estimate instead of COUNT(*) and skip the second, unfiltered count. The
+estimate comes from pg_class.reltuples or EXPLAIN on PostgreSQL and from
+sqlite_stat1 (filled in by ANALYZE) on SQLite. Date hierarchy buckets are
+served from cached rollups instead of scanning for distinct dates on every
+render. Searches that look like a UUID or an email address become exact,
+indexed lookups; other terms go through the text index in api.search.
+"""
+import hashlib
+import json
+import re
+import uuid
+
+from django.conf import settings
+from django.contrib.admin.utils import get_fields_from_path
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import Max, Min, Q, QuerySet, UUIDField
+from django.db.models.expressions import RawSQL
+from django.utils.functional import cached_property
+
+from .search import match_sql
+
+EMAIL_RE = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+UUID_PREFIX_RE = re.compile(r'[0-9a-f]{8}[0-9a-f-]*', re.IGNORECASE)
+
+
+def estimated_count_threshold():
+    return getattr(settings, 'ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000)
+
+
+def estimate_table_rows(model, using='default'):
+    """
+    The planner's estimate of a table's row count, or None if there isn't one.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [table])
+            row = cursor.fetchone()
+            # reltuples is -1 for tables that have never been vacuumed or analyzed
+            return int(row[0]) if row and row[0] >= 0 else None
+        if connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table])
+            row = cursor.fetchone()
+            return int(row[0].split()[0]) if row else None
+    return None
+
+
+def estimate_queryset_rows(queryset):
+    """
+    Estimate how many rows `queryset` returns. Unfiltered querysets use the
+    table estimate; filtered ones can only be estimated on PostgreSQL.
+    """
+    query = queryset.query
+    if not query.where and not query.distinct and not query.combinator:
+        return estimate_table_rows(queryset.model, queryset.db)
+
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    try:
+        sql, params = query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that trusts the planner's estimate once it passes the threshold.
+    Smaller result sets are still counted exactly.
+    """
+    @cached_property
+    def count(self):
+        if isinstance(self.object_list, QuerySet):
+            estimate = estimate_queryset_rows(self.object_list)
+            if estimate is not None and estimate >= estimated_count_threshold():
+                return estimate
+        return super().count
+
+
+class RollupDatesMixin:
+    """
+    QuerySet mixin caching the dates()/datetimes() buckets and Min/Max date
+    range, the queries behind ModelAdmin.date_hierarchy, per filtered query.
+    """
+    rollup_timeout = getattr(settings, 'ADMIN_DATE_ROLLUP_TIMEOUT', 600)
+
+    def _rollup_key(self, *parts):
+        try:
+            sql = str(self.query)
+        except EmptyResultSet:
+            return None
+        digest = hashlib.sha1('|'.join([sql, *map(str, parts)]).encode()).hexdigest()
+        return f'admin-date-rollup:{self.model._meta.label_lower}:{digest}'
+
+    def _cached(self, key, compute):
+        if key is None:
+            return compute()
+        result = cache.get(key)
+        if result is None:
+            result = compute()
+            cache.set(key, result, self.rollup_timeout)
+        return result
+
+    def dates(self, field_name, kind, order='ASC'):
+        key = self._rollup_key('dates', field_name, kind, order)
+        return self._cached(key, lambda: list(super(RollupDatesMixin, self).dates(field_name, kind, order)))
+
+    def datetimes(self, field_name, kind, order='ASC', tzinfo=None):
+        key = self._rollup_key('datetimes', field_name, kind, order, tzinfo)
+        return self._cached(key, lambda: list(super(RollupDatesMixin, self).datetimes(field_name, kind, order, tzinfo)))
+
+    def aggregate(self, *args, **kwargs):
+        if args or not kwargs or not all(isinstance(agg, (Min, Max)) for agg in kwargs.values()):
+            return super().aggregate(*args, **kwargs)
+        key = self._rollup_key('range', *sorted(f'{alias}={agg!r}' for alias, agg in kwargs.items()))
+        return self._cached(key, lambda: super(RollupDatesMixin, self).aggregate(**kwargs))
+
+
+_rollup_classes = {}
+
+
+def with_date_rollups(queryset):
+    """
+    `queryset` with RollupDatesMixin mixed into its own class, so custom
+    queryset methods (Order.objects.with_related(), ...) keep working.
+    """
+    base = type(queryset)
+    if issubclass(base, RollupDatesMixin):
+        return queryset
+    cls = _rollup_classes.get(base)
+    if cls is None:
+        cls = _rollup_classes[base] = type(f'Rollup{base.__name__}', (RollupDatesMixin, base), {})
+    queryset = queryset._chain()
+    queryset.__class__ = cls
+    return queryset
+
+
+class EstimatedCountAdminMixin:
+    """
+    ModelAdmin mixin switching large changelists to estimated counts and
+    cached date hierarchy rollups.
+    """
+    paginator = EstimatedCountPaginator
+
+    @property
+    def show_full_result_count(self):
+        # The unfiltered "(N total)" count is a second full COUNT(*); only
+        # run it while the table is small enough for that to be cheap.
+        estimate = estimate_table_rows(self.model)
+        return estimate is None or estimate < estimated_count_threshold()
+
+    def get_queryset(self, request):
+        return with_date_rollups(super().get_queryset(request))
+
+
+def parse_uuid(value):
+    try:
+        return uuid.UUID(value)
+    except ValueError:
+        return None
+
+
+def uuid_prefix_range(value):
+    """
+    The lowest and highest UUIDs starting with the hex digits of `value`
+    (at least 8, dashes ignored), or None. A range over the column uses its
+    index on every backend, unlike `startswith`, which casts or LIKEs.
+    """
+    if not UUID_PREFIX_RE.fullmatch(value):
+        return None
+    digits = value.replace('-', '').lower()
+    if len(digits) >= 32:
+        return None
+    padding = 32 - len(digits)
+    return uuid.UUID(digits + '0' * padding), uuid.UUID(digits + 'f' * padding)
+
+
+class IndexedSearchMixin:
+    """
+    ModelAdmin mixin that answers searches from indexes instead of running
+    `icontains` over every search field.
+
+    - a UUID-shaped term is matched exactly against `uuid_search_fields`,
+      and a hex term of at least 8 digits as a prefix of them (falling
+      through to the text search when that finds nothing),
+    - an email-shaped term is matched exactly against `email_search_fields`
+      (falling through to the text search when that finds nothing),
+    - anything else goes to the text index (api.search) when there is one,
+      and to the regular search_fields otherwise.
+
+    `uuid_search_fields` that are UUIDField columns are left out of the
+    regular search, where casting the column to text for `icontains` rules
+    out any index. Text columns holding UUIDs, which may also hold other ids,
+    stay in it (ideally as `^field`).
+    """
+    uuid_search_fields = ()
+    email_search_fields = ()
+
+    def get_search_fields(self, request):
+        uuid_columns = {
+            field for field in self.uuid_search_fields
+            if isinstance(get_fields_from_path(self.model, field)[-1], UUIDField)
+        }
+        return tuple(
+            field for field in super().get_search_fields(request)
+            if field not in uuid_columns
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return super().get_search_results(request, queryset, search_term)
+
+        value = parse_uuid(term) if self.uuid_search_fields else None
+        if value is not None:
+            query = Q()
+            for field in self.uuid_search_fields:
+                # CharField columns holding UUIDs may store the text as typed
+                query |= Q(**{field: str(value)}) | Q(**{field: term})
+            return queryset.filter(query), False
+
+        bounds = uuid_prefix_range(term) if self.uuid_search_fields else None
+        if bounds is not None:
+            query = Q()
+            for field in self.uuid_search_fields:
+                # CharField columns get the bounds as dashed UUID text.
+                query |= Q(**{f'{field}__range': bounds})
+            matches = queryset.filter(query)
+            # Names and other text can be all hex digits too.
+            if matches.exists():
+                return matches, False
+
+        if self.email_search_fields and EMAIL_RE.fullmatch(term):
+            query = Q()
+            for field in self.email_search_fields:
+                query |= Q(**{field: term}) | Q(**{field: term.lower()})
+            matches = queryset.filter(query)
+            # Addresses stored with different casing still turn up below.
+            if matches.exists():
+                return matches, False
+
+        subquery = match_sql(self.model, term, using=queryset.db)
+        if subquery is not None:
+            return queryset.filter(pk__in=RawSQL(*subquery)), False
+        return super().get_search_results(request, queryset, search_term)
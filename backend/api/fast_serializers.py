@@ -0,0 +1,174 @@
+"""
+Compiled, read-only serializers that render `.values()` rows.
+
+ModelSerializer converts every field of every object through its own
+`to_representation` call. For the catalog and the current cart that
+dispatch dominates the response time, so these serializers pull plain
+rows with `.values()` and turn them into dicts with a function generated
+once per field selection. The output matches ProductSerializer and
+CartSerializer exactly; use the DRF serializers for anything else.
+"""
+from decimal import Decimal
+
+from django.utils import timezone
+
+from .images import variant_urls
+from .models import Product, CartItem
+from .pricing import quote_cart
+from .serializers import ProductSerializer
+from .tracing import traced
+
+
+CENTS = Decimal('0.01')
+
+
+def decimal_to_string(value):
+    if value is None:
+        return None
+    return '{:f}'.format(value.quantize(CENTS))
+
+
+def compile_row_renderer(columns):
+    """
+    Build a function turning a `.values()` row into an output dict.
+
+    `columns` is a sequence of (output key, row key, converter) tuples; a
+    converter of None copies the value through. Converters receive the
+    value and the render context, so the generated body is a single dict
+    literal with no per-field loop or method lookup.
+    """
+    namespace = {}
+    items = []
+    for index, (key, column, converter) in enumerate(columns):
+        if converter is None:
+            items.append(f'{key!r}: row[{column!r}]')
+        else:
+            namespace[f'c{index}'] = converter
+            items.append(f'{key!r}: c{index}(row[{column!r}], ctx)')
+    source = 'def render_row(row, ctx):\n    return {' + ', '.join(items) + '}\n'
+    exec(compile(source, '<compiled row renderer>', 'exec'), namespace)
+    return namespace['render_row']
+
+
+class RenderContext:
+    """
+    Per-render state shared by the converters (request and timezone).
+    """
+    def __init__(self, request=None):
+        self.request = request
+        self.timezone = timezone.get_current_timezone()
+
+
+def _datetime(value, ctx):
+    # Mirrors rest_framework.fields.DateTimeField.to_representation.
+    if value is None:
+        return None
+    value = value.astimezone(ctx.timezone).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def _decimal(value, ctx):
+    return decimal_to_string(value)
+
+
+_image_storage = Product._meta.get_field('image').storage
+
+
+def _image(value, ctx):
+    # Mirrors rest_framework.fields.FileField.to_representation.
+    if not value:
+        return None
+    url = _image_storage.url(value)
+    if ctx.request is not None:
+        return ctx.request.build_absolute_uri(url)
+    return url
+
+
+def _image_variants(value, ctx):
+    return variant_urls(value, ctx.request)
+
+
+PRODUCT_CONVERTERS = {
+    'price': _decimal,
+    'image': _image,
+    'image_variants': _image_variants,
+    'created_at': _datetime,
+    'updated_at': _datetime,
+}
+
+
+class ProductValuesSerializer:
+    """
+    Renders Product `.values()` rows the way ProductSerializer would.
+
+    `fields` optionally restricts the output (and the selected columns)
+    to a subset of ProductSerializer.Meta.fields.
+    """
+    _renderers = {}
+
+    def __init__(self, fields=None, context=None):
+        names = ProductSerializer.Meta.fields
+        if fields is not None:
+            names = [name for name in names if name in set(fields)]
+        self.columns = tuple(names)
+        self.context = context or {}
+        self.render_row = self.get_row_renderer(self.columns)
+
+    @classmethod
+    def get_row_renderer(cls, columns, prefix=''):
+        key = (columns, prefix)
+        if key not in cls._renderers:
+            cls._renderers[key] = compile_row_renderer([
+                (name, prefix + name, PRODUCT_CONVERTERS.get(name))
+                for name in columns
+            ])
+        return cls._renderers[key]
+
+    @traced()
+    def render_many(self, rows):
+        ctx = RenderContext(self.context.get('request'))
+        render_row = self.render_row
+        return [render_row(row, ctx) for row in rows]
+
+
+class CartValuesSerializer:
+    """
+    Renders a cart the way CartSerializer would, with one query for the
+    items and their products. Totals come from the cart's pricing quote.
+    """
+    product_columns = tuple(ProductSerializer.Meta.fields)
+    item_columns = ('id', 'quantity') + tuple(f'product__{name}' for name in product_columns)
+
+    def __init__(self, context=None):
+        self.context = context or {}
+
+    @traced()
+    def render(self, cart):
+        ctx = RenderContext(self.context.get('request'))
+        render_product = ProductValuesSerializer.get_row_renderer(self.product_columns, 'product__')
+
+        quote = quote_cart(cart)
+        lines = {line.item_id: line for line in quote.lines}
+        items = []
+        rows = CartItem.objects.filter(cart=cart).values(*self.item_columns)
+        for row in rows:
+            line = lines.get(row['id'])
+            line_total = line.total_price if line else row['product__price'] * row['quantity']
+            items.append({
+                'id': row['id'],
+                'product': render_product(row, ctx),
+                'quantity': row['quantity'],
+                'total_price': decimal_to_string(line_total),
+            })
+
+        return {
+            'id': cart.pk,
+            'cart_id': cart.cart_id,
+            'items': items,
+            'total_items': quote.total_items,
+            'total_price': decimal_to_string(quote.total_price),
+            'created_at': _datetime(cart.created_at, ctx),
+            'updated_at': _datetime(cart.updated_at, ctx),
+        }
@@ -0,0 +1,158 @@
+"""
+Derivative images for product uploads.
+
+When a product image is uploaded, a small pool of background threads renders
+a square admin thumbnail plus WebP (and, where Pillow supports it, AVIF)
+variants at several widths. File names are derived from a hash of the source
+bytes, so re-uploading the same picture reuses the existing files. The
+storage names end up in Product.image_variants:
+
+    {
+        "source": "products/ashtray.png",
+        "thumbnail": "products/variants/3f2a...-thumb.webp",
+        "webp": {"160": "products/variants/3f2a...-160w.webp", ...},
+        "avif": {"160": "products/variants/3f2a...-160w.avif", ...},
+    }
+"""
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from PIL import Image, ImageOps, features
+
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+VARIANT_WIDTHS = getattr(settings, 'PRODUCT_IMAGE_WIDTHS', (160, 320, 640, 1280))
+THUMBNAIL_SIZE = getattr(settings, 'PRODUCT_IMAGE_THUMBNAIL_SIZE', 100)
+VARIANT_DIRECTORY = 'products/variants'
+
+
+def _supported_formats():
+    formats = ['webp']
+    try:
+        if features.check('avif'):
+            formats.append('avif')
+    except ValueError:  # Pillow releases that predate AVIF support
+        pass
+    return formats
+
+
+VARIANT_FORMATS = _supported_formats()
+
+# Pillow releases the GIL while encoding, so a couple of threads keep uploads
+# from queueing behind each other without competing with request threads.
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'PRODUCT_IMAGE_WORKERS', 2),
+    thread_name_prefix='product-images',
+)
+
+_storage = Product._meta.get_field('image').storage
+
+
+def schedule_variants(product):
+    """
+    Generate variants for the product's current image once the surrounding
+    transaction commits.
+    """
+    product_id, source_name = product.pk, product.image.name
+    transaction.on_commit(lambda: _executor.submit(_run_job, product_id, source_name))
+
+
+def _run_job(product_id, source_name):
+    try:
+        generate_variants(product_id, source_name)
+    except Exception:
+        logger.exception("Failed to generate image variants for product %s", product_id)
+    finally:
+        # Worker threads get their own connection; don't leave it open.
+        connection.close()
+
+
+def generate_variants(product_id, source_name):
+    """
+    Render and store every variant of `source_name`, then record them on the
+    product unless its image has been replaced in the meantime.
+    """
+    with _storage.open(source_name, 'rb') as source_file:
+        data = source_file.read()
+    digest = hashlib.sha256(data).hexdigest()[:16]
+
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+        variants = {'source': source_name}
+        thumbnail = ImageOps.fit(image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+        variants['thumbnail'] = _save(thumbnail, f'{digest}-thumb', 'webp')
+
+        # Never upscale; images narrower than every width get one native-size variant.
+        widths = [width for width in VARIANT_WIDTHS if width <= image.width] or [image.width]
+        for fmt in VARIANT_FORMATS:
+            variants[fmt] = {}
+            for width in widths:
+                height = round(image.height * width / image.width)
+                resized = image.resize((width, height), Image.LANCZOS)
+                variants[fmt][str(width)] = _save(resized, f'{digest}-{width}w', fmt)
+
+    # Conditional update: a newer upload wins over a slow job for an old one.
+    # Going through update() also keeps updated_at and the post_save hooks out of it.
+    Product.objects.filter(pk=product_id, image=source_name).update(image_variants=variants)
+    return variants
+
+
+def _save(image, stem, fmt):
+    name = f'{VARIANT_DIRECTORY}/{stem}.{fmt}'
+    if _storage.exists(name):
+        return name
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt.upper(), quality=80)
+    return _storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def _url(name, request=None):
+    url = _storage.url(name)
+    if request is not None:
+        return request.build_absolute_uri(url)
+    return url
+
+
+def variant_urls(variants, request=None):
+    """
+    Turn the storage names in Product.image_variants into URLs.
+    """
+    if not variants:
+        return {}
+    urls = {}
+    if variants.get('thumbnail'):
+        urls['thumbnail'] = _url(variants['thumbnail'], request)
+    for fmt in VARIANT_FORMATS:
+        if variants.get(fmt):
+            urls[fmt] = {width: _url(name, request) for width, name in variants[fmt].items()}
+    return urls
+
+
+def best_variant_url(variants, width, fmt='webp', request=None):
+    """
+    URL of the smallest `fmt` variant at least `width` pixels wide (or the
+    largest one available), or None when there are no variants yet.
+    """
+    widths = sorted((int(w), name) for w, name in (variants or {}).get(fmt, {}).items())
+    if not widths:
+        return None
+    for candidate_width, name in widths:
+        if candidate_width >= width:
+            return _url(name, request)
+    return _url(widths[-1][1], request)
+
+
+def thumbnail_url(variants, request=None):
+    if variants and variants.get('thumbnail'):
+        return _url(variants['thumbnail'], request)
+    return None
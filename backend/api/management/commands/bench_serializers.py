@@ -0,0 +1,73 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from api.fast_serializers import ProductValuesSerializer, CartValuesSerializer
+from api.models import Product, Cart, CartItem
+from api.renderers import ORJSONRenderer
+from api.serializers import ProductSerializer, CartSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmark the compiled .values() serializers and the orjson "
+        "renderer against the DRF serializers. Runs inside a transaction "
+        "that is rolled back, so the database is left untouched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000, help='Number of products to render.')
+        parser.add_argument('--cart-items', type=int, default=50, help='Number of items in the benchmark cart.')
+        parser.add_argument('--iterations', type=int, default=20, help='Timed runs per case.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def run(self, options):
+        products = Product.objects.bulk_create(
+            Product(name=f'Benchmark product {i:06d}', price=Decimal('12.50'),
+                    description='Benchmark description', stock=10)
+            for i in range(options['products'])
+        )
+        cart = Cart.objects.create(cart_id='benchmark-serializers')
+        CartItem.objects.bulk_create(
+            CartItem(cart=cart, product=product, quantity=2)
+            for product in products[:options['cart_items']]
+        )
+
+        request = APIRequestFactory().get('/api/products/', SERVER_NAME='localhost')
+        context = {'request': request}
+        product_rows = Product.objects.values(*ProductSerializer.Meta.fields)
+        product_objects = Product.objects.all()
+
+        cases = [
+            ('products: ProductSerializer + JSONRenderer', lambda: JSONRenderer().render(
+                ProductSerializer(list(product_objects), many=True, context=context).data)),
+            ('products: compiled values + ORJSONRenderer', lambda: ORJSONRenderer().render(
+                ProductValuesSerializer(context=context).render_many(list(product_rows)))),
+            ('cart: CartSerializer + JSONRenderer', lambda: JSONRenderer().render(
+                CartSerializer(Cart.objects.get(pk=cart.pk), context=context).data)),
+            ('cart: compiled values + ORJSONRenderer', lambda: ORJSONRenderer().render(
+                CartValuesSerializer(context=context).render(Cart.objects.get(pk=cart.pk)))),
+        ]
+
+        self.stdout.write(
+            f"{options['products']} products, {options['cart_items']} cart items, "
+            f"{options['iterations']} iterations"
+        )
+        for name, case in cases:
+            case()  # warm up
+            timings = []
+            for _ in range(options['iterations']):
+                start = time.perf_counter()
+                case()
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            median = timings[len(timings) // 2]
+            self.stdout.write(f"{name:<48} median {median * 1000:8.2f} ms  ({1 / median:8.1f} renders/s)")
@@ -0,0 +1,97 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.benchmarks import (
+    BenchmarkError, Dataset, Fixtures, compare, load_baseline, measure, parse_size, save_baseline, scenarios,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the hot paths (cart/order serializers, cart add_item and checkout, "
+        "the Stripe webhook, the admin dashboard and changelists) and count their "
+        "queries at growing dataset sizes. --save writes the results as a baseline; "
+        "--compare fails when a path got slower than the tolerance or runs more "
+        "queries. Everything runs inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1k',
+                            help='Comma separated dataset sizes (customers/orders), e.g. 1k,100k,1m.')
+        parser.add_argument('--iterations', type=int, default=10, help='Timed runs per scenario.')
+        parser.add_argument('--only', default='', help='Comma separated scenario names to run.')
+        parser.add_argument('--save', metavar='PATH', help='Write the results to this baseline file.')
+        parser.add_argument('--compare', metavar='PATH', help='Compare the results against this baseline file.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed slowdown as a fraction of the baseline median.')
+        parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                            help='Ignore slowdowns smaller than this, which are mostly noise.')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = sorted({parse_size(size) for size in options['sizes'].split(',') if size.strip()})
+        except ValueError:
+            raise CommandError(f"Invalid --sizes {options['sizes']!r}.")
+        baseline = None
+        if options['compare']:
+            try:
+                baseline = load_baseline(options['compare'])
+            except BenchmarkError as e:
+                raise CommandError(str(e))
+
+        with transaction.atomic():
+            try:
+                results = self.run(sizes, options)
+            except BenchmarkError as e:
+                raise CommandError(f"Scenario failed: {e}")
+            finally:
+                transaction.set_rollback(True)
+
+        if options['save']:
+            save_baseline(options['save'], results, options['iterations'])
+            self.stdout.write(f"Saved baseline to {options['save']}")
+
+        if baseline is not None:
+            self.report(results, baseline, options)
+
+    def run(self, sizes, options):
+        only = {name.strip() for name in options['only'].split(',') if name.strip()}
+        dataset = Dataset()
+        fixtures = cases = None
+        results = {}
+        for size in sizes:
+            self.stdout.write(f"Seeding {size} customers and orders...")
+            dataset.grow(size)
+            if fixtures is None:
+                fixtures = Fixtures()
+                cases = [case for case in scenarios(fixtures) if not only or case.name in only]
+                if not cases:
+                    raise CommandError(f"No scenarios match --only {options['only']!r}.")
+            results[str(size)] = {}
+            for case in cases:
+                result = measure(case, options['iterations'])
+                results[str(size)][case.name] = result
+                self.stdout.write(
+                    f"{size:>9} {case.name:<28} median {result['median_ms']:9.2f} ms  "
+                    f"min {result['min_ms']:9.2f} ms  {result['queries']:4d} queries"
+                )
+        return results
+
+    def report(self, results, baseline, options):
+        regressions = []
+        for size, name, current, previous, regressed in compare(
+            results, baseline, options['tolerance'], options['min_delta_ms']
+        ):
+            change = (current['median_ms'] / previous['median_ms'] - 1) * 100 if previous['median_ms'] else 0
+            line = (
+                f"{size:>9} {name:<28} {previous['median_ms']:9.2f} -> {current['median_ms']:9.2f} ms "
+                f"({change:+6.1f}%)  queries {previous['queries']} -> {current['queries']}"
+            )
+            if regressed:
+                regressions.append(line)
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError(f"{len(regressions)} benchmark(s) regressed against {options['compare']}.")
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {options['compare']}."))
@@ -0,0 +1,74 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import Address
+from api.sql_tags import tag_job
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill in Address.fingerprint for rows created before it existed, folding "
+        "addresses a customer has more than once (differing only in case or "
+        "whitespace) into one. Runs in small batches, each in its own transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Addresses per transaction.')
+        parser.add_argument('--sleep', type=float, default=0.0, help='Seconds to pause between batches.')
+        parser.add_argument('--dry-run', action='store_true', help='Report duplicates without changing anything.')
+
+    @tag_job('fingerprint_addresses')
+    def handle(self, *args, **options):
+        fingerprinted = merged = 0
+        last_pk = 0
+        # (customer, fingerprint) pairs claimed in earlier batches; a dry run
+        # rolls those back, so the database alone can't tell us.
+        self.claimed = {}
+        while True:
+            batch = list(
+                Address.objects.filter(fingerprint__isnull=True, pk__gt=last_pk)
+                .order_by('pk')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            with transaction.atomic():
+                batch_fingerprinted, batch_merged = self.process_batch(batch, options['dry_run'])
+                if options['dry_run']:
+                    transaction.set_rollback(True)
+            fingerprinted += batch_fingerprinted
+            merged += batch_merged
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        if options['dry_run']:
+            summary = f"Dry run: would fingerprint {fingerprinted} addresses and merge {merged} duplicates."
+        else:
+            summary = f"Fingerprinted {fingerprinted} addresses and merged {merged} duplicates."
+        self.stdout.write(self.style.SUCCESS(summary))
+
+    def process_batch(self, batch, dry_run):
+        keys = {address.pk: (address.customer_id, address.compute_fingerprint()) for address in batch}
+        owners = {key: self.claimed[key] for key in keys.values() if key in self.claimed}
+        existing = Address.objects.select_for_update().filter(
+            customer_id__in={customer_id for customer_id, _ in keys.values()},
+            fingerprint__in={fingerprint for _, fingerprint in keys.values()},
+        )
+        owners.update(((address.customer_id, address.fingerprint), address) for address in existing)
+
+        fingerprinted = merged = 0
+        for address in batch:
+            key = keys[address.pk]
+            survivor = owners.get(key)
+            if survivor is None:
+                address.save(update_fields=['fingerprint'])
+                owners[key] = self.claimed[key] = address
+                fingerprinted += 1
+                continue
+            if dry_run:
+                self.stdout.write(f"Address {address.pk} ({address}) -> {survivor.pk}")
+            address.merge_into(survivor)
+            merged += 1
+        return fingerprinted, merged
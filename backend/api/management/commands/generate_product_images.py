@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from api.images import generate_variants
+from api.models import Product
+from api.sql_tags import tag_job
+
+
+class Command(BaseCommand):
+    help = "Generate thumbnails and WebP/AVIF variants for products that don't have them yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Regenerate variants for every product with an image.')
+
+    @tag_job('generate_product_images')
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True)
+        generated = 0
+        for product in products.iterator():
+            if not options['all'] and (product.image_variants or {}).get('source') == product.image.name:
+                continue
+            try:
+                generate_variants(product.pk, product.image.name)
+            except Exception as e:
+                self.stderr.write(f"Product {product.pk}: {e}")
+                continue
+            generated += 1
+        self.stdout.write(self.style.SUCCESS(f"Generated image variants for {generated} products."))
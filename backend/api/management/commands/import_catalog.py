@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.catalog import CatalogImportError, catalog_format, import_catalog, read_catalog_rows
+from api.sql_tags import tag_job
+
+
+class Command(BaseCommand):
+    help = (
+        "Import a product catalog from CSV or JSONL, keyed by sku. Only rows that "
+        "differ from the current catalog are written, in a single transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path to a .csv or .jsonl catalog file.')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Override the format guessed from the file name.')
+        parser.add_argument('--dry-run', action='store_true', help='Report the changes without writing them.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--show-changes', action='store_true', help='List every created and updated sku.')
+
+    @tag_job('import_catalog')
+    def handle(self, *args, **options):
+        try:
+            fmt = options['format'] or catalog_format(options['path'])
+            with open(options['path'], encoding='utf-8-sig', newline='') as catalog_file:
+                result = import_catalog(
+                    read_catalog_rows(catalog_file, fmt),
+                    dry_run=options['dry_run'],
+                    batch_size=options['batch_size'],
+                )
+        except (OSError, CatalogImportError) as e:
+            raise CommandError(str(e))
+
+        for row, message in result.errors:
+            self.stderr.write(f"Row {row}: {message}")
+        if options['show_changes']:
+            for sku in result.created:
+                self.stdout.write(f"+ {sku}")
+            for sku, changes in result.updated.items():
+                described = ', '.join(f"{name}: {old} -> {new}" for name, (old, new) in changes.items())
+                self.stdout.write(f"~ {sku}: {described}")
+
+        if result.errors:
+            raise CommandError(result.summary())
+        self.stdout.write(self.style.SUCCESS(result.summary()))
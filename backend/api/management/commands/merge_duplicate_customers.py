@@ -0,0 +1,108 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from api.models import Customer, Address, Order, Cart, normalize_email
+from api.search import index_objects
+from api.sql_tags import tag_job
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill in Customer.email_normalized for rows created before it existed, "
+        "merging customers whose emails only differ by case or whitespace. Runs "
+        "in small batches, each in its own short transaction, so checkouts are "
+        "never blocked for long."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Customers per transaction.')
+        parser.add_argument('--sleep', type=float, default=0.0, help='Seconds to pause between batches.')
+        parser.add_argument('--dry-run', action='store_true', help='Report duplicates without changing anything.')
+
+    @tag_job('merge_duplicate_customers')
+    def handle(self, *args, **options):
+        normalized = merged = 0
+        last_pk = 0
+        # Emails claimed in earlier batches; a dry run rolls those back, so
+        # the database alone can't tell us.
+        self.claimed = {}
+        while True:
+            # Keyset pagination: rows we fill in drop out of the filter, and
+            # skipping by pk keeps dry runs from reading the same batch again.
+            batch = list(
+                Customer.objects.filter(email_normalized__isnull=True, pk__gt=last_pk)
+                .order_by('pk')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            with transaction.atomic():
+                batch_normalized, batch_merged = self.process_batch(batch, options['dry_run'])
+                if options['dry_run']:
+                    transaction.set_rollback(True)
+            normalized += batch_normalized
+            merged += batch_merged
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        if options['dry_run']:
+            summary = f"Dry run: would normalize {normalized} customers and merge {merged} duplicates."
+        else:
+            summary = f"Normalized {normalized} customers and merged {merged} duplicates."
+        self.stdout.write(self.style.SUCCESS(summary))
+
+    def process_batch(self, batch, dry_run):
+        emails = {customer.pk: normalize_email(customer.email) for customer in batch}
+        # Rows that already own an address win over the ones we are filling in.
+        owners = {email: self.claimed[email] for email in emails.values() if email in self.claimed}
+        owners.update(
+            (customer.email_normalized, customer)
+            for customer in Customer.objects.select_for_update().filter(email_normalized__in=set(emails.values()))
+        )
+        normalized = merged = 0
+        for customer in batch:
+            email = emails[customer.pk]
+            survivor = owners.get(email)
+            if survivor is None:
+                customer.save(update_fields=['email_normalized'])
+                owners[email] = self.claimed[email] = customer
+                normalized += 1
+                continue
+            if dry_run:
+                self.stdout.write(f"{customer.email} -> {survivor.email}")
+            self.merge(customer, survivor)
+            merged += 1
+        return normalized, merged
+
+    def merge(self, duplicate, survivor):
+        """
+        Move everything that points at `duplicate` over to `survivor` and
+        delete it.
+        """
+        # An address the survivor already has is folded into theirs instead
+        # of moved, which would break the (customer, fingerprint) constraint.
+        survivor_addresses = {address.fingerprint: address for address in survivor.addresses.exclude(fingerprint=None)}
+        address_pks = []
+        for address in duplicate.addresses.all():
+            if address.fingerprint in survivor_addresses:
+                address.merge_into(survivor_addresses[address.fingerprint])
+            else:
+                address_pks.append(address.pk)
+        order_pks = list(duplicate.orders.values_list('pk', flat=True))
+        Address.objects.filter(pk__in=address_pks).update(customer=survivor)
+        Order.objects.filter(pk__in=order_pks).update(customer=survivor, updated_at=timezone.now())
+        Cart.objects.filter(customer=duplicate).update(customer=survivor)
+
+        fill = [name for name in ('name', 'device') if not getattr(survivor, name) and getattr(duplicate, name)]
+        for name in fill:
+            setattr(survivor, name, getattr(duplicate, name))
+        if fill:
+            survivor.save(update_fields=fill)
+        duplicate.delete()
+
+        # update() skips the signals that keep the admin search index current.
+        index_objects(Address, address_pks)
+        index_objects(Order, order_pks)
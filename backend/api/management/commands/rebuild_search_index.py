@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from api.search import rebuild_search_index, search_index_ready
+from api.sql_tags import tag_job
+
+
+class Command(BaseCommand):
+    help = "Rebuild the SQLite FTS5 index behind admin search for customers, addresses and orders."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database to rebuild the index on.')
+
+    @tag_job('rebuild_search_index')
+    def handle(self, *args, **options):
+        using = options['database']
+        if not search_index_ready(using):
+            raise CommandError(
+                "No search index on this database. It only exists on SQLite builds with "
+                "FTS5 trigram support; PostgreSQL uses pg_trgm indexes that need no rebuild."
+            )
+        with transaction.atomic(using=using):
+            counts = rebuild_search_index(using)
+        for label, count in counts.items():
+            self.stdout.write(f"{label}: {count} documents")
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt."))
@@ -0,0 +1,69 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.stripe_emulator import EmulatorConfig, StripeEmulator
+
+
+def milliseconds(value):
+    """
+    "40" or "20-200" -> (min, max) milliseconds.
+    """
+    low, _, high = value.partition('-')
+    try:
+        low, high = float(low), float(high or low)
+    except ValueError:
+        raise CommandError(f"Expected milliseconds like 40 or 20-200, got {value!r}.")
+    return low, max(low, high)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in for the Stripe PaymentIntent and Checkout Session "
+        "endpoints, delivering signed webhooks back to this project. Start Django "
+        "with STRIPE_API_BASE=http://<host>:<port> to use it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--webhook-url', default='http://127.0.0.1:8000/webhook/stripe/',
+                            help='Where to send webhook events.')
+        parser.add_argument('--webhook-secret', default=settings.STRIPE_WEBHOOK_SECRET,
+                            help='Signing secret; defaults to STRIPE_WEBHOOK_SECRET.')
+        parser.add_argument('--latency-ms', default='0', help='Added to every API call, e.g. 40 or 20-200.')
+        parser.add_argument('--webhook-delay-ms', default='0', help='Wait before each webhook delivery.')
+        parser.add_argument('--api-failure-rate', type=float, default=0.0,
+                            help='Share of API calls that fail with a 500 api_error.')
+        parser.add_argument('--decline-rate', type=float, default=0.0, help='Share of payments declined.')
+        parser.add_argument('--webhook-failure-rate', type=float, default=0.0,
+                            help='Share of webhook delivery attempts dropped before sending.')
+        parser.add_argument('--webhook-retries', type=int, default=3)
+
+    def handle(self, *args, **options):
+        for name in ('api_failure_rate', 'decline_rate', 'webhook_failure_rate'):
+            if not 0 <= options[name] <= 1:
+                raise CommandError(f"--{name.replace('_', '-')} must be between 0 and 1.")
+        config = EmulatorConfig(
+            webhook_url=options['webhook_url'],
+            webhook_secret=options['webhook_secret'],
+            latency_ms=milliseconds(options['latency_ms']),
+            webhook_delay_ms=milliseconds(options['webhook_delay_ms']),
+            api_failure_rate=options['api_failure_rate'],
+            decline_rate=options['decline_rate'],
+            webhook_failure_rate=options['webhook_failure_rate'],
+            webhook_retries=options['webhook_retries'],
+            verbose=options['verbosity'] > 1,
+        )
+        emulator = StripeEmulator(options['host'], options['port'], config, log=self.stdout.write).start()
+        self.stdout.write(self.style.SUCCESS(f"Stripe emulator listening on {emulator.base_url}"))
+        self.stdout.write(f"Webhooks go to {config.webhook_url}. Run Django with:")
+        self.stdout.write(f"    STRIPE_API_BASE={emulator.base_url} STRIPE_SECRET_KEY=sk_test_emulator")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            emulator.stop()
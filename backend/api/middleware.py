@@ -1,6 +1,24 @@
+import hashlib
 import uuid
 from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.core.exceptions import MiddlewareNotUsed
 from django.http import JsonResponse
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+from .profiling import profile_request, requested_mode
+from .query_budget import QueryShapeRecorder, logger as query_logger
+from .slow_queries import SlowQueryRecorder, route_pattern
+from .sql_tags import sql_tags, view_tags
+from . import tracing
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
 
 class DeviceIDMiddleware:
     """
@@ -73,4 +91,261 @@ class APIMiddleware:
             return response
         
         # Not an API request, process normally
-        return self.get_response(request) 
\ No newline at end of file
+        return self.get_response(request) 
+
+
+class APICompressionMiddleware:
+    """
+    Middleware to compress API responses with brotli or gzip.
+    Only responses above API_COMPRESSION_MIN_SIZE are compressed. The
+    compressed bytes of shared GET responses are cached by content digest,
+    so a hot response that is served again unchanged (e.g. from a cache) is
+    never compressed twice. Only paths in API_COMPRESSION_CACHE_PATHS are
+    cached: per-visitor responses such as the cart or bootstrap would fill
+    the cache with one entry per visitor, and every API response varies on
+    the session cookie, so Vary can't tell them apart.
+
+    Per-visitor responses carry the cart id and echo request input next to
+    each other, which is what BREACH needs. Like Django's GZipMiddleware,
+    they are gzipped with a random-length filename in the header; brotli
+    has no room for that padding, so they never get brotli.
+    """
+    max_random_bytes = 100
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_size = getattr(settings, 'API_COMPRESSION_MIN_SIZE', 1024)
+        self.brotli_quality = getattr(settings, 'API_COMPRESSION_BROTLI_QUALITY', 5)
+        self.cache_timeout = getattr(settings, 'API_COMPRESSION_CACHE_TIMEOUT', 300)
+        self.cache = caches[getattr(settings, 'API_COMPRESSION_CACHE', 'default')]
+        self.cache_paths = tuple(getattr(settings, 'API_COMPRESSION_CACHE_PATHS', ('/api/products/',)))
+    
+    def __call__(self, request):
+        response = self.get_response(request)
+        
+        if not request.path.startswith('/api/'):
+            return response
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if len(response.content) < self.min_size:
+            return response
+        
+        patch_vary_headers(response, ('Accept-Encoding',))
+        shared = request.method == 'GET' and self.is_shared(request, response)
+        encoding = self.choose_encoding(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''),
+            self.supported_encodings() if shared else ['gzip'],
+        )
+        if encoding is None:
+            return response
+        
+        if shared:
+            compressed = self.get_cached_compressed(response.content, encoding)
+        else:
+            compressed = compress_string(response.content, max_random_bytes=self.max_random_bytes)
+        
+        # Return the original response if compression doesn't pay off
+        if len(compressed) >= len(response.content):
+            return response
+        
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        # The body is no longer byte-identical, so a strong ETag must be weakened.
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
+    
+    @staticmethod
+    def supported_encodings():
+        return ['br', 'gzip'] if brotli is not None else ['gzip']
+    
+    @staticmethod
+    def choose_encoding(accept_encoding, candidates):
+        """
+        Pick the candidate encoding the client gives the highest q-value,
+        preferring the earlier candidate on a tie.
+        """
+        accepted = {}
+        for part in accept_encoding.split(','):
+            coding, _, params = part.strip().partition(';')
+            quality = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[coding.strip().lower()] = quality
+        
+        best, best_quality = None, 0
+        for coding in candidates:
+            quality = accepted.get(coding, accepted.get('*', 0))
+            if quality > best_quality:
+                best, best_quality = coding, quality
+        return best
+    
+    def is_shared(self, request, response):
+        """
+        Whether the body is one that many visitors get: an allow-listed
+        path, with no cookie being set and no private Cache-Control.
+        """
+        if not request.path.startswith(self.cache_paths) or response.cookies:
+            return False
+        cache_control = response.get('Cache-Control', '').lower()
+        return 'private' not in cache_control and 'no-store' not in cache_control
+    
+    def compress(self, content, encoding):
+        if encoding == 'br':
+            return brotli.compress(content, quality=self.brotli_quality)
+        return compress_string(content)
+    
+    def get_cached_compressed(self, content, encoding):
+        digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+        cache_key = f'api-compressed:{encoding}:{digest}'
+        compressed = self.cache.get(cache_key)
+        if compressed is None:
+            compressed = self.compress(content, encoding)
+            self.cache.set(cache_key, compressed, self.cache_timeout)
+        return compressed
+
+
+class NPlusOneDetectionMiddleware:
+    """
+    Development aid: warn when one query shape (the SQL with its literals
+    normalized away) runs more than NPLUSONE_THRESHOLD times in a request,
+    which is what an N+1 looks like. The warning names the call site of the
+    first repeat. Enabled by NPLUSONE_DETECTION, which is off by default.
+    """
+    
+    def __init__(self, get_response):
+        if not getattr(settings, 'NPLUSONE_DETECTION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'NPLUSONE_THRESHOLD', 5)
+    
+    def __call__(self, request):
+        with QueryShapeRecorder(track_shapes=True, threshold=self.threshold) as recorder:
+            response = self.get_response(request)
+        for shape, count, stack in recorder.repeated(self.threshold):
+            query_logger.warning(
+                "Possible N+1 on %s %s: %d queries of the same shape:\n    %s\nFirst repeated at:\n%s",
+                request.method, request.path, count, shape[:500], stack,
+            )
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profile a single request when a staff user asks for it with an
+    `X-Profile: cprofile|sample` header or a `?_profile=` query flag (see
+    api.profiling). The response carries the id of the stored profile and a
+    link to it in the admin. Must come after AuthenticationMiddleware.
+    """
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        mode = requested_mode(request)
+        user = getattr(request, 'user', None)
+        if mode is None or user is None or not (user.is_active and user.is_staff):
+            return self.get_response(request)
+        
+        response, profile = profile_request(request, self.get_response, mode)
+        if profile is None:
+            response['X-Profile'] = 'busy'
+        else:
+            response['X-Profile-Id'] = profile.id
+            response['X-Profile-URL'] = reverse('admin:profile', args=[profile.id])
+        return response
+
+
+class SlowQueryMiddleware:
+    """
+    Record queries slower than SLOW_QUERY_THRESHOLD_MS in the slow query log
+    (see api.slow_queries), attributed to the request's URL pattern.
+    """
+    
+    def __init__(self, get_response):
+        if not getattr(settings, 'SLOW_QUERY_LOG', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        recorder = SlowQueryRecorder(request)
+        wrappers = [connection.execute_wrapper(recorder) for connection in connections.all()]
+        for wrapper in wrappers:
+            wrapper.__enter__()
+        try:
+            return self.get_response(request)
+        finally:
+            for wrapper in reversed(wrappers):
+                wrapper.__exit__(None, None, None)
+
+
+class SQLCommentMiddleware:
+    """
+    Tag every query a request runs with the view, action and URL pattern
+    handling it (see api.sql_tags). Queries run before the URL is resolved
+    are left untagged rather than tagged with the raw path, which would put
+    cart ids and UUIDs into the statement text.
+    """
+    
+    def __init__(self, get_response):
+        if not getattr(settings, 'SQL_COMMENTS', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        with sql_tags() as tags:
+            request.sql_tags = tags
+            return self.get_response(request)
+    
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        tags = getattr(request, 'sql_tags', None)
+        if tags is not None:
+            tags.update(**view_tags(request, view_func))
+
+
+class TracingMiddleware:
+    """
+    Trace each request (see api.tracing): a server span for the request and
+    a client span for every query it runs. The trace continues an incoming
+    `traceparent`. The request id comes from `X-Request-ID` or is made up;
+    it is set as request.request_id and both are echoed on the response.
+    Enabled by TRACING_EXPORTER.
+    """
+    
+    def __init__(self, get_response):
+        if not tracing.enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        request.request_id = tracing.clean_request_id(request.headers.get('X-Request-ID'))
+        with tracing.start_trace(
+            f'{request.method} {request.path}',
+            traceparent=request.headers.get('traceparent'),
+            request_id=request.request_id,
+            **{'http.request.method': request.method, 'url.path': request.path},
+        ) as span:
+            wrappers = [connection.execute_wrapper(tracing.query_span) for connection in connections.all()]
+            for wrapper in wrappers:
+                wrapper.__enter__()
+            try:
+                response = self.get_response(request)
+            finally:
+                for wrapper in reversed(wrappers):
+                    wrapper.__exit__(None, None, None)
+            # Name the span after the URL pattern so traces group by endpoint.
+            route = route_pattern(request)
+            span.name = f'{request.method} {route}'
+            span.set_attribute('http.route', route)
+            span.set_attribute('http.response.status_code', response.status_code)
+            if response.status_code >= 500:
+                span.set_status(tracing.STATUS_ERROR)
+        response['X-Request-ID'] = request.request_id
+        response['traceparent'] = span.traceparent
+        return response
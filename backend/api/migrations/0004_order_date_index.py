@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_product_sku'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['order_date'], name='api_order_order_d_f254aa_idx'),
+        ),
+    ]
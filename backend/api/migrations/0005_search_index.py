@@ -0,0 +1,89 @@
+from django.db import migrations, transaction, DatabaseError
+
+
+SQLITE_TABLES = [
+    "CREATE TABLE api_searchkey ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT NOT NULL, object_pk NOT NULL)",
+    "CREATE UNIQUE INDEX api_searchkey_model_object_pk ON api_searchkey (model, object_pk)",
+    "CREATE VIRTUAL TABLE api_searchdoc USING fts5(body, tokenize='trigram')",
+]
+
+# Backfill; the documents must match api.search.SEARCH_DOCUMENTS.
+SQLITE_BACKFILL = [
+    "INSERT INTO api_searchkey (model, object_pk) SELECT 'api.customer', id FROM api_customer",
+    "INSERT INTO api_searchkey (model, object_pk) SELECT 'api.address', id FROM api_address",
+    "INSERT INTO api_searchkey (model, object_pk) SELECT 'api.order', id FROM api_order",
+    "INSERT INTO api_searchdoc (rowid, body) "
+    "SELECT k.id, c.email || char(10) || coalesce(c.name, '') || char(10) || coalesce(c.device, '') "
+    "FROM api_searchkey k JOIN api_customer c ON k.model = 'api.customer' AND k.object_pk = c.id",
+    "INSERT INTO api_searchdoc (rowid, body) "
+    "SELECT k.id, a.street_address || char(10) || a.city || char(10) || coalesce(c.email, '') "
+    "FROM api_searchkey k JOIN api_address a ON k.model = 'api.address' AND k.object_pk = a.id "
+    "LEFT JOIN api_customer c ON c.id = a.customer_id",
+    "INSERT INTO api_searchdoc (rowid, body) "
+    "SELECT k.id, c.email || char(10) || coalesce(c.name, '') "
+    "FROM api_searchkey k JOIN api_order o ON k.model = 'api.order' AND k.object_pk = o.id "
+    "JOIN api_customer c ON c.id = o.customer_id",
+]
+
+# icontains compiles to UPPER("column"::text) LIKE UPPER(%s) on PostgreSQL,
+# so the trigram indexes have to be on that exact expression.
+POSTGRES_TRIGRAM_INDEXES = [
+    ('api_customer_email_trgm', 'api_customer', 'email'),
+    ('api_customer_name_trgm', 'api_customer', 'name'),
+    ('api_customer_device_trgm', 'api_customer', 'device'),
+    ('api_address_street_trgm', 'api_address', 'street_address'),
+    ('api_address_city_trgm', 'api_address', 'city'),
+]
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute(SQLITE_TABLES[-1].replace('api_searchdoc', 'api_searchdoc_probe'))
+            except DatabaseError:
+                # SQLite without FTS5 or the trigram tokenizer (< 3.34):
+                # admin search keeps using icontains.
+                return
+            cursor.execute('DROP TABLE api_searchdoc_probe')
+            for sql in SQLITE_TABLES + SQLITE_BACKFILL:
+                cursor.execute(sql)
+    elif connection.vendor == 'postgresql':
+        try:
+            with transaction.atomic(using=connection.alias):
+                with connection.cursor() as cursor:
+                    cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except DatabaseError:
+            # Needs a role allowed to create extensions; without it the
+            # searches still work, just without index support.
+            return
+        with connection.cursor() as cursor:
+            for name, table, column in POSTGRES_TRIGRAM_INDEXES:
+                cursor.execute(
+                    f'CREATE INDEX IF NOT EXISTS {name} ON {table} '
+                    f'USING gin ((UPPER({column}::text)) gin_trgm_ops)'
+                )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('DROP TABLE IF EXISTS api_searchdoc')
+            cursor.execute('DROP TABLE IF EXISTS api_searchkey')
+        elif connection.vendor == 'postgresql':
+            for name, _, _ in POSTGRES_TRIGRAM_INDEXES:
+                cursor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_order_date_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='email_normalized',
+            field=models.EmailField(blank=True, editable=False, max_length=254, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_customer_email_normalized'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='address',
+            constraint=models.UniqueConstraint(fields=('customer', 'fingerprint'), name='api_address_customer_fingerprint_uniq'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_address_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_checkout_session_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_payment_intent_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='stripe_checkout_session_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='stripe_payment_intent_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_stripe_references'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_checkout_session_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_checkout_session_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_checkout_session_url',
+            field=models.URLField(blank=True, max_length=2048, null=True),
+        ),
+    ]
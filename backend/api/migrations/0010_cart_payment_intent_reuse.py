@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_cart_checkout_session_reuse'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_payment_intent_amount',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='stripe_payment_intent_client_secret',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
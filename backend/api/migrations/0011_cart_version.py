@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_cart_payment_intent_reuse'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_cart_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', '-order_date'], name='api_order_custome_7dc25f_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:31
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def fill_cart_counters(apps, schema_editor):
+    Cart = apps.get_model('api', 'Cart')
+    CartItem = apps.get_model('api', 'CartItem')
+    money = models.DecimalField(max_digits=12, decimal_places=2)
+    items = CartItem.objects.filter(cart=models.OuterRef('pk')).order_by().values('cart')
+    Cart.objects.update(
+        item_count=Coalesce(models.Subquery(items.annotate(total=models.Sum('quantity')).values('total')), 0),
+        subtotal=Coalesce(models.Subquery(items.annotate(total=models.Sum(
+            models.F('quantity') * models.F('product__price'), output_field=money,
+        )).values('total')), models.Value(0), output_field=money),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_order_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(fill_cart_counters, migrations.RunPython.noop),
+    ]
@@ -1,21 +1,70 @@
-from django.db import models
+from django.db import models, IntegrityError
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+import hashlib
 import uuid
 import json
 
 
+def normalize_email(email):
+    """
+    The form customer emails are matched on: surrounding whitespace dropped
+    and lowercased, so "Jane@Example.com " and "jane@example.com" are one
+    customer.
+    """
+    if not email:
+        return None
+    return email.strip().lower()
+
+
+class CustomerQuerySet(models.QuerySet):
+    def by_email(self, email):
+        return self.filter(email_normalized=normalize_email(email))
+    
+    def upsert_by_email(self, email, defaults=None):
+        """
+        Get or create the customer for `email`, ignoring case. Safe under
+        concurrent checkouts: the unique index on email_normalized decides
+        the race and the loser re-reads the winner's row.
+        """
+        email = email.strip()
+        try:
+            return self.get_or_create(
+                email_normalized=normalize_email(email),
+                defaults={'email': email, **(defaults or {})},
+            )
+        except IntegrityError:
+            # A row from before email_normalized existed holds this exact
+            # address (merge_duplicate_customers hasn't reached it yet).
+            customer = self.get(email=email)
+            customer.save(update_fields=['email_normalized'])
+            return customer, False
+
+
 class Customer(models.Model):
     """
     Model representing a customer who places orders.
     No registration required, just email tracking.
     """
     email = models.EmailField(unique=True)
+    email_normalized = models.EmailField(unique=True, null=True, blank=True, editable=False)  # Set by save()
     name = models.CharField(max_length=200, null=True, blank=True)
     device = models.CharField(max_length=200, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = CustomerQuerySet.as_manager()
+    
     def __str__(self):
         return self.email if self.email else f"Anonymous ({self.device})"
+    
+    def save(self, *args, **kwargs):
+        self.email_normalized = normalize_email(self.email)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'email' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'email_normalized'}
+        super().save(*args, **kwargs)
 
 
 class Product(models.Model):
@@ -23,9 +72,11 @@ class Product(models.Model):
     Model representing a product in the store.
     """
     name = models.CharField(max_length=200)
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)  # Catalog import key
     price = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to='products/', null=True, blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)  # Filled in by api.images
     stock = models.IntegerField(default=0)
     active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -38,6 +89,35 @@ class Product(models.Model):
         ordering = ['name']
 
 
+ADDRESS_FIELDS = ('street_address', 'apartment_address', 'city', 'state', 'country', 'postal_code')
+
+
+def address_fingerprint(street_address='', apartment_address='', city='', state='', country='', postal_code=''):
+    """
+    Hash of the canonicalized address fields: whitespace collapsed, case
+    folded, None treated as blank and spaces dropped from the postal code,
+    so "12  Baker St" / "SW1A 1AA" matches "12 baker st" / "sw1a1aa".
+    """
+    parts = [' '.join(str(value or '').split()).casefold() for value in (
+        street_address, apartment_address, city, state, country, postal_code
+    )]
+    parts[-1] = parts[-1].replace(' ', '')
+    return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()
+
+
+class AddressQuerySet(models.QuerySet):
+    def upsert(self, customer, defaults=None, **fields):
+        """
+        Get or create `customer`'s address with these ADDRESS_FIELDS, with
+        a single probe of the (customer, fingerprint) unique index.
+        """
+        return self.get_or_create(
+            customer=customer,
+            fingerprint=address_fingerprint(**fields),
+            defaults={**fields, **(defaults or {})},
+        )
+
+
 class Address(models.Model):
     """
     Model representing a shipping address.
@@ -49,14 +129,64 @@ class Address(models.Model):
     state = models.CharField(max_length=100)
     country = models.CharField(max_length=100)
     postal_code = models.CharField(max_length=20)
+    fingerprint = models.CharField(max_length=64, null=True, blank=True, editable=False)  # Set by save()
     default = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = AddressQuerySet.as_manager()
+    
     def __str__(self):
         return f"{self.street_address}, {self.city}, {self.country}"
     
+    def compute_fingerprint(self):
+        return address_fingerprint(**{name: getattr(self, name) for name in ADDRESS_FIELDS})
+    
+    def clean(self):
+        # The unique constraint involves a non-editable field, so forms
+        # don't validate it themselves.
+        if self.customer_id is None:
+            return
+        duplicate = Address.objects.filter(
+            customer_id=self.customer_id, fingerprint=self.compute_fingerprint()
+        ).exclude(pk=self.pk)
+        if duplicate.exists():
+            raise ValidationError("This customer already has this address.")
+    
+    def save(self, *args, **kwargs):
+        self.fingerprint = self.compute_fingerprint()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(update_fields) & set(ADDRESS_FIELDS):
+            kwargs['update_fields'] = {*update_fields, 'fingerprint'}
+        super().save(*args, **kwargs)
+    
+    def merge_into(self, survivor):
+        """
+        Point the orders shipped to this address at `survivor`, an
+        equivalent address, and delete this one.
+        """
+        Order.objects.filter(shipping_address=self).update(shipping_address=survivor, updated_at=timezone.now())
+        if self.default and not survivor.default:
+            survivor.default = True
+            survivor.save(update_fields=['default'])
+        self.delete()
+    
     class Meta:
         verbose_name_plural = 'Addresses'
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'fingerprint'], name='api_address_customer_fingerprint_uniq'),
+        ]
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_related(self):
+        """
+        Load everything OrderSerializer renders (customer and their addresses,
+        shipping address, items and their products) in a fixed number of queries.
+        """
+        return self.select_related('customer', 'shipping_address').prefetch_related(
+            models.Prefetch('items', queryset=OrderItem.objects.select_related('product')),
+            models.Prefetch('customer__addresses', queryset=Address.objects.all()),
+        )
 
 
 class Order(models.Model):
@@ -78,12 +208,23 @@ class Order(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     notes = models.TextField(null=True, blank=True)
+    stripe_payment_intent_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    stripe_checkout_session_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    # Versions the cached snapshot (see api.order_cache). queryset.update() skips
+    # auto_now, so bulk updates must set it themselves.
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = OrderQuerySet.as_manager()
     
     def __str__(self):
         return f"Order {self.id}"
     
     class Meta:
         ordering = ['-order_date']
+        indexes = [
+            models.Index(fields=['order_date']),
+            models.Index(fields=['customer', '-order_date']),  # a customer's order history
+        ]
 
 
 class OrderItem(models.Model):
@@ -103,25 +244,83 @@ class OrderItem(models.Model):
         return self.price * self.quantity
 
 
+class CartQuerySet(models.QuerySet):
+    def mark_changed(self):
+        """
+        Bump the carts' versions and recompute their item_count and subtotal
+        from their items, in one UPDATE.
+        """
+        money = models.DecimalField(max_digits=12, decimal_places=2)
+        items = CartItem.objects.filter(cart=models.OuterRef('pk')).order_by().values('cart')
+        item_count = items.annotate(total=models.Sum('quantity')).values('total')
+        subtotal = items.annotate(total=models.Sum(
+            models.F('quantity') * models.F('product__price'), output_field=money,
+        )).values('total')
+        return self.update(
+            version=models.F('version') + 1,
+            updated_at=timezone.now(),
+            item_count=Coalesce(models.Subquery(item_count), 0),
+            subtotal=Coalesce(models.Subquery(subtotal), models.Value(0), output_field=money),
+        )
+
+
 class Cart(models.Model):
     """
     Model representing a shopping cart stored in cookies.
     """
     cart_id = models.CharField(max_length=100, unique=True)  # Will store session or device ID
     customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True, related_name='carts')
+    # Stripe objects created for this cart, handed over to the order at checkout
+    stripe_payment_intent_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    stripe_payment_intent_client_secret = models.CharField(max_length=255, null=True, blank=True)
+    stripe_payment_intent_amount = models.PositiveIntegerField(null=True, blank=True)  # In cents
+    stripe_checkout_session_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    stripe_checkout_session_url = models.URLField(max_length=2048, null=True, blank=True)
+    stripe_checkout_session_hash = models.CharField(max_length=64, null=True, blank=True)  # See api.payments
+    stripe_checkout_session_expires_at = models.DateTimeField(null=True, blank=True)
+    version = models.PositiveIntegerField(default=0)  # Bumped by mark_changed(); keys the pricing quote
+    # Denormalized by mark_changed() for the header badge (cart/summary)
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = CartQuerySet.as_manager()
+    
     def __str__(self):
         return self.cart_id
     
+    def mark_changed(self):
+        """
+        Record a change to the cart's items. Call it after the change, in the
+        same transaction, so a quote cached under the new version can't have
+        seen the old items and item_count/subtotal match them.
+        """
+        Cart.objects.filter(pk=self.pk).mark_changed()
+        self.refresh_from_db(fields=['version', 'updated_at', 'item_count', 'subtotal'])
+    
+    def prefetch_items(self):
+        """
+        Load the items and their products, which CartSerializer renders, in
+        one query instead of one per item.
+        """
+        models.prefetch_related_objects(
+            [self], models.Prefetch('items', queryset=CartItem.objects.select_related('product'))
+        )
+        return self
+    
+    @property
+    def quote(self):
+        from .pricing import quote_cart
+        return quote_cart(self)
+    
     @property
     def total_items(self):
-        return sum(item.quantity for item in self.items.all())
+        return self.quote.total_items
     
     @property
     def total_price(self):
-        return sum(item.total_price for item in self.items.all())
+        return self.quote.total_price
 
 
 class CartItem(models.Model):
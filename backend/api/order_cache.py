@@ -0,0 +1,65 @@
+"""
+Order snapshot cache.
+
+Delivered and cancelled orders are final, so their OrderSerializer output is
+cached as a snapshot keyed by (order id, Order.updated_at). Any change to the
+order row moves updated_at: save() sets it, and bulk updates such as the
+admin's mark_as_* actions set it explicitly. The receivers in api.signals
+move it for item edits and for the SET_NULL of a deleted customer or address. A changed order therefore
+misses the old snapshot instead of needing it deleted. The snapshot is of
+the order; later edits to its customer or products don't refresh it.
+Media URLs are absolute when rendered for a request, so snapshots are kept
+per site root.
+
+`render_orders()` takes the final orders' snapshots from the cache and loads
+and serializes only the rest (new, in-flight, or not cached yet), in one
+batch.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Order
+from .serializers import OrderSerializer
+
+TERMINAL_STATUSES = ('delivered', 'cancelled')
+ORDER_CACHE_TIMEOUT = getattr(settings, 'ORDER_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def _order_key(order, root=''):
+    return f'order-snapshot:{root}:{order.pk}:{order.updated_at.timestamp()}'
+
+
+def render_orders(orders, context=None):
+    """
+    OrderSerializer data for `orders`, in their order. The orders can be bare
+    rows; the ones that have to be rendered are reloaded with their related data.
+    """
+    context = context or {}
+    request = context.get('request')
+    params = getattr(request, 'query_params', {}) if request is not None else {}
+    # Sparse responses differ per request; only full representations are cached.
+    use_cache = not ('fields' in params or 'expand' in params)
+    root = request.build_absolute_uri('/') if request is not None else ''
+
+    cacheable = [order for order in orders if use_cache and order.status in TERMINAL_STATUSES]
+    cached = cache.get_many([_order_key(order, root) for order in cacheable]) if cacheable else {}
+    missing = [order.pk for order in orders if _order_key(order, root) not in cached]
+
+    rendered = {}
+    if missing:
+        fresh = list(Order.objects.with_related().filter(pk__in=missing))
+        for order, data in zip(fresh, OrderSerializer(fresh, many=True, context=context).data):
+            rendered[order.pk] = data
+        cache.set_many({
+            _order_key(order, root): rendered[order.pk]
+            for order in fresh if use_cache and order.status in TERMINAL_STATUSES
+        }, ORDER_CACHE_TIMEOUT)
+
+    results = []
+    for order in orders:
+        key = _order_key(order, root)
+        if key in cached:
+            results.append(cached[key])
+        elif order.pk in rendered:  # else deleted since the page was read
+            results.append(rendered[order.pk])
+    return results
@@ -0,0 +1,167 @@
+"""
+Stripe bookkeeping for carts.
+
+A cart keeps one PaymentIntent until an order takes it over or Stripe
+reports it finished. Asking for it again returns the stored client secret and
+only calls PaymentIntent.modify when the cart total has changed since the
+last call. The webhook calls finish_payment_intent() when the intent
+succeeds or is canceled, so a finished intent's secret isn't handed out.
+
+A Checkout Session is created once per distinct cart content. The parameters
+sent to Stripe (line items, prices, URLs, metadata) are hashed. While the
+cart's open session has the same hash and isn't about to expire, the
+existing session URL is handed out again instead of another
+stripe.checkout.Session.create round trip.
+"""
+import datetime
+import hashlib
+import json
+
+import stripe
+from django.conf import settings
+from django.utils import timezone
+
+from .tracing import stripe_call
+
+# Don't hand out a session that expires before the customer can finish paying.
+CHECKOUT_SESSION_REUSE_MARGIN = datetime.timedelta(
+    seconds=getattr(settings, 'STRIPE_CHECKOUT_SESSION_REUSE_MARGIN', 600)
+)
+
+PAYMENT_INTENT_FIELDS = [
+    'stripe_payment_intent_id', 'stripe_payment_intent_client_secret', 'stripe_payment_intent_amount',
+]
+
+CHECKOUT_SESSION_FIELDS = [
+    'stripe_checkout_session_id', 'stripe_checkout_session_url',
+    'stripe_checkout_session_hash', 'stripe_checkout_session_expires_at',
+]
+
+
+class PaymentIntentSucceeded(Exception):
+    """
+    The cart's PaymentIntent has already been paid.
+    """
+
+
+def cart_payment_intent(cart, amount, **params):
+    """
+    Client secret of the cart's PaymentIntent for `amount` cents, creating
+    the intent on first use and updating its amount when the total moved.
+    Raises PaymentIntentSucceeded once the intent has been paid.
+    """
+    if cart.stripe_payment_intent_id:
+        if not cart.stripe_payment_intent_client_secret:
+            raise PaymentIntentSucceeded(cart.stripe_payment_intent_id)
+        if cart.stripe_payment_intent_amount == amount:
+            return cart.stripe_payment_intent_client_secret
+        try:
+            with stripe_call('PaymentIntent.modify'):
+                stripe.PaymentIntent.modify(cart.stripe_payment_intent_id, amount=amount)
+        except stripe.error.InvalidRequestError as e:
+            print(f"Could not update PaymentIntent {cart.stripe_payment_intent_id}: {e}")
+            with stripe_call('PaymentIntent.retrieve'):
+                intent = stripe.PaymentIntent.retrieve(cart.stripe_payment_intent_id)
+            if intent.status == 'succeeded':
+                # Paid, but the webhook hasn't told us yet. A new intent would
+                # let the customer pay twice and orphan this payment.
+                finish_payment_intent(cart, succeeded=True)
+                raise PaymentIntentSucceeded(cart.stripe_payment_intent_id)
+            if intent.status != 'canceled':
+                raise
+            # Canceled intents can't change; start a new one.
+        else:
+            cart.stripe_payment_intent_amount = amount
+            cart.save(update_fields=['stripe_payment_intent_amount', 'updated_at'])
+            return cart.stripe_payment_intent_client_secret
+
+    with stripe_call('PaymentIntent.create'):
+        intent = stripe.PaymentIntent.create(amount=amount, **params)
+    cart.stripe_payment_intent_id = intent.id
+    cart.stripe_payment_intent_client_secret = intent.client_secret
+    cart.stripe_payment_intent_amount = amount
+    cart.save(update_fields=PAYMENT_INTENT_FIELDS + ['updated_at'])
+    return intent.client_secret
+
+
+def release_payment_intent(cart):
+    """
+    Detach the PaymentIntent from the cart once an order has taken it over.
+    Returns its id.
+    """
+    intent_id = cart.stripe_payment_intent_id
+    if intent_id:
+        for name in PAYMENT_INTENT_FIELDS:
+            setattr(cart, name, None)
+        cart.save(update_fields=PAYMENT_INTENT_FIELDS + ['updated_at'])
+    return intent_id
+
+
+def finish_payment_intent(cart, succeeded):
+    """
+    Stop handing out the client secret of the cart's PaymentIntent once
+    Stripe reports it succeeded or canceled. A canceled intent is dropped, so
+    the next request starts a new one. A succeeded one keeps its id for
+    checkout() to move onto the order the payment_intent.succeeded webhook
+    is waiting for.
+    """
+    if not succeeded:
+        return release_payment_intent(cart)
+    if cart.stripe_payment_intent_client_secret:
+        cart.stripe_payment_intent_client_secret = None
+        cart.stripe_payment_intent_amount = None
+        cart.save(update_fields=PAYMENT_INTENT_FIELDS[1:] + ['updated_at'])
+    return cart.stripe_payment_intent_id
+
+
+def params_hash(params):
+    """
+    Stable digest of a Stripe request's parameters.
+    """
+    encoded = json.dumps(params, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def reusable_checkout_session(cart, digest):
+    """
+    (session id, url) of the cart's open Checkout Session if it was created
+    for the same parameters and is still good for a while, else None.
+    """
+    if not cart.stripe_checkout_session_id or cart.stripe_checkout_session_hash != digest:
+        return None
+    expires_at = cart.stripe_checkout_session_expires_at
+    if expires_at is None or expires_at <= timezone.now() + CHECKOUT_SESSION_REUSE_MARGIN:
+        return None
+    return cart.stripe_checkout_session_id, cart.stripe_checkout_session_url
+
+
+def remember_checkout_session(cart, session, digest):
+    """
+    Record `session` as the cart's open Checkout Session, expiring the one
+    it replaces so a stale cart can't be paid for.
+    """
+    previous = cart.stripe_checkout_session_id
+    if previous and previous != session.id:
+        try:
+            with stripe_call('checkout.Session.expire'):
+                stripe.checkout.Session.expire(previous)
+        except stripe.error.StripeError as e:
+            # Already completed or expired; nothing left to clean up.
+            print(f"Could not expire Checkout Session {previous}: {e}")
+    cart.stripe_checkout_session_id = session.id
+    cart.stripe_checkout_session_url = session.url
+    cart.stripe_checkout_session_hash = digest
+    expires_at = getattr(session, 'expires_at', None)
+    cart.stripe_checkout_session_expires_at = (
+        datetime.datetime.fromtimestamp(expires_at, tz=datetime.timezone.utc) if expires_at else None
+    )
+    cart.save(update_fields=CHECKOUT_SESSION_FIELDS + ['updated_at'])
+
+
+def forget_checkout_session(cart):
+    """
+    Drop the cart's session once it has been completed.
+    """
+    for name in CHECKOUT_SESSION_FIELDS:
+        setattr(cart, name, None)
+    cart.save(update_fields=CHECKOUT_SESSION_FIELDS + ['updated_at'])
@@ -0,0 +1,148 @@
+"""
+Cart pricing.
+
+`quote_cart(cart)` prices a cart once and returns an immutable CartQuote with
+integer-cent amounts. Quotes are memoized in the cache under the cart's
+version, which Cart.mark_changed() bumps on every change to the cart's items
+and which product edits and deletes (see api.signals) bump for every cart
+holding the product, so a cached quote can't outlive the contents it priced. The serializers, the
+Stripe calls and order creation all work from the same quote.
+"""
+from dataclasses import dataclass
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Cart, CartItem, OrderItem
+
+CURRENCY = 'usd'
+QUOTE_CACHE_TIMEOUT = getattr(settings, 'CART_QUOTE_CACHE_TIMEOUT', 300)
+
+CENT = Decimal('0.01')
+
+
+def to_cents(amount):
+    """
+    Decimal currency amount -> integer cents, rounding half up.
+    """
+    return int((Decimal(amount) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    return (Decimal(cents) / 100).quantize(CENT)
+
+
+@dataclass(frozen=True)
+class QuoteLine:
+    item_id: int
+    product_id: int
+    name: str
+    quantity: int
+    unit_amount: int  # cents
+
+    @property
+    def amount(self):
+        return self.unit_amount * self.quantity
+
+    @property
+    def unit_price(self):
+        return from_cents(self.unit_amount)
+
+    @property
+    def total_price(self):
+        return from_cents(self.amount)
+
+
+@dataclass(frozen=True)
+class CartQuote:
+    cart_pk: int
+    version: int
+    lines: tuple
+    currency: str = CURRENCY
+
+    @property
+    def total_items(self):
+        return sum(line.quantity for line in self.lines)
+
+    @property
+    def total_amount(self):
+        """
+        Total in cents, the unit Stripe expects.
+        """
+        return sum(line.amount for line in self.lines)
+
+    @property
+    def total_price(self):
+        return from_cents(self.total_amount)
+
+    @property
+    def is_empty(self):
+        return not self.lines
+
+    def line_for_item(self, item_id):
+        for line in self.lines:
+            if line.item_id == item_id:
+                return line
+        return None
+
+
+def _quote_key(cart):
+    return f'cart-quote:{cart.pk}:{cart.version}'
+
+
+def build_quote(cart):
+    """
+    Price `cart` from the database with a single query.
+    """
+    rows = (
+        CartItem.objects.filter(cart=cart)
+        .order_by('pk')
+        .values_list('pk', 'product_id', 'product__name', 'quantity', 'product__price')
+    )
+    lines = tuple(
+        QuoteLine(item_id=pk, product_id=product_id, name=name, quantity=quantity, unit_amount=to_cents(price))
+        for pk, product_id, name, quantity, price in rows
+    )
+    return CartQuote(cart_pk=cart.pk, version=cart.version, lines=lines)
+
+
+def quote_cart(cart):
+    """
+    The memoized quote for the cart's current version.
+    """
+    quote = getattr(cart, '_quote', None)
+    if quote is not None and quote.version == cart.version:
+        return quote
+    key = _quote_key(cart)
+    quote = cache.get(key)
+    if quote is None:
+        quote = build_quote(cart)
+        cache.set(key, quote, QUOTE_CACHE_TIMEOUT)
+    cart._quote = quote
+    return quote
+
+
+def invalidate_product_quotes(product_ids):
+    """
+    Bump the version of every cart holding one of these products, and
+    recompute its subtotal, after a change to their prices or names.
+    """
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), 900):
+        chunk = product_ids[start:start + 900]
+        Cart.objects.filter(
+            pk__in=CartItem.objects.filter(product_id__in=chunk).values('cart_id')
+        ).mark_changed()
+
+
+def create_order_items(order, quote):
+    """
+    Materialize the quote's lines as the order's items and set its total.
+    """
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product_id=line.product_id, quantity=line.quantity, price=line.unit_price)
+        for line in quote.lines
+    ])
+    order.total_amount = quote.total_price
+    order.save(update_fields=['total_amount', 'updated_at'])
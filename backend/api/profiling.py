@@ -0,0 +1,234 @@
+"""
+On-demand request profiling for staff.
+
+A staff user adds `X-Profile: cprofile` (or `sample`) to a request, or
+`?_profile=cprofile` / `?_profile=sample` to its URL, and
+ProfilingMiddleware profiles that one request:
+
+- cprofile: deterministic cProfile of the request thread. Accurate call
+  counts, but it slows every Python call down.
+- sample: a background thread samples the request thread's stack every
+  PROFILING_SAMPLE_INTERVAL seconds. Cheap enough to use on slow endpoints
+  in production. The output is folded stacks, the input format of
+  flamegraph.pl and speedscope.
+
+Either way each query's SQL shape and duration is recorded. Profiles live in
+an in-process ring buffer of the last PROFILING_BUFFER_SIZE requests, so
+each worker process keeps its own. The admin site lists and downloads them
+under /admin/profiles/.
+"""
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .query_budget import fingerprint_sql
+
+MODES = ('cprofile', 'sample')
+BUFFER_SIZE = getattr(settings, 'PROFILING_BUFFER_SIZE', 50)
+SAMPLE_INTERVAL = getattr(settings, 'PROFILING_SAMPLE_INTERVAL', 0.005)
+
+# Only one cProfile can be active per process (Python 3.12 refuses a second).
+_cprofile_lock = threading.Lock()
+
+
+@dataclass
+class Profile:
+    id: str
+    mode: str
+    method: str
+    path: str
+    user: str
+    started_at: object
+    duration_ms: float = 0.0
+    status_code: int = 0
+    query_count: int = 0
+    query_ms: float = 0.0
+    queries: list = field(default_factory=list)  # (shape, count, total ms, max ms), slowest first
+    stats_text: str = ''
+    folded: str = ''  # "frame;frame;frame count" lines, for flame graphs
+    pstats_data: bytes = b''  # marshalled pstats, for snakeviz and friends
+
+
+class ProfileStore:
+    """
+    The last `size` profiles, newest first.
+    """
+    def __init__(self, size):
+        self._profiles = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        with self._lock:
+            self._profiles.appendleft(profile)
+
+    def all(self):
+        with self._lock:
+            return list(self._profiles)
+
+    def get(self, profile_id):
+        with self._lock:
+            return next((p for p in self._profiles if p.id == profile_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+
+store = ProfileStore(BUFFER_SIZE)
+
+
+def requested_mode(request):
+    """
+    The profiling mode the request asks for, or None.
+    """
+    value = request.headers.get('X-Profile') or request.GET.get('_profile')
+    if not value:
+        return None
+    value = value.strip().lower()
+    if value in ('1', 'true', 'yes'):
+        return 'cprofile'
+    return value if value in MODES else None
+
+
+class QueryTimer:
+    """
+    Execute wrapper timing every query, grouped by SQL shape.
+    """
+    def __init__(self):
+        self.shapes = {}
+        self.count = 0
+        self.total = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.count += 1
+            self.total += elapsed
+            count, total, longest = self.shapes.get(sql, (0, 0.0, 0.0))
+            self.shapes[sql] = (count + 1, total + elapsed, max(longest, elapsed))
+
+    def summary(self, limit=50):
+        by_shape = {}
+        for sql, (count, total, longest) in self.shapes.items():
+            shape = fingerprint_sql(sql)
+            c, t, m = by_shape.get(shape, (0, 0.0, 0.0))
+            by_shape[shape] = (c + count, t + total, max(m, longest))
+        rows = sorted(by_shape.items(), key=lambda item: item[1][1], reverse=True)
+        return [(shape, count, round(total, 3), round(longest, 3)) for shape, (count, total, longest) in rows[:limit]]
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Samples one thread's Python stack from a background thread.
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='request-profiler')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit=40):
+        """
+        Sample counts by innermost frame, as text.
+        """
+        own = Counter()
+        for stack, count in self.stacks.items():
+            own[stack.rsplit(';', 1)[-1]] += count
+        total = sum(own.values()) or 1
+        lines = [f"{sum(self.stacks.values())} samples every {self.interval * 1000:g} ms", '']
+        lines += [f"{count:6d} {count * 100 / total:5.1f}%  {label}" for label, count in own.most_common(limit)]
+        return '\n'.join(lines)
+
+
+def profile_request(request, get_response, mode):
+    """
+    Run `get_response(request)` under the profiler and store the profile.
+    Returns (response, profile), or (response, None) when another cProfile
+    was already running.
+    """
+    if mode == 'cprofile' and not _cprofile_lock.acquire(blocking=False):
+        return get_response(request), None
+
+    profile = Profile(
+        id=uuid.uuid4().hex[:12], mode=mode, method=request.method, path=request.get_full_path(),
+        user=request.user.get_username(), started_at=timezone.now(),
+    )
+    timer = QueryTimer()
+    wrappers = [connection.execute_wrapper(timer) for connection in connections.all()]
+    for wrapper in wrappers:
+        wrapper.__enter__()
+    profiler = sampler = None
+    start = time.perf_counter()
+    try:
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            sampler = StackSampler(threading.get_ident(), SAMPLE_INTERVAL)
+            sampler.start()
+        response = get_response(request)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _cprofile_lock.release()
+        if sampler is not None:
+            sampler.stop()
+        profile.duration_ms = round((time.perf_counter() - start) * 1000, 3)
+        for wrapper in reversed(wrappers):
+            wrapper.__exit__(None, None, None)
+
+    profile.status_code = response.status_code
+    profile.query_count = timer.count
+    profile.query_ms = round(timer.total, 3)
+    profile.queries = timer.summary()
+    if profiler is not None:
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(60)
+        profile.stats_text = stream.getvalue()
+        profile.pstats_data = marshal.dumps(stats.stats)
+    else:
+        profile.stats_text = sampler.top_functions()
+        profile.folded = sampler.folded()
+    store.add(profile)
+    return response, profile
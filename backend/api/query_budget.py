@@ -0,0 +1,170 @@
+"""
+Query budgets and N+1 detection.
+
+`@query_budget(n)` declares how many queries a view may run, including the
+ones its template or serializer issue while rendering. Admin classes get the
+same for their changelist through QueryBudgetAdminMixin.changelist_query_budget.
+Going over budget raises QueryBudgetExceeded when settings.QUERY_BUDGET_STRICT
+is on and logs a warning otherwise.
+
+QueryShapeRecorder groups a request's queries by fingerprint, the SQL with
+literals and parameter lists normalized away, so `WHERE id = 1` and
+`WHERE id = 2` count as the same shape. NPlusOneDetectionMiddleware uses it
+to warn, with the call site, when one shape runs more than
+settings.NPLUSONE_THRESHOLD times in a request.
+"""
+import functools
+import logging
+import re
+import traceback
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('api.queries')
+
+_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\((?:\s*(?:\?|%s)\s*,?)+\)', re.IGNORECASE)
+_PLACEHOLDERS = re.compile(r'%s|\?')
+_WHITESPACE = re.compile(r'\s+')
+
+# Frames from these paths are framework plumbing, not the call site.
+_LIBRARY_PATHS = (
+    '/django/', '/rest_framework/', '/site-packages/',
+    '/api/middleware.py', '/api/query_budget.py', '/api/sql_tags.py', '/api/slow_queries.py',
+    '/api/tracing.py', '/api/profiling.py',
+)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def fingerprint_sql(sql):
+    """
+    Normalize SQL to its shape: comments (see api.sql_tags) are dropped,
+    literals and placeholders become `?` and IN lists of any length
+    collapse to `IN (...)`.
+    """
+    sql = _COMMENT.sub('', sql)
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDERS.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def call_site(limit=6):
+    """
+    The innermost frames of the current stack that belong to the project.
+    """
+    frames = [
+        frame for frame in traceback.extract_stack()[:-1]
+        if not any(part in frame.filename for part in _LIBRARY_PATHS)
+    ]
+    return ''.join(traceback.format_list(frames[-limit:]))
+
+
+class QueryShapeRecorder:
+    """
+    Execute wrapper that counts queries, and optionally their shapes, on
+    every database connection while it is installed.
+
+        with QueryShapeRecorder() as recorder:
+            ...
+        recorder.count, recorder.repeated(5)
+    """
+    def __init__(self, track_shapes=False, threshold=None):
+        self.track_shapes = track_shapes
+        self.threshold = threshold
+        self.count = 0
+        self.shapes = Counter()
+        self.stacks = {}
+        self._contexts = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        if self.track_shapes:
+            shape = fingerprint_sql(sql)
+            self.shapes[shape] += 1
+            # Only the first repeat past the threshold pays for a stack.
+            if self.threshold is not None and self.shapes[shape] == self.threshold + 1:
+                self.stacks[shape] = call_site()
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        for connection in connections.all():
+            context = connection.execute_wrapper(self)
+            context.__enter__()
+            self._contexts.append(context)
+        return self
+
+    def __exit__(self, *exc_info):
+        while self._contexts:
+            self._contexts.pop().__exit__(*exc_info)
+
+    def repeated(self, threshold):
+        """
+        (shape, count, call site) for every shape run more than `threshold` times.
+        """
+        return [
+            (shape, count, self.stacks.get(shape, ''))
+            for shape, count in self.shapes.most_common()
+            if count > threshold
+        ]
+
+
+def check_budget(name, count, budget):
+    if count <= budget:
+        return
+    message = f"{name} ran {count} queries, over its budget of {budget}."
+    if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+def _renderable(response):
+    # A DRF Response can't render before the view's finalize_response has
+    # picked a renderer; its serializer data is evaluated by then anyway.
+    if getattr(response, 'is_rendered', True):
+        return False
+    return not hasattr(response, 'data') or hasattr(response, 'accepted_renderer')
+
+
+def query_budget(max_queries, name=None):
+    """
+    Decorate a view (function or method) with the most queries it may run.
+    Template responses are rendered inside the budget so the queries their
+    templates run count too.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with QueryShapeRecorder() as recorder:
+                response = view(*args, **kwargs)
+                if _renderable(response):
+                    response.render()
+            check_budget(name or view.__qualname__, recorder.count, max_queries)
+            return response
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
+
+
+class QueryBudgetAdminMixin:
+    """
+    ModelAdmin mixin enforcing `changelist_query_budget` on the changelist,
+    whatever the page size: an N+1 in a list_display callable blows it.
+    """
+    changelist_query_budget = None
+
+    def changelist_view(self, request, extra_context=None):
+        if self.changelist_query_budget is None:
+            return super().changelist_view(request, extra_context)
+        view = query_budget(self.changelist_query_budget, name=f'{type(self).__name__} changelist')(
+            super().changelist_view
+        )
+        return view(request, extra_context)
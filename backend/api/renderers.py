@@ -0,0 +1,70 @@
+"""
+orjson based renderer and parser for the high-traffic read endpoints.
+
+Viewsets opt in through `renderer_classes` / `parser_classes`. When orjson
+isn't installed both classes fall back to DRF's stdlib JSON implementation.
+"""
+import decimal
+
+from django.db.models.query import QuerySet
+from django.utils.encoding import force_str
+from django.utils.functional import Promise
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+def _default(obj):
+    """
+    Handle the types orjson doesn't know about. UUID and datetime are
+    serialized natively; Decimal is rendered as a string to match
+    DRF's COERCE_DECIMAL_TO_STRING behaviour.
+    """
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if isinstance(obj, Promise):
+        return force_str(obj)
+    if isinstance(obj, QuerySet):
+        return list(obj)
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if hasattr(obj, '__iter__'):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSON renderer backed by orjson.
+    """
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+
+        option = orjson.OPT_NON_STR_KEYS
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=_default, option=option)
+
+
+class ORJSONParser(JSONParser):
+    """
+    JSON parser backed by orjson.
+    """
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if orjson is None:
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
@@ -0,0 +1,179 @@
+"""
+Indexed text search for the admin.
+
+On SQLite, customers, addresses and orders get a document in an FTS5 shadow
+table using the trigram tokenizer, which answers the same case-insensitive
+substring questions as `icontains` without scanning the tables. Documents are
+kept in sync by the signal receivers in api.signals; `manage.py
+rebuild_search_index` rebuilds them from scratch.
+
+    api_searchkey (id, model, object_pk)  -- maps objects to FTS rowids
+    api_searchdoc (rowid, body)           -- FTS5, tokenize='trigram'
+
+On PostgreSQL nothing is mirrored: migration 0005 adds pg_trgm GIN indexes on
+the searched columns, which plain `icontains` lookups use directly.
+"""
+from django.db import OperationalError, connections
+from django.utils.text import smart_split, unescape_string_literal
+
+from .models import Customer, Address, Order
+
+# Model -> the fields whose text makes up its search document. These mirror
+# the search_fields of the matching ModelAdmin, minus exact-match-only fields.
+SEARCH_DOCUMENTS = {
+    Customer: ('email', 'name', 'device'),
+    Address: ('street_address', 'city', 'customer__email'),
+    Order: ('customer__email', 'customer__name'),
+}
+
+# The trigram tokenizer can't match anything shorter than a trigram.
+MIN_TERM_LENGTH = 3
+
+_ready = set()
+
+
+def search_index_ready(using='default'):
+    """
+    Whether the FTS5 shadow tables exist on this database.
+    """
+    if using in _ready:
+        return True
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'api_searchdoc'")
+        if cursor.fetchone() is None:
+            return False
+    _ready.add(using)
+    return True
+
+
+def search_terms(search_term):
+    """
+    Split a search box string the way ModelAdmin.get_search_results does.
+    """
+    terms = []
+    for bit in smart_split(search_term):
+        if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+            bit = unescape_string_literal(bit)
+        terms.append(bit)
+    return terms
+
+
+def match_sql(model, search_term, using='default'):
+    """
+    (sql, params) for a subquery returning the primary keys of `model`
+    objects whose document contains every term, or None when the index
+    can't answer the search and the caller should fall back to icontains.
+    """
+    if model not in SEARCH_DOCUMENTS or not search_index_ready(using):
+        return None
+    terms = search_terms(search_term)
+    if not terms or any(len(term) < MIN_TERM_LENGTH for term in terms):
+        return None
+    # Quote every term so FTS5 treats it as a literal substring.
+    query = ' AND '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    sql = (
+        'SELECT k.object_pk FROM api_searchdoc d '
+        'JOIN api_searchkey k ON k.id = d.rowid '
+        'WHERE d.body MATCH %s AND k.model = %s'
+    )
+    return sql, [query, model._meta.label_lower]
+
+
+def _document_rows(model, pks=None, using='default'):
+    rows = model._base_manager.using(using).values_list('pk', *SEARCH_DOCUMENTS[model])
+    if pks is not None:
+        rows = rows.filter(pk__in=pks)
+    return rows
+
+
+def _write_documents(model, rows, using, replace=True):
+    connection = connections[using]
+    label = model._meta.label_lower
+    pk_field = model._meta.pk
+    documents = [
+        (pk_field.get_db_prep_value(pk, connection), '\n'.join(str(value) for value in values if value))
+        for pk, *values in rows
+    ]
+    if not documents:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT OR IGNORE INTO api_searchkey (model, object_pk) VALUES (%s, %s)',
+            [(label, object_pk) for object_pk, _ in documents]
+        )
+        if replace:
+            cursor.executemany(
+                'DELETE FROM api_searchdoc WHERE rowid = '
+                '(SELECT id FROM api_searchkey WHERE model = %s AND object_pk = %s)',
+                [(label, object_pk) for object_pk, _ in documents]
+            )
+        cursor.executemany(
+            'INSERT INTO api_searchdoc (rowid, body) '
+            'SELECT id, %s FROM api_searchkey WHERE model = %s AND object_pk = %s',
+            [(body, label, object_pk) for object_pk, body in documents if body]
+        )
+
+
+def index_objects(model, pks, using='default'):
+    """
+    (Re)write the search documents of the given `model` objects.
+    """
+    if not search_index_ready(using):
+        return
+    pks = list(pks)
+    if not pks:
+        return
+    _write_documents(model, _document_rows(model, pks, using), using)
+
+
+def remove_objects(model, pks, using='default'):
+    """
+    Drop the search documents of the given `model` objects.
+    """
+    if not search_index_ready(using):
+        return
+    pks = list(pks)
+    if not pks:
+        return
+    connection = connections[using]
+    label = model._meta.label_lower
+    object_pks = [model._meta.pk.get_db_prep_value(pk, connection) for pk in pks]
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'DELETE FROM api_searchdoc WHERE rowid = '
+            '(SELECT id FROM api_searchkey WHERE model = %s AND object_pk = %s)',
+            [(label, object_pk) for object_pk in object_pks]
+        )
+        cursor.executemany(
+            'DELETE FROM api_searchkey WHERE model = %s AND object_pk = %s',
+            [(label, object_pk) for object_pk in object_pks]
+        )
+
+
+def rebuild_search_index(using='default', chunk_size=2000):
+    """
+    Empty the shadow tables and index every object again. Returns the number
+    of documents written per model label.
+    """
+    if not search_index_ready(using):
+        raise OperationalError("The search index tables don't exist on this database.")
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM api_searchdoc')
+        cursor.execute('DELETE FROM api_searchkey')
+
+    counts = {}
+    for model in SEARCH_DOCUMENTS:
+        count, chunk = 0, []
+        for row in _document_rows(model, using=using).order_by().iterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                _write_documents(model, chunk, using, replace=False)
+                count += len(chunk)
+                chunk = []
+        _write_documents(model, chunk, using, replace=False)
+        counts[model._meta.label_lower] = count + len(chunk)
+    return counts
@@ -1,22 +1,166 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from .images import variant_urls
+from .tracing import span
 from .models import Product, Customer, Address, Order, OrderItem, Cart, CartItem
 
 
-class ProductSerializer(serializers.ModelSerializer):
+_UNSET = object()
+
+
+def parse_field_paths(value):
+    """
+    Turn a comma separated list of dotted paths such as "id,items.product.name"
+    into a nested dict: {'id': {}, 'items': {'product': {'name': {}}}}.
+    """
+    if not isinstance(value, str):
+        value = ','.join(value)
+    tree = {}
+    for path in value.split(','):
+        path = path.strip()
+        if not path:
+            continue
+        node = tree
+        for part in path.split('.'):
+            node = node.setdefault(part, {})
+    return tree
+
+
+class TracedListSerializer(serializers.ListSerializer):
+    """
+    many=True counterpart of TracedDataMixin.
+    """
+    @property
+    def data(self):
+        with span(f'{type(self.child).__name__}(many=True).data'):
+            return super().data
+
+
+class TracedDataMixin:
+    """
+    Builds `.data` inside a tracing span (see api.tracing), many=True lists
+    included, so traces show how long rendering took.
+    """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        meta = cls.__dict__.get('Meta')
+        if meta is not None and not hasattr(meta, 'list_serializer_class'):
+            meta.list_serializer_class = TracedListSerializer
+    
+    @property
+    def data(self):
+        with span(f'{type(self).__name__}.data'):
+            return super().data
+
+
+class SparseFieldsMixin:
+    """
+    Lets API clients trim read responses with ?fields= and ?expand=.
+
+    `fields` takes dotted paths (e.g. `total_items,items.product.name`). When it
+    is given, only the listed fields are built; a nested serializer that is
+    listed without sub-fields collapses to its primary key unless it is also
+    named in `expand`. Pruned fields, nested serializers included, are never
+    instantiated. Serializers bound to input data always keep every field.
+    """
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        expand = kwargs.pop('expand', None)
+        super().__init__(*args, **kwargs)
+        self._sparse_spec = _UNSET
+        if fields is not None or expand is not None:
+            self._sparse_spec = (
+                parse_field_paths(fields) if fields is not None else None,
+                parse_field_paths(expand) if expand is not None else {},
+            )
+    
+    def get_sparse_spec(self):
+        """
+        Return (fields tree or None, expand tree) for this serializer. Nested
+        serializers get theirs from the parent; the outermost one reads the
+        request's query parameters.
+        """
+        if self._sparse_spec is _UNSET:
+            self._sparse_spec = (None, {})
+            request = self.context.get('request')
+            if request is not None and not hasattr(self.root, 'initial_data'):
+                params = getattr(request, 'query_params', request.GET)
+                fields = params.get('fields')
+                expand = params.get('expand')
+                self._sparse_spec = (
+                    parse_field_paths(fields) if fields else None,
+                    parse_field_paths(expand) if expand else {},
+                )
+        return self._sparse_spec
+    
+    def get_field_names(self, declared_fields, info):
+        field_names = super().get_field_names(declared_fields, info)
+        fields_tree, _ = self.get_sparse_spec()
+        if fields_tree is None:
+            return field_names
+        return [name for name in field_names if name in fields_tree]
+    
+    def get_fields(self):
+        fields_tree, expand_tree = self.get_sparse_spec()
+        if fields_tree is None:
+            fields = super().get_fields()
+            for name, field in fields.items():
+                self._set_nested_spec(field, None, expand_tree.get(name, {}))
+            return fields
+        
+        # Hide pruned declared fields so ModelSerializer doesn't deepcopy
+        # (and so instantiate) nested serializers nobody asked for.
+        self._declared_fields = {
+            name: field for name, field in type(self)._declared_fields.items()
+            if name in fields_tree
+        }
+        try:
+            fields = super().get_fields()
+        finally:
+            del self._declared_fields
+        
+        for name, field in list(fields.items()):
+            if not isinstance(field, serializers.BaseSerializer):
+                continue
+            if fields_tree[name]:
+                self._set_nested_spec(field, fields_tree[name], expand_tree.get(name, {}))
+            elif name in expand_tree:
+                self._set_nested_spec(field, None, expand_tree[name])
+            else:
+                fields[name] = serializers.PrimaryKeyRelatedField(
+                    read_only=True,
+                    many=isinstance(field, serializers.ListSerializer),
+                    source=field.source,
+                )
+        return fields
+    
+    @staticmethod
+    def _set_nested_spec(field, fields_tree, expand_tree):
+        if isinstance(field, serializers.ListSerializer):
+            field = field.child
+        if isinstance(field, SparseFieldsMixin):
+            field._sparse_spec = (fields_tree, expand_tree)
+
+
+class ProductSerializer(TracedDataMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the Product model.
     """
+    image_variants = serializers.SerializerMethodField()
+    
     class Meta:
         model = Product
         fields = [
-            'id', 'name', 'price', 'description', 'image', 
+            'id', 'name', 'price', 'description', 'image', 'image_variants',
             'stock', 'active', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
+    
+    def get_image_variants(self, obj):
+        return variant_urls(obj.image_variants, self.context.get('request'))
 
 
-class AddressSerializer(serializers.ModelSerializer):
+class AddressSerializer(TracedDataMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the Address model.
     """
@@ -29,7 +173,7 @@ class AddressSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
 
-class CustomerSerializer(serializers.ModelSerializer):
+class CustomerSerializer(TracedDataMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the Customer model.
     """
@@ -41,7 +185,7 @@ class CustomerSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TracedDataMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the CartItem model.
     """
@@ -61,7 +205,7 @@ class CartItemSerializer(serializers.ModelSerializer):
         read_only_fields = ['id']
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(TracedDataMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the Cart model.
     """
@@ -77,7 +221,7 @@ class CartSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
 
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(TracedDataMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the OrderItem model.
     """
@@ -102,7 +246,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(TracedDataMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the Order model.
     """
@@ -126,13 +270,12 @@ class OrderSerializer(serializers.ModelSerializer):
     
     def create(self, validated_data):
         customer_email = validated_data.pop('customer_email')
-        # Get or create customer by email
-        customer, created = Customer.objects.get_or_create(email=customer_email)
+        customer, created = Customer.objects.upsert_by_email(customer_email)
         validated_data['customer'] = customer
         return super().create(validated_data)
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TracedDataMixin, serializers.ModelSerializer):
     """
     Serializer for the User model (admin users).
     """
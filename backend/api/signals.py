@@ -0,0 +1,137 @@
+from django.db.models import DEFERRED
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .bootstrap import bump_catalog_version
+from .images import schedule_variants
+from .pricing import invalidate_product_quotes
+from .models import Product, Customer, Address, Order, OrderItem, Cart, CartItem
+from .search import index_objects, remove_objects, search_index_ready
+
+
+def _loaded_image(instance):
+    # Read from __dict__: a deferred image must not cost a query per instance.
+    if 'image' not in instance.__dict__:
+        return DEFERRED
+    image = instance.__dict__['image']
+    return getattr(image, 'name', image) or None
+
+
+@receiver(post_init, sender=Product)
+def remember_product_image(sender, instance, **kwargs):
+    instance._saved_image = _loaded_image(instance)
+
+
+@receiver(post_save, sender=Product)
+def queue_product_image_variants(sender, instance, created, **kwargs):
+    """
+    Regenerate image variants whenever a product gets a new image. The image
+    is compared with the one the instance was loaded or last saved with, so
+    other saves (before the job finishes, or after it failed) leave the
+    variants alone.
+    """
+    previous = None if created else instance._saved_image
+    if previous is DEFERRED and 'image' not in instance.__dict__:
+        return  # Not loaded, so not changed by this save.
+    current = instance.image.name or None
+    instance._saved_image = current
+    if current == previous:
+        return
+    # Drop the variants of the previous image straight away.
+    Product.objects.filter(pk=instance.pk).update(image_variants={})
+    instance.image_variants = {}
+    if current:
+        schedule_variants(instance)
+
+
+@receiver(post_save, sender=Product)
+def reprice_carts(sender, instance, created, **kwargs):
+    """
+    Carts holding a product that was edited get a new version, so their
+    cached pricing quotes aren't served with the old price or name.
+    """
+    if not created:
+        invalidate_product_quotes([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def refresh_bootstrap_catalog(sender, **kwargs):
+    # The storefront's first catalog page is cached under the catalog version.
+    bump_catalog_version()
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_carts(sender, instance, **kwargs):
+    # Deleting the product cascades to cart items without touching their carts.
+    instance._cart_pks = list(CartItem.objects.filter(product=instance).values_list('cart_id', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def recount_product_carts(sender, instance, **kwargs):
+    """
+    Carts that lost the deleted product get a new version, so their cached
+    quotes don't hand checkout a line for a product that is gone, and fresh
+    counters.
+    """
+    cart_pks = getattr(instance, '_cart_pks', None)
+    if cart_pks:
+        Cart.objects.filter(pk__in=cart_pks).mark_changed()
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def touch_item_order(sender, instance, **kwargs):
+    """
+    Item edits don't write the order row; move its updated_at so its cached
+    snapshot (see api.order_cache) is dropped.
+    """
+    Order.objects.filter(pk=instance.order_id).update(updated_at=timezone.now())
+
+
+@receiver(pre_delete, sender=Customer)
+def touch_customer_orders(sender, instance, **kwargs):
+    # SET_NULL clears the orders' customer with a bulk UPDATE that skips auto_now.
+    Order.objects.filter(customer=instance).update(updated_at=timezone.now())
+
+
+@receiver(pre_delete, sender=Address)
+def touch_address_orders(sender, instance, **kwargs):
+    # Same for their shipping address; also runs for a deleted customer's addresses.
+    Order.objects.filter(shipping_address=instance).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Customer)
+def index_customer(sender, instance, using, **kwargs):
+    """
+    Keep the admin search index in step with customers. Address and order
+    documents include the customer's email and name, so they follow along.
+    """
+    index_objects(Customer, [instance.pk], using)
+    if not kwargs.get('created'):
+        index_objects(Address, instance.addresses.values_list('pk', flat=True), using)
+        index_objects(Order, instance.orders.values_list('pk', flat=True), using)
+
+
+@receiver(post_save, sender=Address)
+@receiver(post_save, sender=Order)
+def index_search_document(sender, instance, using, **kwargs):
+    index_objects(sender, [instance.pk], using)
+
+
+@receiver(pre_delete, sender=Customer)
+def remember_customer_orders(sender, instance, using, **kwargs):
+    # Orders outlive their customer (SET_NULL, without a save signal), so
+    # note which ones lose their searchable text.
+    if search_index_ready(using):
+        instance._search_order_pks = list(instance.orders.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=Address)
+@receiver(post_delete, sender=Order)
+def remove_search_document(sender, instance, using, **kwargs):
+    remove_objects(sender, [instance.pk], using)
+    if sender is Customer:
+        remove_objects(Order, getattr(instance, '_search_order_pks', ()), using)
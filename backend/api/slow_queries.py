@@ -0,0 +1,180 @@
+"""
+Slow query log.
+
+SlowQueryMiddleware times every query a request runs. A query that takes
+longer than SLOW_QUERY_THRESHOLD_MS is recorded in `slow_query_log` under its
+fingerprint (see api.query_budget.fingerprint_sql). The record keeps the
+SQL, the shape of its parameters (types and list lengths, never the values)
+and the request's URL pattern. It also keeps the frame in api/views.py or api/admin.py
+that issued the query. The log keeps SLOW_QUERY_LOG_SIZE fingerprints per
+process and evicts the least recently seen one when full.
+
+Browse it in the admin at /admin/slow-queries/. Scrapers can read
+/api/admin/dashboard/slow_queries/, which needs a staff login.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.utils import timezone
+
+from .query_budget import fingerprint_sql
+
+THRESHOLD_MS = getattr(settings, 'SLOW_QUERY_THRESHOLD_MS', 100)
+LOG_SIZE = getattr(settings, 'SLOW_QUERY_LOG_SIZE', 200)
+# Frames in these files are reported as the query's call site.
+CALL_SITE_FILES = tuple(
+    os.path.join('api', name) for name in getattr(settings, 'SLOW_QUERY_CALL_SITE_FILES', ('views.py', 'admin.py'))
+)
+MAX_SQL_LENGTH = 2000
+MAX_PATHS = 10
+# (?P<pk>[^/.]+) in a router's regex pattern.
+NAMED_GROUP = re.compile(r'\(\?P<(\w+)>[^)]*\)')
+ORDERINGS = ('total_ms', 'max_ms', 'mean_ms', 'count', 'last_seen')
+
+
+def params_shape(params):
+    """
+    Describe query parameters without their values: `(int, str, list[3])`.
+    """
+    if params is None:
+        return '()'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in params.items()) + '}'
+    parts = []
+    for value in params:
+        if isinstance(value, (list, tuple)):
+            parts.append(f'{type(value).__name__}[{len(value)}]')
+        else:
+            parts.append(type(value).__name__)
+    return '(' + ', '.join(parts) + ')'
+
+
+def find_call_site():
+    """
+    'api/views.py:123 in checkout' for the innermost frame in one of
+    CALL_SITE_FILES, or None.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.endswith(CALL_SITE_FILES):
+            short = os.path.join(os.path.basename(os.path.dirname(filename)), os.path.basename(filename))
+            return f'{short}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+class SlowQueryLog:
+    """
+    Slow queries aggregated by fingerprint, bounded to `size` fingerprints.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, sql, params, duration_ms, path, call_site):
+        fingerprint = fingerprint_sql(sql)
+        shape = params_shape(params)
+        now = timezone.now()
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                entry = self._entries[fingerprint] = {
+                    'fingerprint': fingerprint,
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'first_seen': now,
+                    'paths': Counter(),
+                    'call_sites': Counter(),
+                }
+                if len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(fingerprint)
+            entry['count'] += 1
+            entry['total_ms'] += duration_ms
+            entry['last_ms'] = duration_ms
+            entry['last_seen'] = now
+            if duration_ms >= entry['max_ms']:
+                # Keep the slowest example; its plan is the one worth explaining.
+                entry['max_ms'] = duration_ms
+                entry['sql'] = sql[:MAX_SQL_LENGTH]
+                entry['params_shape'] = shape
+            if path is not None and (path in entry['paths'] or len(entry['paths']) < MAX_PATHS):
+                entry['paths'][path] += 1
+            if call_site is not None and (call_site in entry['call_sites'] or len(entry['call_sites']) < MAX_PATHS):
+                entry['call_sites'][call_site] += 1
+
+    def entries(self, order_by='total_ms'):
+        """
+        Plain-dict copies of the entries, biggest `order_by` first.
+        """
+        with self._lock:
+            entries = [
+                {
+                    **entry,
+                    'total_ms': round(entry['total_ms'], 3),
+                    'max_ms': round(entry['max_ms'], 3),
+                    'last_ms': round(entry['last_ms'], 3),
+                    'mean_ms': round(entry['total_ms'] / entry['count'], 3),
+                    'paths': dict(entry['paths'].most_common()),
+                    'call_sites': dict(entry['call_sites'].most_common()),
+                }
+                for entry in self._entries.values()
+            ]
+        return sorted(entries, key=lambda entry: entry[order_by], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_query_log = SlowQueryLog(LOG_SIZE)
+
+
+def route_pattern(request):
+    """
+    "/api/orders/<pk>/": the request's URL pattern, or its path before URL
+    resolution.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.route:
+        return request.path
+    # Router patterns are regexes: write their groups the way path() does
+    # and drop the anchors.
+    route = NAMED_GROUP.sub(r'<\1>', match.route)
+    return '/' + route.replace('^', '').replace('$', '')
+
+
+def request_label(request):
+    """
+    "GET /api/orders/<pk>/", so paths with ids in them don't each take a slot.
+    """
+    return f'{request.method} {route_pattern(request)}'
+
+
+class SlowQueryRecorder:
+    """
+    Execute wrapper logging the queries slower than `threshold_ms`.
+    """
+    def __init__(self, request=None, threshold_ms=THRESHOLD_MS, log=slow_query_log):
+        self.request = request
+        self.threshold_ms = threshold_ms
+        self.log = log
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            if duration_ms >= self.threshold_ms:
+                path = request_label(self.request) if self.request is not None else None
+                self.log.record(sql, None if many else params, duration_ms, path, find_call_site())
@@ -0,0 +1,122 @@
+"""
+sqlcommenter-style query tagging.
+
+Inside `with sql_tags(view='CartViewSet', action='checkout'):` every query
+gets a comment naming where it came from:
+
+    SELECT ... FROM "api_cart" WHERE ... /*action='checkout',view='CartViewSet'*/
+
+SQLCommentMiddleware tags each request with its view, action and URL
+pattern. Management commands tag themselves with `@tag_job(name)` on handle().
+Keys are sorted and values URL-encoded, as the sqlcommenter spec asks, so
+tools that parse those comments (Cloud SQL insights, pganalyze, ...) can
+read them. The comment is built once per tag change, not once per query.
+
+PostgreSQL ignores comments when computing pg_stat_statements' queryid, so
+tagged statements still share one row there. The tags show up wherever the
+statement text is kept verbatim: pg_stat_activity, the slow statement log
+(log_min_duration_statement) and auto_explain.
+"""
+import contextvars
+import functools
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from django.db import connections
+
+from .slow_queries import route_pattern
+
+_current = contextvars.ContextVar('sql_tags', default=None)
+
+
+class TagSet:
+    """
+    The tags of the current context and their rendered comment.
+    """
+    def __init__(self, tags):
+        self.tags = {key: value for key, value in tags.items() if value is not None}
+        self._comment = None
+
+    def update(self, **tags):
+        self.tags.update((key, value) for key, value in tags.items() if value is not None)
+        self._comment = None
+
+    @property
+    def comment(self):
+        if self._comment is None:
+            pairs = ','.join(
+                f"{quote(str(key), safe='')}='{quote(str(value), safe='')}'"
+                for key, value in sorted(self.tags.items())
+            )
+            self._comment = f'/*{pairs}*/' if pairs else ''
+        return self._comment
+
+
+def _append_comment(execute, sql, params, many, context):
+    tags = _current.get()
+    if tags is not None and tags.comment:
+        comment = tags.comment
+        # With parameters the driver interpolates, so a literal % must be doubled.
+        if params is not None:
+            comment = comment.replace('%', '%%')
+        sql = f'{sql} {comment}'
+    return execute(sql, params, many, context)
+
+
+@contextmanager
+def sql_tags(**tags):
+    """
+    Tag the queries run in this block, on top of any enclosing tags.
+    Yields the TagSet, which can be updated as more becomes known.
+    """
+    parent = _current.get()
+    tag_set = TagSet({**(parent.tags if parent is not None else {}), **tags})
+    token = _current.set(tag_set)
+    wrappers = []
+    if parent is None:
+        wrappers = [connection.execute_wrapper(_append_comment) for connection in connections.all()]
+        for wrapper in wrappers:
+            wrapper.__enter__()
+    try:
+        yield tag_set
+    finally:
+        for wrapper in reversed(wrappers):
+            wrapper.__exit__(None, None, None)
+        _current.reset(token)
+
+
+def tag_job(name):
+    """
+    Decorate a management command's handle() to tag its queries with `job=name`.
+    """
+    def decorator(handle):
+        @functools.wraps(handle)
+        def wrapper(*args, **kwargs):
+            with sql_tags(job=name):
+                return handle(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def view_tags(request, view_func):
+    """
+    view/action/route tags for the view about to handle `request`.
+    """
+    match = request.resolver_match
+    view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+    model_admin = getattr(view_func, 'model_admin', None)
+    if model_admin is not None:
+        view = type(model_admin).__name__
+    elif view_class is not None:
+        view = view_class.__name__
+    else:
+        view = getattr(view_func, '__qualname__', getattr(view_func, '__name__', None))
+
+    actions = getattr(view_func, 'actions', None)  # DRF viewsets: {'get': 'list', ...}
+    if actions:
+        action = actions.get(request.method.lower())
+    elif model_admin is not None and match is not None and match.url_name:
+        action = match.url_name.rsplit('_', 1)[-1]  # api_customer_changelist -> changelist
+    else:
+        action = match.url_name if match is not None else None
+    return {'view': view, 'action': action, 'route': route_pattern(request)}
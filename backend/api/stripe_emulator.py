@@ -0,0 +1,491 @@
+"""
+A local stand-in for the parts of the Stripe API this project uses.
+
+Run it with `manage.py stripe_emulator` and start Django with
+STRIPE_API_BASE pointing at it. Checkout and payments then run end to end
+without network access:
+
+    POST /v1/payment_intents                     create
+    GET  /v1/payment_intents/<id>                retrieve
+    POST /v1/payment_intents/<id>                update (amount, metadata)
+    POST /v1/payment_intents/<id>/confirm        succeed or decline
+    POST /v1/payment_intents/<id>/cancel         cancel
+    POST /v1/checkout/sessions                   create
+    GET  /v1/checkout/sessions/<id>              retrieve
+    POST /v1/checkout/sessions/<id>/expire       expire
+    GET  /pay/<id>                               hosted "payment page"
+    POST /pay/<id>                               complete the session
+
+State changes send signed webhook events (payment_intent.succeeded,
+payment_intent.payment_failed, payment_intent.canceled,
+checkout.session.completed) to the webhook URL from a background thread,
+and failed deliveries are retried with backoff the way Stripe does. Latency
+and failures can be injected into API calls, payments and webhook
+deliveries.
+"""
+import hashlib
+import hmac
+import json
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.request
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+API_VERSION = '2024-06-20'
+CHECKOUT_SESSION_LIFETIME = 24 * 60 * 60
+MINIMUM_AMOUNT = 50  # cents; Stripe's minimum charge in USD
+
+
+@dataclass
+class EmulatorConfig:
+    webhook_url: str = 'http://127.0.0.1:8000/webhook/stripe/'
+    webhook_secret: str = 'whsec_placeholder'
+    latency_ms: tuple = (0, 0)  # (min, max) added to every API response
+    webhook_delay_ms: tuple = (0, 0)  # (min, max) before each delivery attempt
+    api_failure_rate: float = 0.0  # share of API calls answered with a 500
+    decline_rate: float = 0.0  # share of payments that are declined
+    webhook_failure_rate: float = 0.0  # share of delivery attempts dropped
+    webhook_retries: int = 3
+    verbose: bool = False
+
+
+class StripeAPIError(Exception):
+    def __init__(self, status, error_type, message, code=None, param=None):
+        super().__init__(message)
+        self.status = status
+        self.body = {'error': {'type': error_type, 'message': message}}
+        if code:
+            self.body['error']['code'] = code
+        if param:
+            self.body['error']['param'] = param
+
+
+def decode_form(body):
+    """
+    Decode Stripe's form encoding (`metadata[cart_id]=1&line_items[0][quantity]=2`)
+    into nested dicts and lists.
+    """
+    root = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+', key)
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return _listify(root)
+
+
+def _listify(node):
+    if not isinstance(node, dict):
+        return node
+    if node and all(key.isdigit() for key in node):
+        return [_listify(node[key]) for key in sorted(node, key=int)]
+    return {key: _listify(value) for key, value in node.items()}
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """
+    The Stripe-Signature header for `payload`.
+    """
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def _new_id(prefix):
+    return f'{prefix}_{secrets.token_hex(12)}'
+
+
+def _pause(bounds):
+    low, high = bounds
+    if high > 0:
+        time.sleep(random.uniform(low, high) / 1000)
+
+
+class StripeEmulator:
+    """
+    In-memory Stripe state plus the HTTP server in front of it.
+    """
+    def __init__(self, host='127.0.0.1', port=12111, config=None, log=print):
+        self.config = config or EmulatorConfig()
+        self.log = log
+        self.lock = threading.Lock()
+        self.payment_intents = {}
+        self.sessions = {}
+        self.deliveries = []  # (event type, event id, status or error) per attempt
+        self._webhooks = queue.Queue()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._threads = []
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """
+        Serve and deliver webhooks from background threads.
+        """
+        for target in (self.server.serve_forever, self._deliver_webhooks):
+            thread = threading.Thread(target=target, daemon=True, name=f'stripe-emulator-{target.__name__}')
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._webhooks.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_for_webhooks(self, timeout=10):
+        """
+        Block until every queued webhook has been delivered or given up on.
+        """
+        deadline = time.monotonic() + timeout
+        while self._webhooks.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._webhooks.unfinished_tasks
+
+    # --- API -----------------------------------------------------------
+
+    def dispatch(self, method, path, params):
+        _pause(self.config.latency_ms)
+        if self.config.api_failure_rate and random.random() < self.config.api_failure_rate:
+            raise StripeAPIError(500, 'api_error', 'Injected failure.')
+
+        routes = [
+            ('POST', r'/v1/payment_intents', self.create_payment_intent),
+            ('GET', r'/v1/payment_intents/(?P<id>[^/]+)', self.retrieve_payment_intent),
+            ('POST', r'/v1/payment_intents/(?P<id>[^/]+)', self.update_payment_intent),
+            ('POST', r'/v1/payment_intents/(?P<id>[^/]+)/confirm', self.confirm_payment_intent),
+            ('POST', r'/v1/payment_intents/(?P<id>[^/]+)/cancel', self.cancel_payment_intent),
+            ('POST', r'/v1/checkout/sessions', self.create_checkout_session),
+            ('GET', r'/v1/checkout/sessions/(?P<id>[^/]+)', self.retrieve_checkout_session),
+            ('POST', r'/v1/checkout/sessions/(?P<id>[^/]+)/expire', self.expire_checkout_session),
+        ]
+        for route_method, pattern, handler in routes:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                with self.lock:
+                    return handler(params, **match.groupdict())
+        raise StripeAPIError(404, 'invalid_request_error', f'Unrecognized request URL ({method}: {path}).')
+
+    def _payment_intent(self, id):
+        try:
+            return self.payment_intents[id]
+        except KeyError:
+            raise StripeAPIError(404, 'invalid_request_error', f"No such payment_intent: '{id}'",
+                                 code='resource_missing', param='intent')
+
+    def _checkout_session(self, id):
+        try:
+            return self.sessions[id]
+        except KeyError:
+            raise StripeAPIError(404, 'invalid_request_error', f"No such checkout.session: '{id}'",
+                                 code='resource_missing', param='session')
+
+    def _amount(self, value):
+        try:
+            amount = int(value)
+        except (TypeError, ValueError):
+            raise StripeAPIError(400, 'invalid_request_error', 'Invalid integer: amount', param='amount')
+        if amount < MINIMUM_AMOUNT:
+            raise StripeAPIError(400, 'invalid_request_error', 'Amount must be at least $0.50 usd',
+                                 code='amount_too_small', param='amount')
+        return amount
+
+    def create_payment_intent(self, params):
+        intent_id = _new_id('pi')
+        intent = {
+            'id': intent_id,
+            'object': 'payment_intent',
+            'amount': self._amount(params.get('amount')),
+            'currency': params.get('currency', 'usd'),
+            'client_secret': f'{intent_id}_secret_{secrets.token_hex(12)}',
+            'created': int(time.time()),
+            'livemode': False,
+            'metadata': params.get('metadata', {}),
+            'status': 'requires_payment_method',
+            'last_payment_error': None,
+        }
+        self.payment_intents[intent_id] = intent
+        return intent
+
+    def retrieve_payment_intent(self, params, id):
+        return self._payment_intent(id)
+
+    def update_payment_intent(self, params, id):
+        intent = self._payment_intent(id)
+        if intent['status'] in ('succeeded', 'canceled', 'processing'):
+            raise StripeAPIError(
+                400, 'invalid_request_error',
+                f"This PaymentIntent's amount could not be updated because it has a status of {intent['status']}.",
+                code='payment_intent_unexpected_state',
+            )
+        if 'amount' in params:
+            intent['amount'] = self._amount(params['amount'])
+        if 'metadata' in params:
+            intent['metadata'].update(params['metadata'])
+        return intent
+
+    def confirm_payment_intent(self, params, id):
+        intent = self._payment_intent(id)
+        if intent['status'] in ('succeeded', 'canceled'):
+            raise StripeAPIError(400, 'invalid_request_error',
+                                 f"This PaymentIntent has a status of {intent['status']}.",
+                                 code='payment_intent_unexpected_state')
+        if self.config.decline_rate and random.random() < self.config.decline_rate:
+            intent['status'] = 'requires_payment_method'
+            intent['last_payment_error'] = {
+                'type': 'card_error', 'code': 'card_declined', 'message': 'Your card was declined.',
+            }
+            self.send_event('payment_intent.payment_failed', intent)
+        else:
+            intent['status'] = 'succeeded'
+            intent['last_payment_error'] = None
+            self.send_event('payment_intent.succeeded', intent)
+        return intent
+
+    def cancel_payment_intent(self, params, id):
+        intent = self._payment_intent(id)
+        if intent['status'] in ('succeeded', 'canceled'):
+            raise StripeAPIError(400, 'invalid_request_error',
+                                 f"This PaymentIntent has a status of {intent['status']}.",
+                                 code='payment_intent_unexpected_state')
+        intent['status'] = 'canceled'
+        self.send_event('payment_intent.canceled', intent)
+        return intent
+
+    def create_checkout_session(self, params):
+        line_items = params.get('line_items') or []
+        if not line_items:
+            raise StripeAPIError(400, 'invalid_request_error', 'line_items is required.', param='line_items')
+        amount_total = sum(
+            int(item['price_data']['unit_amount']) * int(item.get('quantity', 1))
+            for item in line_items
+        )
+        session_id = _new_id('cs_test')
+        session = {
+            'id': session_id,
+            'object': 'checkout.session',
+            'amount_total': amount_total,
+            'currency': line_items[0]['price_data'].get('currency', 'usd'),
+            'cancel_url': params.get('cancel_url'),
+            'success_url': params.get('success_url'),
+            'created': int(time.time()),
+            'expires_at': int(time.time()) + CHECKOUT_SESSION_LIFETIME,
+            'livemode': False,
+            'metadata': params.get('metadata', {}),
+            'mode': params.get('mode', 'payment'),
+            'payment_intent': None,
+            'payment_status': 'unpaid',
+            'status': 'open',
+            'customer_details': None,
+            'shipping_details': None,
+            'url': f'{self.base_url}/pay/{session_id}',
+            '_line_items': line_items,
+        }
+        self.sessions[session_id] = session
+        return self._public(session)
+
+    def retrieve_checkout_session(self, params, id):
+        return self._public(self._checkout_session(id))
+
+    def expire_checkout_session(self, params, id):
+        session = self._checkout_session(id)
+        if session['status'] != 'open':
+            raise StripeAPIError(400, 'invalid_request_error',
+                                 f"Only Checkout Sessions with a status of open can be expired; this one is {session['status']}.",
+                                 code='checkout_session_unexpected_state')
+        session['status'] = 'expired'
+        return self._public(session)
+
+    def complete_checkout_session(self, id, email='customer@example.com', address=None):
+        """
+        What paying on the hosted page does: create a succeeded
+        PaymentIntent and send checkout.session.completed.
+        """
+        with self.lock:
+            session = self._checkout_session(id)
+            if session['status'] != 'open':
+                raise StripeAPIError(400, 'invalid_request_error', f"Checkout Session is {session['status']}.")
+            if self.config.decline_rate and random.random() < self.config.decline_rate:
+                raise StripeAPIError(402, 'card_error', 'Your card was declined.', code='card_declined')
+            intent = self.create_payment_intent({
+                'amount': session['amount_total'], 'currency': session['currency'],
+                'metadata': dict(session['metadata']),
+            })
+            intent['status'] = 'succeeded'
+            session.update({
+                'status': 'complete',
+                'payment_status': 'paid',
+                'payment_intent': intent['id'],
+                'customer_details': {'email': email, 'name': None},
+                'shipping_details': {'name': None, 'address': address or {
+                    'line1': '1 Emulator Way', 'line2': '', 'city': 'Springfield',
+                    'state': 'IL', 'country': 'US', 'postal_code': '62701',
+                }},
+            })
+            self.send_event('checkout.session.completed', self._public(session))
+            self.send_event('payment_intent.succeeded', intent)
+            return self._public(session)
+
+    @staticmethod
+    def _public(session):
+        return {key: value for key, value in session.items() if not key.startswith('_')}
+
+    # --- Webhooks --------------------------------------------------------
+
+    def send_event(self, event_type, obj):
+        event = {
+            'id': _new_id('evt'),
+            'object': 'event',
+            'api_version': API_VERSION,
+            'created': int(time.time()),
+            'livemode': False,
+            'type': event_type,
+            'data': {'object': json.loads(json.dumps(obj))},
+        }
+        self._webhooks.put((event, 0))
+
+    def _deliver_webhooks(self):
+        while True:
+            job = self._webhooks.get()
+            if job is None:
+                self._webhooks.task_done()
+                return
+            event, attempt = job
+            try:
+                delivered = self._deliver(event)
+                if not delivered and attempt < self.config.webhook_retries:
+                    # Stripe backs off exponentially; seconds here instead of hours.
+                    time.sleep(min(0.25 * 2 ** attempt, 5))
+                    self._webhooks.put((event, attempt + 1))
+            finally:
+                self._webhooks.task_done()
+
+    def _deliver(self, event):
+        _pause(self.config.webhook_delay_ms)
+        if self.config.webhook_failure_rate and random.random() < self.config.webhook_failure_rate:
+            self.deliveries.append((event['type'], event['id'], 'dropped'))
+            return False
+        payload = json.dumps(event)
+        request = urllib.request.Request(
+            self.config.webhook_url,
+            data=payload.encode(),
+            headers={
+                'Content-Type': 'application/json',
+                'Stripe-Signature': sign_payload(payload, self.config.webhook_secret),
+                'User-Agent': 'Stripe/1.0 (+https://stripe.com/docs/webhooks)',
+            },
+            method='POST',
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except (urllib.error.URLError, OSError) as e:
+            self.deliveries.append((event['type'], event['id'], str(e)))
+            if self.config.verbose:
+                self.log(f"webhook {event['type']} {event['id']}: {e}")
+            return False
+        self.deliveries.append((event['type'], event['id'], status))
+        if self.config.verbose:
+            self.log(f"webhook {event['type']} {event['id']}: {status}")
+        return 200 <= status < 300
+
+    # --- HTTP ------------------------------------------------------------
+
+    def _handler_class(self):
+        emulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+            def _handle(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode() if length else ''
+                if url.path.startswith('/pay/'):
+                    return self._payment_page(method, url.path[len('/pay/'):], body)
+                params = decode_form(body if method == 'POST' else url.query)
+                try:
+                    result, status = emulator.dispatch(method, url.path, params), 200
+                except StripeAPIError as e:
+                    result, status = e.body, e.status
+                self._send(status, json.dumps(result).encode(), 'application/json', {
+                    'Request-Id': _new_id('req'), 'Stripe-Version': API_VERSION,
+                })
+
+            def _payment_page(self, method, session_id, body):
+                if method == 'POST':
+                    form = dict(parse_qsl(body))
+                    try:
+                        session = emulator.complete_checkout_session(session_id, email=form.get('email') or 'customer@example.com')
+                    except StripeAPIError as e:
+                        return self._send(e.status, e.body['error']['message'].encode(), 'text/plain')
+                    return self._send(303, b'', 'text/plain', {'Location': session['success_url'] or '/'})
+                with emulator.lock:
+                    session = emulator.sessions.get(session_id)
+                if session is None:
+                    return self._send(404, b'No such Checkout Session.', 'text/plain')
+                page = (
+                    '<!doctype html><title>Stripe emulator</title>'
+                    f'<h1>Pay {session["amount_total"] / 100:.2f} {session["currency"].upper()}</h1>'
+                    f'<p>Session {session_id} is {session["status"]}.</p>'
+                    f'<form method="post"><input name="email" value="customer@example.com">'
+                    '<button type="submit">Pay</button></form>'
+                )
+                self._send(200, page.encode(), 'text/html; charset=utf-8')
+
+            def _send(self, status, content, content_type, headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                if emulator.config.verbose:
+                    emulator.log(f'{self.command} {self.path} -> {format % args}')
+
+        return Handler
+
+
+def pay_url(session_url, email='customer@example.com'):
+    """
+    Complete a Checkout Session on the emulator, as a customer paying on the
+    hosted page would.
+    """
+    request = urllib.request.Request(session_url, data=urlencode({'email': email}).encode(), method='POST')
+    opener = urllib.request.build_opener(_NoRedirect)
+    try:
+        with opener.open(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
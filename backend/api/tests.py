@@ -0,0 +1,574 @@
+import functools
+import gzip
+import json
+import shutil
+import tempfile
+from decimal import Decimal
+from unittest import mock
+
+import stripe
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.models import QuerySet
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from rest_framework.test import APIClient
+
+from .models import Product, Customer, Address, Order, OrderItem, Cart
+from .admin import admin_site
+from .catalog import import_catalog
+from .middleware import APICompressionMiddleware, SQLCommentMiddleware
+from .payments import PaymentIntentSucceeded, cart_payment_intent
+from .pricing import quote_cart
+from .slow_queries import SlowQueryLog, SlowQueryRecorder, slow_query_log
+from .sql_tags import _append_comment
+from .stripe_emulator import sign_payload
+
+
+class OrderEndpointQueryCountTests(TestCase):
+    """
+    The OrderSerializer endpoints run the same number of queries whatever
+    the number of orders: nested customers, addresses, items and products
+    are loaded in bulk, not per order.
+    """
+    sizes = (1, 10, 100)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.products = [
+            Product.objects.create(name=f'Product {n}', price=Decimal('9.99'), stock=100)
+            for n in range(3)
+        ]
+
+    def setUp(self):
+        # Order snapshots are cached; every run must render from the database.
+        cache.clear()
+        self.client = APIClient(SERVER_NAME='localhost')
+        self.client.force_login(self.admin)
+
+    def create_orders(self, count):
+        customer = Customer.objects.create(email='buyer@example.com', name='Buyer')
+        addresses = [
+            Address.objects.create(
+                customer=customer, street_address=f'{n} Main St', city='Springfield',
+                state='IL', country='US', postal_code='62701',
+            )
+            for n in range(2)
+        ]
+        for n in range(count):
+            order = Order.objects.create(customer=customer, shipping_address=addresses[n % 2], status='pending')
+            for product in self.products[:2]:
+                OrderItem.objects.create(order=order, product=product, quantity=1, price=product.price)
+        return customer
+
+    def assertConstantQueries(self, expected, url_for):
+        for size in self.sizes:
+            with self.subTest(orders=size):
+                customer = self.create_orders(size)
+                try:
+                    with self.assertNumQueries(expected):
+                        response = self.client.get(url_for(customer))
+                    self.assertEqual(response.status_code, 200)
+                finally:
+                    Order.objects.all().delete()
+                    customer.delete()
+
+    def test_order_list(self):
+        self.assertConstantQueries(10, lambda customer: '/api/orders/')
+
+    def test_orders_by_email(self):
+        self.assertConstantQueries(9, lambda customer: '/api/orders/by_email/?email=buyer@example.com')
+
+    def test_customer_orders(self):
+        self.assertConstantQueries(10, lambda customer: f'/api/customers/{customer.pk}/orders/')
+
+    def test_dashboard_recent_orders(self):
+        self.assertConstantQueries(19, lambda customer: '/api/admin/dashboard/statistics/')
+
+
+class CartQuoteInvalidationTests(TestCase):
+    """
+    Deleting a product cascades to cart items without saving them; the
+    carts that held it must still drop their cached quotes.
+    """
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient(SERVER_NAME='localhost')
+        self.kept = Product.objects.create(name='Kept', price=Decimal('5.00'), stock=10)
+        self.deleted = Product.objects.create(name='Deleted', price=Decimal('7.50'), stock=10)
+        for product in (self.kept, self.deleted):
+            response = self.client.post('/api/cart/add_item/', {'product_id': product.pk, 'quantity': 1}, format='json')
+            self.assertEqual(response.status_code, 200)
+        self.cart = Cart.objects.get(cart_id=self.client.cookies['cart_id'].value)
+
+    def test_product_delete_bumps_cart_version(self):
+        stale = quote_cart(self.cart)
+        self.deleted.delete()
+        self.cart.refresh_from_db()
+        self.assertGreater(self.cart.version, stale.version)
+        self.assertEqual([line.product_id for line in quote_cart(self.cart).lines], [self.kept.pk])
+        self.assertEqual((self.cart.item_count, self.cart.subtotal), (1, Decimal('5.00')))
+
+    def test_checkout_after_product_delete(self):
+        quote_cart(self.cart)
+        self.deleted.delete()
+        response = self.client.post('/api/cart/checkout/', {
+            'customer_email': 'buyer@example.com',
+            'shipping_address': {'street_address': '1 Main St', 'city': 'Springfield', 'state': 'IL',
+                                 'country': 'US', 'postal_code': '62701'},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        order = Order.objects.get(pk=response.data['id'])
+        self.assertEqual(list(order.items.values_list('product_id', flat=True)), [self.kept.pk])
+        self.assertEqual(order.total_amount, Decimal('5.00'))
+
+
+@mock.patch('api.signals.schedule_variants')
+class ProductImageVariantTests(TestCase):
+    """
+    Variants are rescheduled only when a product's image changes.
+    """
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def create_product(self):
+        return Product.objects.create(
+            name='Ashtray', price=Decimal('9.99'),
+            image=SimpleUploadedFile('ashtray.png', b'not really a png', content_type='image/png'),
+        )
+
+    def test_new_image_is_scheduled(self, schedule_variants):
+        self.create_product()
+        self.assertEqual(schedule_variants.call_count, 1)
+
+    def test_other_saves_keep_pending_or_failed_variants(self, schedule_variants):
+        product = self.create_product()
+        product.name = 'Glass ashtray'
+        product.save()
+        reloaded = Product.objects.get(pk=product.pk)
+        reloaded.stock = 5
+        reloaded.save()
+        Product.objects.only('pk', 'name').get(pk=product.pk).save()
+        self.assertEqual(schedule_variants.call_count, 1)
+
+    def test_replaced_image_is_rescheduled(self, schedule_variants):
+        product = self.create_product()
+        Product.objects.filter(pk=product.pk).update(image_variants={'source': product.image.name})
+        product = Product.objects.get(pk=product.pk)
+        product.image = SimpleUploadedFile('other.png', b'another image', content_type='image/png')
+        product.save()
+        product.refresh_from_db()
+        self.assertEqual(schedule_variants.call_count, 2)
+        self.assertEqual(product.image_variants, {})
+
+
+class AdminUUIDPrefixSearchTests(TestCase):
+    """
+    A partial id, as copied from the start of a UUID, finds its rows.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        customer = Customer.objects.create(email='buyer@example.com', name='Buyer')
+        cls.orders = [Order.objects.create(customer=customer) for _ in range(3)]
+        cls.cart = Cart.objects.create(cart_id='0b6f7a3e-5c1d-4e2a-9f8b-7c6d5e4f3a2b')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def search(self, url, term):
+        response = self.client.get(url, {'q': term})
+        self.assertEqual(response.status_code, 200)
+        return list(response.context['cl'].result_list)
+
+    def test_order_id_prefix(self):
+        order = self.orders[0]
+        self.assertEqual(self.search('/admin/api/order/', order.id.hex[:8]), [order])
+        self.assertEqual(self.search('/admin/api/order/', str(order.id)[:13].upper()), [order])
+
+    def test_cart_id_prefix(self):
+        self.assertEqual(self.search('/admin/api/cart/', '0b6f7a3e-5c1d'), [self.cart])
+
+    def test_partial_and_non_uuid_cart_ids(self):
+        device_cart = Cart.objects.create(cart_id='device-abc-123')
+        self.assertEqual(self.search('/admin/api/cart/', 'device'), [device_cart])
+        self.assertEqual(self.search('/admin/api/cart/', 'device-abc-123'), [device_cart])
+        self.assertEqual(self.search('/admin/api/cart/', '0b6f'), [self.cart])
+
+    def test_hex_term_without_match_falls_through(self):
+        customer = Customer.objects.create(email='cafe@example.com', name='deadbeef')
+        order = Order.objects.create(customer=customer)
+        self.assertEqual(self.search('/admin/api/order/', 'deadbeef'), [order])
+
+
+class BootstrapCatalogTests(TestCase):
+    """
+    The cached catalog page of /api/bootstrap/ follows product changes
+    without querying the product table on every page load.
+    """
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient(SERVER_NAME='localhost')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product = Product.objects.create(name='Ashtray', sku='ash-1', price=Decimal('9.99'), stock=5)
+
+    def catalog_names(self):
+        response = self.client.get('/api/bootstrap/')
+        self.assertEqual(response.status_code, 200)
+        return [product['name'] for product in response.json()['products']['results']]
+
+    def test_warm_bootstrap_skips_the_catalog(self):
+        self.catalog_names()
+        with self.assertNumQueries(1):  # the cart row
+            self.catalog_names()
+
+    def test_product_save_and_delete(self):
+        self.assertEqual(self.catalog_names(), ['Ashtray'])
+        self.product.name = 'Glass ashtray'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertEqual(self.catalog_names(), ['Glass ashtray'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.delete()
+        self.assertEqual(self.catalog_names(), [])
+
+    def test_catalog_import(self):
+        self.assertEqual(self.catalog_names(), ['Ashtray'])
+        with self.captureOnCommitCallbacks(execute=True):
+            result = import_catalog([{'sku': 'ash-1', 'name': 'Stone ashtray'}, {'sku': 'ash-2', 'name': 'Bowl', 'price': '4.00'}])
+        self.assertTrue(result.applied)
+        self.assertEqual(self.catalog_names(), ['Bowl', 'Stone ashtray'])
+
+
+class PaymentIntentWebhookTests(TestCase):
+    """
+    A cart stops handing out its PaymentIntent's client secret once Stripe
+    reports the intent succeeded or canceled.
+    """
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient(SERVER_NAME='localhost')
+        product = Product.objects.create(name='Ashtray', price=Decimal('9.99'), stock=5)
+        self.client.post('/api/cart/add_item/', {'product_id': product.pk, 'quantity': 1}, format='json')
+        self.cart = Cart.objects.get(cart_id=self.client.cookies['cart_id'].value)
+        Cart.objects.filter(pk=self.cart.pk).update(
+            stripe_payment_intent_id='pi_test', stripe_payment_intent_client_secret='pi_test_secret',
+            stripe_payment_intent_amount=999,
+        )
+
+    def send_event(self, event_type):
+        payload = json.dumps({
+            'id': f'evt_{event_type}', 'object': 'event', 'type': event_type,
+            'data': {'object': {'id': 'pi_test', 'object': 'payment_intent', 'amount': 999, 'metadata': {}}},
+        })
+        return self.client.post('/webhook/stripe/', payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=sign_payload(payload, settings.STRIPE_WEBHOOK_SECRET))
+
+    def test_succeeded_before_checkout(self):
+        self.assertEqual(self.send_event('payment_intent.succeeded').status_code, 404)
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.stripe_payment_intent_id, 'pi_test')
+        self.assertIsNone(self.cart.stripe_payment_intent_client_secret)
+        self.assertEqual(self.client.post('/api/cart/create_payment_intent/').status_code, 409)
+
+        response = self.client.post('/api/cart/checkout/', {
+            'customer_email': 'buyer@example.com',
+            'shipping_address': {'street_address': '1 Main St', 'city': 'Springfield', 'state': 'IL',
+                                 'country': 'US', 'postal_code': '62701'},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        # Stripe's retry now finds the order.
+        self.assertEqual(self.send_event('payment_intent.succeeded').status_code, 200)
+        self.assertEqual(Order.objects.get(stripe_payment_intent_id='pi_test').status, 'paid')
+
+    def test_canceled(self):
+        self.assertEqual(self.send_event('payment_intent.canceled').status_code, 200)
+        self.cart.refresh_from_db()
+        self.assertIsNone(self.cart.stripe_payment_intent_id)
+        self.assertIsNone(self.cart.stripe_payment_intent_client_secret)
+
+
+@mock.patch.object(APICompressionMiddleware, 'get_cached_compressed', autospec=True,
+                   side_effect=lambda self, content, encoding: self.compress(content, encoding))
+class CompressionCacheTests(TestCase):
+    """
+    Only responses that are the same for every visitor are kept in the
+    compressed body cache.
+    """
+    def setUp(self):
+        self.client = APIClient(SERVER_NAME='localhost', HTTP_ACCEPT_ENCODING='gzip')
+        self.client.cookies['device_id'] = 'device'
+        self.products = [
+            Product.objects.create(name=f'Ashtray {n}', price=Decimal('9.99'), stock=5, description='Glass ' * 50)
+            for n in range(10)
+        ]
+
+    def test_catalog_is_cached(self, get_cached_compressed):
+        response = self.client.get('/api/products/')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(get_cached_compressed.call_count, 1)
+
+    def test_cart_is_not_cached(self, get_cached_compressed):
+        for product in self.products:
+            self.client.post('/api/cart/add_item/', {'product_id': product.pk, 'quantity': 1}, format='json')
+        response = self.client.get('/api/cart/current/')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response = self.client.get('/api/bootstrap/')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(get_cached_compressed.call_count, 0)
+
+    def test_per_visitor_responses_are_padded_gzip(self, get_cached_compressed):
+        for product in self.products:
+            self.client.post('/api/cart/add_item/', {'product_id': product.pk, 'quantity': 1}, format='json')
+        bodies = set()
+        for _ in range(5):
+            response = self.client.get('/api/cart/current/', HTTP_ACCEPT_ENCODING='br, gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(response.content))['total_items'], 10)
+            bodies.add(response.content)
+        # A random-length filename in the gzip header varies the length.
+        self.assertGreater(len({len(body) for body in bodies}), 1)
+
+    def test_choose_encoding_by_quality(self, get_cached_compressed):
+        choose = APICompressionMiddleware.choose_encoding
+        self.assertEqual(choose('br;q=0.1, gzip', ['br', 'gzip']), 'gzip')
+        self.assertEqual(choose('gzip;q=0.5, br', ['br', 'gzip']), 'br')
+        self.assertEqual(choose('br, gzip', ['br', 'gzip']), 'br')
+        self.assertEqual(choose('*;q=0.2, gzip;q=0', ['br', 'gzip']), 'br')
+        self.assertIsNone(choose('br', ['gzip']))
+        self.assertIsNone(choose('identity', ['br', 'gzip']))
+
+
+class CheckoutSessionWebhookTests(TestCase):
+    """
+    checkout.session.completed creates the order, its items and clears the
+    cart all or nothing, and redeliveries are acknowledged.
+    """
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient(SERVER_NAME='localhost')
+        self.product = Product.objects.create(name='Ashtray', price=Decimal('9.99'), stock=5)
+        self.client.post('/api/cart/add_item/', {'product_id': self.product.pk, 'quantity': 2}, format='json')
+        self.cart = Cart.objects.get(cart_id=self.client.cookies['cart_id'].value)
+
+    def send_event(self):
+        payload = json.dumps({
+            'id': 'evt_session', 'object': 'event', 'type': 'checkout.session.completed',
+            'data': {'object': {
+                'id': 'cs_test', 'object': 'checkout.session', 'payment_intent': 'pi_session',
+                'metadata': {'cart_id': self.cart.cart_id},
+                'customer_details': {'email': 'buyer@example.com'},
+                'shipping_details': {'address': {'line1': '1 Main St', 'city': 'Springfield', 'state': 'IL',
+                                                 'country': 'US', 'postal_code': '62701'}},
+            }},
+        })
+        return self.client.post('/webhook/stripe/', payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=sign_payload(payload, settings.STRIPE_WEBHOOK_SECRET))
+
+    def test_failure_leaves_nothing_for_the_retry_to_skip(self):
+        with mock.patch('api.views.create_order_items', side_effect=RuntimeError('boom')):
+            self.assertEqual(self.send_event().status_code, 500)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.cart.items.count(), 1)
+
+        self.assertEqual(self.send_event().status_code, 200)
+        order = Order.objects.get(stripe_checkout_session_id='cs_test')
+        self.assertEqual(order.total_amount, Decimal('19.98'))
+        self.assertEqual(order.items.count(), 1)
+        self.assertEqual(self.cart.items.count(), 0)
+
+    def test_concurrent_redelivery(self):
+        self.assertEqual(self.send_event().status_code, 200)
+        self.client.post('/api/cart/add_item/', {'product_id': self.product.pk, 'quantity': 1}, format='json')
+        # The second delivery gets past the redelivery check before the first commits.
+        exists = QuerySet.exists
+        raced = []
+
+        def racing_exists(queryset):
+            if not raced and 'stripe_checkout_session_id' in str(queryset.query):
+                raced.append(queryset)
+                return False
+            return exists(queryset)
+
+        with mock.patch.object(QuerySet, 'exists', autospec=True, side_effect=racing_exists):
+            self.assertEqual(self.send_event().status_code, 200)
+        self.assertTrue(raced)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.cart.items.count(), 1)
+
+
+@mock.patch('stripe.PaymentIntent.create', return_value=mock.Mock(id='pi_new', client_secret='pi_new_secret'))
+@mock.patch('stripe.PaymentIntent.modify',
+            side_effect=stripe.error.InvalidRequestError('This PaymentIntent could not be updated.', 'amount'))
+class CartPaymentIntentTests(TestCase):
+    """
+    An intent whose amount can't be updated is only replaced once it is
+    canceled; a paid one must never get a second client secret next to it.
+    """
+    def setUp(self):
+        self.cart = Cart.objects.create(
+            cart_id='cart', stripe_payment_intent_id='pi_old', stripe_payment_intent_client_secret='pi_old_secret',
+            stripe_payment_intent_amount=999,
+        )
+
+    def retrieve(self, status):
+        return mock.patch('stripe.PaymentIntent.retrieve', return_value=mock.Mock(status=status))
+
+    def test_succeeded_intent_is_kept(self, modify, create):
+        with self.retrieve('succeeded'), self.assertRaises(PaymentIntentSucceeded):
+            cart_payment_intent(self.cart, 1999, currency='usd')
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.stripe_payment_intent_id, 'pi_old')
+        self.assertIsNone(self.cart.stripe_payment_intent_client_secret)
+        create.assert_not_called()
+
+    def test_canceled_intent_is_replaced(self, modify, create):
+        with self.retrieve('canceled'):
+            self.assertEqual(cart_payment_intent(self.cart, 1999, currency='usd'), 'pi_new_secret')
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.stripe_payment_intent_id, 'pi_new')
+
+    def test_processing_intent_is_not_replaced(self, modify, create):
+        with self.retrieve('processing'), self.assertRaises(stripe.error.InvalidRequestError):
+            cart_payment_intent(self.cart, 1999, currency='usd')
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.stripe_payment_intent_id, 'pi_old')
+        create.assert_not_called()
+
+
+class CatalogImportValidationTests(TestCase):
+    """
+    Rows the database would reject are reported as row errors instead of
+    failing the import transaction.
+    """
+    def test_invalid_rows_are_reported(self):
+        result = import_catalog([
+            {'sku': 'ok', 'name': 'Ashtray', 'price': '9.99'},
+            [1, 2],
+            {'sku': 'nan', 'name': 'Ashtray', 'price': 'NaN'},
+            {'sku': 'big', 'name': 'Ashtray', 'price': '123456789'},
+            {'sku': 'long-name', 'name': 'A' * 201, 'price': '9.99'},
+            {'sku': 's' * 65, 'name': 'Ashtray', 'price': '9.99'},
+        ])
+        self.assertEqual([row for row, _ in result.errors], [2, 3, 4, 5, 6])
+        self.assertFalse(result.applied)
+        self.assertFalse(Product.objects.exists())
+
+
+class AdminQuerySetTests(TestCase):
+    """
+    The changelist querysets keep the model's own queryset methods.
+    """
+    def test_custom_queryset_methods(self):
+        request = RequestFactory().get('/admin/')
+        orders = admin_site._registry[Order].get_queryset(request)
+        carts = admin_site._registry[Cart].get_queryset(request)
+        self.assertEqual(list(orders.with_related()), [])
+        self.assertEqual(carts.filter(pk=0).mark_changed(), 0)
+        self.assertEqual(list(orders.dates('order_date', 'year')), [])
+
+
+class SQLCommentTests(TestCase):
+    """
+    Queries are tagged with the URL pattern, never the raw path with its ids.
+    """
+    def record_sql(self):
+        executed = []
+
+        def append_comment(execute, sql, params, many, context):
+            def record(sql, *args):
+                executed.append(sql)
+                return execute(sql, *args)
+            return _append_comment(record, sql, params, many, context)
+        return executed, mock.patch('api.sql_tags._append_comment', append_comment)
+
+    def test_route_is_the_url_pattern(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        customer = Customer.objects.create(email='buyer@example.com', name='Buyer')
+        order = Order.objects.create(customer=customer, status='pending')
+        client = APIClient(SERVER_NAME='localhost')
+        client.force_login(admin)
+        executed, recording = self.record_sql()
+        with recording:
+            response = client.get(f'/api/orders/{order.pk}/')
+        self.assertEqual(response.status_code, 200)
+        routes = {
+            sql.replace('%%', '%').rsplit("route='", 1)[-1].split("'")[0]
+            for sql in executed if "route='" in sql
+        }
+        self.assertEqual(routes, {'%2Fapi%2Forders%2F%3Cpk%3E%2F'})
+
+    def test_queries_before_resolution_are_untagged(self):
+        def get_response(request):
+            Cart.objects.filter(cart_id='device-abc').exists()
+            return HttpResponse()
+
+        executed, recording = self.record_sql()
+        with recording:
+            SQLCommentMiddleware(get_response)(RequestFactory().get('/api/cart/device-abc/'))
+        self.assertEqual(len(executed), 1)
+        self.assertNotIn('/*', executed[0])
+
+
+class SlowQueryLogTests(TestCase):
+    """
+    Slow queries are logged by fingerprint with their URL pattern and call
+    site, and served to staff as JSON.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        customer = Customer.objects.create(email='buyer@example.com', name='Buyer')
+        cls.order = Order.objects.create(customer=customer, status='pending')
+
+    def setUp(self):
+        cache.clear()
+        self.log = SlowQueryLog(50)
+        self.client = APIClient(SERVER_NAME='localhost')
+        self.client.force_login(self.admin)
+
+    def test_recorder_keeps_shapes_not_values(self):
+        request = RequestFactory().get('/api/products/')
+        with connection.execute_wrapper(SlowQueryRecorder(request, threshold_ms=0, log=self.log)):
+            Product.objects.filter(name='secret', stock__in=[1, 2, 3]).exists()
+        [entry] = self.log.entries()
+        self.assertEqual(entry['count'], 1)
+        self.assertEqual(entry['params_shape'], '(int, str, int, int, int)')
+        self.assertEqual(entry['paths'], {'GET /api/products/': 1})
+        self.assertEqual(entry['call_sites'], {})
+        self.assertNotIn('secret', json.dumps(entry, default=str))
+
+    def test_request_is_logged_under_its_url_pattern(self):
+        recorder = functools.partial(SlowQueryRecorder, threshold_ms=0, log=self.log)
+        with mock.patch('api.middleware.SlowQueryRecorder', recorder):
+            response = self.client.get(f'/api/orders/{self.order.pk}/')
+        self.assertEqual(response.status_code, 200)
+        entries = self.log.entries()
+        paths = {path for entry in entries for path in entry['paths']}
+        self.assertEqual(paths, {'GET /api/orders/<pk>/'})
+        call_sites = {site for entry in entries for site in entry['call_sites']}
+        self.assertTrue(call_sites)
+        self.assertTrue(all(site.startswith('api/views.py:') for site in call_sites), call_sites)
+
+    def test_dashboard_endpoint(self):
+        slow_query_log.clear()
+        self.addCleanup(slow_query_log.clear)
+        slow_query_log.record('SELECT * FROM api_product', None, 5.0, 'GET /api/products/', None)
+        for _ in range(3):
+            slow_query_log.record('SELECT * FROM api_order', None, 1.0, 'GET /api/orders/<pk>/', None)
+        response = self.client.get('/api/admin/dashboard/slow_queries/?order_by=count')
+        self.assertEqual(response.status_code, 200)
+        queries = response.json()['queries']
+        self.assertEqual([query['count'] for query in queries], [3, 1])
+        self.assertEqual(queries[0]['paths'], {'GET /api/orders/<pk>/': 3})
+        self.client.logout()
+        self.assertIn(self.client.get('/api/admin/dashboard/slow_queries/').status_code, (401, 403))
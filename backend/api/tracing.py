@@ -0,0 +1,444 @@
+"""
+In-process tracing.
+
+`with span('name', key=value):` times a block as a span. Spans nest through a
+context variable. Each one carries its trace id, its parent's span id and
+the request id of the request it belongs to. The data model is OpenTelemetry's
+(OTLP): ids are hex, times are unix nanoseconds, kinds and status codes
+use the OTLP numbers.
+
+TracingMiddleware opens a server span per request and a client span per
+database query. An incoming W3C `traceparent` header continues the caller's
+trace. An incoming `X-Request-ID` is kept, and a new one is made up when
+there is none. Both go back out on the response. The views add spans for
+the CartViewSet actions, serializer `.data`, Stripe calls and webhook
+handling.
+
+Finished spans go on a bounded queue; a daemon thread batches them and
+exports them as OTLP/JSON, so the request thread only pays for the queue
+put. When the queue is full, spans are dropped and counted rather than
+slowing requests down. TRACING_EXPORTER picks the destination:
+
+- 'file': one ExportTraceServiceRequest per line appended to TRACING_FILE.
+- 'otlp': POST to an OTLP/HTTP collector at TRACING_ENDPOINT
+  (e.g. http://localhost:4318/v1/traces).
+- '' (default): tracing is off and span() costs one check.
+"""
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from django.conf import settings
+
+logger = logging.getLogger('api.tracing')
+
+EXPORTER = getattr(settings, 'TRACING_EXPORTER', '')
+SERVICE_NAME = getattr(settings, 'TRACING_SERVICE_NAME', 'ashtray-backend')
+QUEUE_SIZE = getattr(settings, 'TRACING_QUEUE_SIZE', 2048)
+BATCH_SIZE = getattr(settings, 'TRACING_BATCH_SIZE', 512)
+EXPORT_INTERVAL = getattr(settings, 'TRACING_EXPORT_INTERVAL', 2.0)  # seconds
+MAX_STATEMENT_LENGTH = 1000
+
+# OTLP Span.SpanKind
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+# OTLP Status.StatusCode
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = 0, 1, 2
+
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+_REQUEST_ID = re.compile(r'^[\w.:+/=-]{1,128}$')
+
+_current = contextvars.ContextVar('tracing_span', default=None)
+
+
+def enabled():
+    return EXPORTER in ('file', 'otlp')
+
+
+def new_trace_id():
+    return f'{random.getrandbits(128):032x}'
+
+
+def new_span_id():
+    return f'{random.getrandbits(64):016x}'
+
+
+def parse_traceparent(value):
+    """
+    (trace id, parent span id) from a W3C traceparent header, or None.
+    """
+    match = _TRACEPARENT.match((value or '').strip().lower())
+    if match is None or set(match.group(1)) == {'0'} or set(match.group(2)) == {'0'}:
+        return None
+    return match.group(1), match.group(2)
+
+
+def clean_request_id(value):
+    """
+    The incoming X-Request-ID if it is a sane token, else a new one.
+    """
+    if value and _REQUEST_ID.match(value):
+        return value
+    return new_span_id() + new_span_id()
+
+
+class Span:
+    """
+    One timed operation. Ended spans are immutable and handed to the exporter.
+    """
+    __slots__ = (
+        'trace_id', 'span_id', 'parent_span_id', 'name', 'kind', 'request_id',
+        'start_time', 'end_time', 'attributes', 'events', 'status_code', 'status_message',
+    )
+
+    def __init__(self, name, kind=INTERNAL, parent=None, trace_id=None, parent_span_id=None,
+                 request_id=None, attributes=None):
+        if parent is not None:
+            trace_id, parent_span_id = parent.trace_id, parent.span_id
+            request_id = request_id or parent.request_id
+        self.trace_id = trace_id or new_trace_id()
+        self.span_id = new_span_id()
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.kind = kind
+        self.request_id = request_id
+        self.attributes = attributes or {}
+        self.events = []
+        self.status_code = STATUS_UNSET
+        self.status_message = ''
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    @property
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_status(self, code, message=''):
+        self.status_code = code
+        self.status_message = message
+
+    def record_exception(self, exc):
+        self.events.append((time.time_ns(), 'exception', {
+            'exception.type': type(exc).__name__,
+            'exception.message': str(exc),
+        }))
+        self.set_status(STATUS_ERROR, str(exc))
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            processor.enqueue(self)
+
+    def to_otlp(self):
+        attributes = dict(self.attributes)
+        if self.request_id:
+            attributes['request.id'] = self.request_id
+        data = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_time),
+            'endTimeUnixNano': str(self.end_time),
+            'attributes': encode_attributes(attributes),
+            'status': {'code': self.status_code},
+        }
+        if self.parent_span_id:
+            data['parentSpanId'] = self.parent_span_id
+        if self.status_message:
+            data['status']['message'] = self.status_message
+        if self.events:
+            data['events'] = [
+                {'timeUnixNano': str(at), 'name': name, 'attributes': encode_attributes(attrs)}
+                for at, name, attrs in self.events
+            ]
+        return data
+
+
+class _NoopSpan:
+    """
+    Stands in for a span while tracing is off.
+    """
+    trace_id = span_id = request_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_status(self, code, message=''):
+        pass
+
+    def record_exception(self, exc):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _NoopContext:
+    def __enter__(self):
+        return NOOP_SPAN
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_CONTEXT = _NoopContext()
+
+
+class _SpanContext:
+    def __init__(self, span):
+        self.span = span
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.span.record_exception(exc)
+        _current.reset(self._token)
+        self.span.end()
+        return False
+
+
+def current_span():
+    """
+    The innermost open span, or a no-op one outside any span.
+    """
+    return _current.get() or NOOP_SPAN
+
+
+def span(name, kind=INTERNAL, **attributes):
+    """
+    Time the block as a child of the current span:
+
+        with span('quote_cart', cart_id=cart.cart_id) as s:
+            ...
+            s.set_attribute('items', n)
+
+    Outside a traced request (or with tracing off) it does nothing.
+    """
+    parent = _current.get()
+    if parent is None:
+        return _NOOP_CONTEXT
+    return _SpanContext(Span(name, kind, parent=parent, attributes=attributes))
+
+
+def start_trace(name, kind=SERVER, traceparent=None, request_id=None, **attributes):
+    """
+    Open a root span, continuing the caller's trace when `traceparent` is valid.
+    """
+    if not enabled():
+        return _NOOP_CONTEXT
+    parent = parse_traceparent(traceparent)
+    trace_id, parent_span_id = parent if parent else (None, None)
+    return _SpanContext(Span(
+        name, kind, trace_id=trace_id, parent_span_id=parent_span_id,
+        request_id=request_id, attributes=attributes,
+    ))
+
+
+def traced(name=None, kind=INTERNAL):
+    """
+    Decorate a function to run inside a span named after it.
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stripe_call(operation, **attributes):
+    """
+    Client span around one Stripe API request, e.g. stripe_call('PaymentIntent.create').
+    """
+    return span(f'stripe {operation}', CLIENT, **{'rpc.system': 'stripe', 'rpc.method': operation, **attributes})
+
+
+def query_span(execute, sql, params, many, context):
+    """
+    Execute wrapper running each query in a client span.
+    """
+    parent = _current.get()
+    if parent is None:
+        return execute(sql, params, many, context)
+    operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'QUERY'
+    with _SpanContext(Span(f'db {operation}', CLIENT, parent=parent, attributes={
+        'db.system': context['connection'].vendor,
+        'db.operation': operation,
+        'db.statement': sql[:MAX_STATEMENT_LENGTH],
+    })) as query:
+        if many:
+            query.set_attribute('db.executemany', True)
+        return execute(sql, params, many, context)
+
+
+def encode_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}  # int64 is a string in OTLP/JSON
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def encode_attributes(attributes):
+    return [
+        {'key': key, 'value': encode_value(value)}
+        for key, value in attributes.items() if value is not None
+    ]
+
+
+def export_request(spans):
+    """
+    An OTLP ExportTraceServiceRequest, as JSON-ready dicts, for `spans`.
+    """
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': encode_attributes({
+                'service.name': SERVICE_NAME,
+                'process.pid': os.getpid(),
+            })},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': [span.to_otlp() for span in spans],
+            }],
+        }],
+    }
+
+
+class FileExporter:
+    """
+    Append each batch to `path` as one line of OTLP/JSON.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        line = json.dumps(export_request(spans), separators=(',', ':'))
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+
+class OTLPHTTPExporter:
+    """
+    POST each batch to an OTLP/HTTP collector as JSON.
+    """
+    def __init__(self, endpoint, timeout=5):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def export(self, spans):
+        body = json.dumps(export_request(spans), separators=(',', ':')).encode()
+        request = urllib.request.Request(
+            self.endpoint, data=body, method='POST', headers={'Content-Type': 'application/json'},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+def make_exporter():
+    if EXPORTER == 'file':
+        return FileExporter(getattr(settings, 'TRACING_FILE', 'traces.jsonl'))
+    if EXPORTER == 'otlp':
+        return OTLPHTTPExporter(getattr(settings, 'TRACING_ENDPOINT', 'http://localhost:4318/v1/traces'))
+    return None
+
+
+class BatchSpanProcessor:
+    """
+    Queue of ended spans drained by a daemon thread, which exports them in
+    batches of up to `batch_size` at least every `interval` seconds.
+    """
+    def __init__(self, exporter_factory, queue_size, batch_size, interval):
+        self.exporter_factory = exporter_factory
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self.exported = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def enqueue(self, span):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=10):
+        """
+        Export everything queued so far; returns False on timeout.
+        """
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def _ensure_started(self):
+        # Forked workers inherit the object but not the thread.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, args=(self.exporter_factory(),),
+                                            daemon=True, name='span-exporter')
+            self._thread.start()
+            self._pid = os.getpid()
+        atexit.register(self.flush, timeout=2)
+
+    def _run(self, exporter):
+        batch = []
+        deadline = time.monotonic() + self.interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+            flush = isinstance(item, threading.Event)
+            if isinstance(item, Span):
+                batch.append(item)
+            if batch and (flush or item is None or len(batch) >= self.batch_size):
+                self._export(exporter, batch)
+                batch = []
+            if flush:
+                item.set()
+            if item is None or not batch:
+                deadline = time.monotonic() + self.interval
+
+    def _export(self, exporter, batch):
+        try:
+            exporter.export(batch)
+        except (OSError, urllib.error.URLError, ValueError) as e:
+            logger.warning("Could not export %d spans: %s", len(batch), e)
+        else:
+            self.exported += len(batch)
+
+
+processor = BatchSpanProcessor(make_exporter, QUEUE_SIZE, BATCH_SIZE, EXPORT_INTERVAL)
@@ -25,6 +25,7 @@ urlpatterns = [
     # It does NOT automatically generate the /cart/add_item/ style routes from @actions like DefaultRouter.
     # We need to explicitly add paths for the @action methods if SimpleRouter is used.
     path('cart/current', views.CartViewSet.as_view({'get': 'current'}), name='cart-current'),
+    path('cart/summary', views.CartViewSet.as_view({'get': 'summary'}), name='cart-summary'),
     path('cart/add_item', views.CartViewSet.as_view({'post': 'add_item'}), name='cart-add-item'),
     path('cart/update_item', views.CartViewSet.as_view({'post': 'update_item'}), name='cart-update-item'),
     path('cart/remove_item', views.CartViewSet.as_view({'post': 'remove_item'}), name='cart-remove-item'),
@@ -33,6 +34,10 @@ urlpatterns = [
     path('cart/create_payment_intent', views.CartViewSet.as_view({'post': 'create_payment_intent'}), name='cart-create-payment-intent'),
     path('cart/checkout', views.CartViewSet.as_view({'post': 'checkout'}), name='cart-checkout'),
 
+    # Catalog, cart and Stripe key for the storefront's first paint
+    path('bootstrap/', views.bootstrap, name='bootstrap'),
+    path('bootstrap', views.bootstrap),
+
     # Add Stripe webhook path explicitly
     path('stripe-webhook/', views.stripe_webhook, name='stripe-webhook'),
 
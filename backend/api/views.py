@@ -3,9 +3,13 @@ import sys
 import uuid
 import stripe
 from rest_framework import viewsets, permissions, status
+from rest_framework.pagination import CursorPagination
+from rest_framework.parsers import FormParser, MultiPartParser
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
-from rest_framework.decorators import action, api_view, authentication_classes, permission_classes
+from rest_framework.decorators import action, api_view, authentication_classes, permission_classes, renderer_classes
 from django.contrib.auth.models import User
+from django.db import IntegrityError, models, transaction
 from django.http import HttpResponse
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
@@ -16,12 +20,25 @@ from django.views.decorators.csrf import csrf_exempt
 from rest_framework.permissions import AllowAny
 from decimal import Decimal
 
-from .models import Product, Customer, Address, Order, OrderItem, Cart, CartItem
+from .models import Product, Customer, Address, Order, OrderItem, Cart, CartItem, normalize_email
 from .serializers import (
     ProductSerializer, CustomerSerializer, AddressSerializer,
     OrderSerializer, OrderItemSerializer, CartSerializer, CartItemSerializer,
     UserSerializer
 )
+from .images import best_variant_url
+from .pricing import quote_cart, create_order_items
+from .payments import (
+    PaymentIntentSucceeded, cart_payment_intent, finish_payment_intent, release_payment_intent,
+    params_hash, reusable_checkout_session, remember_checkout_session, forget_checkout_session,
+)
+from .fast_serializers import ProductValuesSerializer, CartValuesSerializer
+from .order_cache import render_orders
+from .query_budget import query_budget
+from .bootstrap import cart_fragment, catalog_fragment
+from .renderers import ORJSONRenderer, ORJSONParser
+from .tracing import span, stripe_call
+from .slow_queries import ORDERINGS as SLOW_QUERY_ORDERINGS, THRESHOLD_MS as SLOW_QUERY_THRESHOLD_MS, slow_query_log
 
 
 class IsAdminUser(permissions.BasePermission):
@@ -40,6 +57,8 @@ class ProductViewSet(viewsets.ModelViewSet):
     """
     queryset = Product.objects.filter(active=True)
     serializer_class = ProductSerializer
+    renderer_classes = [ORJSONRenderer, BrowsableAPIRenderer]
+    parser_classes = [ORJSONParser, FormParser, MultiPartParser]
     
     def get_permissions(self):
         """
@@ -51,6 +70,23 @@ class ProductViewSet(viewsets.ModelViewSet):
         else:
             permission_classes = [permissions.AllowAny]
         return [permission() for permission in permission_classes]
+    
+    def list(self, request, *args, **kwargs):
+        """
+        List products from .values() rows through the compiled serializer.
+        Only the columns named in ?fields= are selected.
+        """
+        fields = request.query_params.get('fields')
+        serializer = ProductValuesSerializer(
+            fields=fields.split(',') if fields else None,
+            context=self.get_serializer_context()
+        )
+        queryset = self.filter_queryset(self.get_queryset()).values(*serializer.columns)
+        
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer.render_many(page))
+        return Response(serializer.render_many(queryset))
 
 
 class CustomerViewSet(viewsets.ModelViewSet):
@@ -63,12 +99,12 @@ class CustomerViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAdminUser]
     
     @action(detail=True, methods=['get'])
+    @query_budget(8)
     def orders(self, request, pk=None):
         """Get orders for a specific customer."""
         customer = self.get_object()
         orders = Order.objects.filter(customer=customer)
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+        return Response(render_orders(list(orders), self.get_serializer_context()))
 
 
 class AddressViewSet(viewsets.ModelViewSet):
@@ -85,8 +121,10 @@ class AddressViewSet(viewsets.ModelViewSet):
         """Get addresses by customer email."""
         email = request.query_params.get('email', None)
         if email:
-            customer = get_object_or_404(Customer, email=email)
-            addresses = Address.objects.filter(customer=customer)
+            # One query through the join; only an empty result needs the customer check.
+            addresses = list(Address.objects.filter(customer__email_normalized=normalize_email(email)))
+            if not addresses:
+                get_object_or_404(Customer.objects.by_email(email))
             serializer = self.get_serializer(addresses, many=True)
             return Response(serializer.data)
         return Response(
@@ -95,6 +133,16 @@ class AddressViewSet(viewsets.ModelViewSet):
         )
 
 
+class OrderHistoryPagination(CursorPagination):
+    """
+    Newest first. Cursors stay stable while new orders come in.
+    """
+    ordering = '-order_date'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
 class OrderViewSet(viewsets.ModelViewSet):
     """
     API endpoint for orders.
@@ -115,18 +163,106 @@ class OrderViewSet(viewsets.ModelViewSet):
             permission_classes = [IsAdminUser]
         return [permission() for permission in permission_classes]
     
+    @query_budget(8)
+    def list(self, request, *args, **kwargs):
+        """
+        Read actions render through the order snapshot cache, which loads the
+        related data only for the orders it has to serialize.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(render_orders(page, self.get_serializer_context()))
+        return Response(render_orders(list(queryset), self.get_serializer_context()))
+    
+    @query_budget(6)
+    def retrieve(self, request, *args, **kwargs):
+        return Response(render_orders([self.get_object()], self.get_serializer_context())[0])
+    
     @action(detail=False, methods=['get'])
+    @query_budget(6)
     def by_email(self, request):
         """Get orders by customer email."""
         email = request.query_params.get('email', None)
         if email:
-            orders = Order.objects.filter(customer__email=email)
-            serializer = self.get_serializer(orders, many=True)
-            return Response(serializer.data)
+            orders = self.get_queryset().filter(customer__email_normalized=normalize_email(email))
+            return Response(render_orders(list(orders), self.get_serializer_context()))
         return Response(
             {"error": "Customer email parameter is required"}, 
             status=status.HTTP_400_BAD_REQUEST
         )
+    
+    @action(detail=False, methods=['get'], pagination_class=OrderHistoryPagination)
+    @query_budget(8)
+    def history(self, request):
+        """
+        A customer's orders by email, newest first, one cursor page at a time.
+        Delivered and cancelled orders come from the order cache.
+        """
+        email = request.query_params.get('email', None)
+        if not email:
+            return Response(
+                {"error": "Customer email parameter is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        customer = get_object_or_404(Customer.objects.by_email(email))
+        # Walks the (customer, -order_date) index; related data is loaded
+        # only for the orders render_orders() has to serialize.
+        orders = self.paginate_queryset(Order.objects.filter(customer=customer))
+        return self.get_paginated_response(render_orders(orders, self.get_serializer_context()))
+
+
+def get_cart(request):
+    """
+    Get the cart from the cookie or create a new one. Returns (cart, created).
+    Avoids creating a customer based solely on device_id to prevent IntegrityError.
+    """
+    cart_id = request.COOKIES.get('cart_id', None)
+    print(f"[DEBUG get_cart] Received cart_id from cookie: {cart_id}")
+    cart = None
+    created = False
+
+    if cart_id:
+        # Try to fetch existing cart
+        try:
+            cart = Cart.objects.get(cart_id=cart_id)
+            print(f"[DEBUG get_cart] Found/Created cart with DB ID: {cart.pk}, Cart ID: {cart.cart_id}")
+        except Cart.DoesNotExist:
+            # If cart with this ID doesn't exist, log the issue and create a new one below
+            print(f"Cart with ID {cart_id} from cookie not found in database. Creating new cart.")
+            cart_id = None # Force creation of a new cart ID
+
+    if not cart:
+        # Generate a new cart ID and create the cart
+        cart_id = str(uuid.uuid4())
+        cart = Cart.objects.create(cart_id=cart_id)
+        created = True
+        # We don't associate customer here based on device_id anymore
+
+    if cart:
+         print(f"[DEBUG get_cart] Found/Created cart with DB ID: {cart.pk}, Cart ID: {cart.cart_id}")
+    else:
+         print(f"[DEBUG get_cart] Cart object is None after lookup/creation attempt.")
+    return cart, created
+
+
+def set_cart_cookie(response, cart_id):
+    """
+    Set the cart_id cookie with proper settings based on environment
+    """
+    secure = True  # True for all environments
+    samesite = 'None'  # None for cross-site cookies
+
+    response.set_cookie(
+        'cart_id',
+        cart_id,
+        max_age=30*24*60*60,  # 30 days
+        httponly=False,  # Allow JavaScript access
+        samesite=samesite,
+        secure=secure,
+        path='/',  # Available across the site
+    )
+    return response
 
 
 class CartViewSet(viewsets.ModelViewSet):
@@ -136,9 +272,19 @@ class CartViewSet(viewsets.ModelViewSet):
     """
     serializer_class = CartSerializer
     permission_classes = [permissions.AllowAny]
+    renderer_classes = [ORJSONRenderer, BrowsableAPIRenderer]
+    parser_classes = [ORJSONParser, FormParser, MultiPartParser]
     
     def get_queryset(self):
-        return Cart.objects.all()
+        return Cart.objects.prefetch_related(
+            models.Prefetch('items', queryset=CartItem.objects.select_related('product'))
+        )
+    
+    def get_serializer(self, *args, **kwargs):
+        # CartSerializer renders every item's product; load them up front.
+        if args and isinstance(args[0], Cart):
+            args[0].prefetch_items()
+        return super().get_serializer(*args, **kwargs)
     
     def get_permissions(self):
         """
@@ -162,62 +308,38 @@ class CartViewSet(viewsets.ModelViewSet):
             response["Access-Control-Allow-Headers"] = "accept, accept-encoding, authorization, content-type, dnt, origin, user-agent, x-csrftoken, x-requested-with"
             return response
             
-        return super().dispatch(request, *args, **kwargs)
+        action_name = self.action_map.get(request.method.lower(), request.method.lower())
+        with span(f'CartViewSet.{action_name}', **{'cart.action': action_name}) as action_span:
+            response = super().dispatch(request, *args, **kwargs)
+            action_span.set_attribute('http.response.status_code', response.status_code)
+        return response
     
     def get_cart(self, request):
-        """
-        Get the cart from the cookie or create a new one.
-        Avoids creating a customer based solely on device_id to prevent IntegrityError.
-        """
-        cart_id = request.COOKIES.get('cart_id', None)
-        print(f"[DEBUG get_cart] Received cart_id from cookie: {cart_id}")
-        cart = None
-        created = False
-
-        if cart_id:
-            # Try to fetch existing cart
-            try:
-                cart = Cart.objects.get(cart_id=cart_id)
-                print(f"[DEBUG get_cart] Found/Created cart with DB ID: {cart.pk}, Cart ID: {cart.cart_id}")
-            except Cart.DoesNotExist:
-                # If cart with this ID doesn't exist, log the issue and create a new one below
-                print(f"Cart with ID {cart_id} from cookie not found in database. Creating new cart.")
-                cart_id = None # Force creation of a new cart ID
-
-        if not cart:
-            # Generate a new cart ID and create the cart
-            cart_id = str(uuid.uuid4())
-            cart = Cart.objects.create(cart_id=cart_id)
-            created = True
-            # We don't associate customer here based on device_id anymore
-
-        if cart:
-             print(f"[DEBUG get_cart] Found/Created cart with DB ID: {cart.pk}, Cart ID: {cart.cart_id}")
-        else:
-             print(f"[DEBUG get_cart] Cart object is None after lookup/creation attempt.")
-        return cart, created
+        return get_cart(request)
     
     def set_cart_cookie(self, response, cart_id):
+        return set_cart_cookie(response, cart_id)
+    
+    @action(detail=False, methods=['get'])
+    def summary(self, request):
         """
-        Helper method to set cart_id cookie with proper settings based on environment
+        Item count and subtotal of the current cart, for the header badge.
+        One lookup by cart_id reading the counters mark_changed() keeps; it
+        never creates a cart, so it is cheap to poll.
         """
-        from django.conf import settings
-        
-        secure = True  # True for all environments
-        samesite = 'None'  # None for cross-site cookies
-        
-        response.set_cookie(
-            'cart_id',
-            cart_id,
-            max_age=30*24*60*60,  # 30 days
-            httponly=False,  # Allow JavaScript access
-            samesite=samesite,
-            secure=secure,
-            path='/',  # Available across the site
-        )
-        return response
+        cart_id = request.COOKIES.get('cart_id')
+        summary = None
+        if cart_id:
+            summary = Cart.objects.filter(cart_id=cart_id).values(
+                'cart_id', 'item_count', 'subtotal', 'version',
+            ).first()
+        if summary is None:
+            summary = {'cart_id': None, 'item_count': 0, 'subtotal': Decimal('0.00'), 'version': None}
+        summary['subtotal'] = f"{summary['subtotal']:.2f}"
+        return Response(summary)
     
     @action(detail=False, methods=['get'])
+    @query_budget(5)
     def current(self, request):
         """
         Get or create the current cart for this user.
@@ -226,13 +348,17 @@ class CartViewSet(viewsets.ModelViewSet):
             print("[DEBUG current] Starting current cart method in ViewSet")
             cart, created = self.get_cart(request)
             if cart:
-                print(f"[DEBUG current] Cart state before serialization: ID={cart.cart_id}, Items Count={cart.items.count()}")
-                for item in cart.items.all():
-                    print(f"  - Item: {item.product.name}, Qty: {item.quantity}")
+                print(f"[DEBUG current] Cart state before serialization: ID={cart.cart_id}")
             else:
                 print("[DEBUG current] Cart object is None after get_cart.")
-            serializer = self.get_serializer(cart)
-            response = Response(serializer.data)
+            
+            # Sparse responses go through the regular serializer; the full
+            # cart is rendered by the compiled fast path.
+            if 'fields' in request.query_params or 'expand' in request.query_params:
+                data = self.get_serializer(cart).data
+            else:
+                data = CartValuesSerializer(context=self.get_serializer_context()).render(cart)
+            response = Response(data)
             
             # Set cookie using the helper method
             return self.set_cart_cookie(response, cart.cart_id)
@@ -249,6 +375,7 @@ class CartViewSet(viewsets.ModelViewSet):
             })
     
     @action(detail=False, methods=['post'])
+    @query_budget(16)
     def add_item(self, request):
         """
         Add an item to the cart.
@@ -274,24 +401,27 @@ class CartViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        # Get or create cart item
-        cart_item, cart_item_created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': quantity}
-        )
-        
-        # If the item already exists, update its quantity
-        if not cart_item_created:
-            cart_item.quantity += quantity
-        
-        print(f"[DEBUG add_item] Attempting to save CartItem: Product={product.id}, Qty={cart_item.quantity}, Cart ID={cart.cart_id}")
-        cart_item.save()
+        # The item write and the cart's counters (mark_changed) commit together
+        with transaction.atomic():
+            # Get or create cart item
+            cart_item, cart_item_created = CartItem.objects.get_or_create(
+                cart=cart,
+                product=product,
+                defaults={'quantity': quantity}
+            )
+            
+            # If the item already exists, update its quantity
+            if not cart_item_created:
+                cart_item.quantity += quantity
+            
+            print(f"[DEBUG add_item] Attempting to save CartItem: Product={product.id}, Qty={cart_item.quantity}, Cart ID={cart.cart_id}")
+            cart_item.save()
+            cart.mark_changed()
         print(f"[DEBUG add_item] CartItem saved. Verifying cart state from DB...")
         
         # Explicitly refresh cart from DB and check items
         cart.refresh_from_db()
-        items_in_cart = cart.items.all()
+        items_in_cart = cart.prefetch_items().items.all()
         print(f"[DEBUG add_item] Cart state post-save: ID={cart.cart_id}, Items Count={items_in_cart.count()}")
         for item in items_in_cart:
             print(f"  - Item: {item.product.name}, Qty: {item.quantity}")
@@ -306,6 +436,7 @@ class CartViewSet(viewsets.ModelViewSet):
         return self.set_cart_cookie(response, cart.cart_id)
     
     @action(detail=False, methods=['post'])
+    @query_budget(12)
     def update_item(self, request):
         """
         Update an item's quantity in the cart.
@@ -333,11 +464,13 @@ class CartViewSet(viewsets.ModelViewSet):
             )
         
         # Update quantity or remove if quantity is 0
-        if quantity > 0:
-            cart_item.quantity = quantity
-            cart_item.save()
-        else:
-            cart_item.delete()
+        with transaction.atomic():
+            if quantity > 0:
+                cart_item.quantity = quantity
+                cart_item.save()
+            else:
+                cart_item.delete()
+            cart.mark_changed()
         
         # Return the updated cart
         cart_serializer = self.get_serializer(cart)
@@ -347,6 +480,7 @@ class CartViewSet(viewsets.ModelViewSet):
         return self.set_cart_cookie(response, cart.cart_id)
     
     @action(detail=False, methods=['post'])
+    @query_budget(12)
     def remove_item(self, request):
         """
         Remove an item from the cart.
@@ -371,7 +505,9 @@ class CartViewSet(viewsets.ModelViewSet):
             )
         
         # Remove the item from the cart
-        cart_item.delete()
+        with transaction.atomic():
+            cart_item.delete()
+            cart.mark_changed()
         
         # Return the updated cart
         cart_serializer = self.get_serializer(cart)
@@ -381,12 +517,15 @@ class CartViewSet(viewsets.ModelViewSet):
         return self.set_cart_cookie(response, cart.cart_id)
     
     @action(detail=False, methods=['post'])
+    @query_budget(10)
     def clear(self, request):
         """
         Clear all items from the cart.
         """
         cart, _ = self.get_cart(request)
-        CartItem.objects.filter(cart=cart).delete()
+        with transaction.atomic():
+            CartItem.objects.filter(cart=cart).delete()
+            cart.mark_changed()
         
         # Return the empty cart
         cart_serializer = self.get_serializer(cart)
@@ -401,22 +540,18 @@ class CartViewSet(viewsets.ModelViewSet):
         Creates a Stripe PaymentIntent for the current cart.
         Expects cart_id to be in cookies or creates a new cart.
         Calculates total amount based on cart items.
-        Returns the client_secret for the PaymentIntent.
+        Returns the client_secret for the PaymentIntent. The cart keeps
+        its intent, so repeat calls reuse it and only update the amount.
         """
         try:
             cart, _ = self.get_cart(request)
-            cart_items = CartItem.objects.filter(cart=cart)
+            quote = quote_cart(cart)
 
-            if not cart_items.exists():
+            if quote.is_empty:
                 return Response({"error": "Cart is empty"}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Calculate total amount in cents
-            total_amount = 0
-            for item in cart_items:
-                # Ensure price is converted to cents correctly
-                # Assuming item.product.price is in dollars (e.g., Decimal or float)
-                item_price_cents = int(item.product.price * 100) 
-                total_amount += item.quantity * item_price_cents
+            # Total amount in cents
+            total_amount = quote.total_amount
 
             if total_amount <= 0:
                  return Response({"error": "Invalid cart total"}, status=status.HTTP_400_BAD_REQUEST)
@@ -424,10 +559,11 @@ class CartViewSet(viewsets.ModelViewSet):
             # Initialize Stripe
             stripe.api_key = settings.STRIPE_SECRET_KEY
 
-            # Create a PaymentIntent with the order amount and currency
-            intent = stripe.PaymentIntent.create(
-                amount=total_amount,
-                currency='usd',  # Or get from settings/request
+            # Get (or create) the cart's PaymentIntent with the order amount and currency
+            client_secret = cart_payment_intent(
+                cart,
+                total_amount,
+                currency=quote.currency,
                 # Add metadata if needed, e.g., linking to your Cart or Order ID
                 metadata={
                     'cart_id': cart.cart_id,
@@ -436,9 +572,11 @@ class CartViewSet(viewsets.ModelViewSet):
             )
 
             return Response({
-                'clientSecret': intent.client_secret
+                'clientSecret': client_secret
             })
 
+        except PaymentIntentSucceeded:
+            return Response({"error": "This cart has already been paid for."}, status=status.HTTP_409_CONFLICT)
         except Product.DoesNotExist:
              return Response({"error": "A product in the cart was not found."}, status=status.HTTP_404_NOT_FOUND)
         except Cart.DoesNotExist:
@@ -478,9 +616,9 @@ class CartViewSet(viewsets.ModelViewSet):
             print(f"Stripe Key: {settings.STRIPE_SECRET_KEY[:4]}...{settings.STRIPE_SECRET_KEY[-4:] if settings.STRIPE_SECRET_KEY else 'None'}")
             
             cart, _ = self.get_cart(request)
-            cart_items = CartItem.objects.filter(cart=cart)
+            quote = quote_cart(cart)
 
-            if not cart_items.exists():
+            if quote.is_empty:
                 return Response({"error": "Cart is empty"}, status=status.HTTP_400_BAD_REQUEST)
 
             # Get success and cancel URLs from the frontend
@@ -497,14 +635,16 @@ class CartViewSet(viewsets.ModelViewSet):
             if not stripe.api_key or settings.STRIPE_SECRET_KEY == 'sk_test_placeholder':
                 return Response({"error": "Stripe API key not configured"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            # Prepare line items for Stripe Checkout
+            # Prepare line items for Stripe Checkout; prices come from the quote,
+            # descriptions and images from the products
+            products = Product.objects.in_bulk([line.product_id for line in quote.lines])
             line_items = []
-            for item in cart_items:
-                product = item.product
+            for line in quote.lines:
+                product = products[line.product_id]
                 
                 # Prepare product data
                 product_data = {
-                    'name': product.name,
+                    'name': line.name,
                 }
                 
                 # Add description if available
@@ -515,8 +655,8 @@ class CartViewSet(viewsets.ModelViewSet):
                 images = []
                 if product.image and hasattr(product.image, 'url'):
                     try:
-                        # Use a simple approach for production
-                        image_url = product.image.url
+                        # Send Stripe a 640px derivative rather than the original upload
+                        image_url = best_variant_url(product.image_variants, 640) or product.image.url
                         if not image_url.startswith(('http://', 'https://')):
                             # Use a default image if the URL is relative
                             image_url = "https://placehold.co/400x300?text=Product+Image"
@@ -530,15 +670,14 @@ class CartViewSet(viewsets.ModelViewSet):
                 # Create the line item
                 line_items.append({
                     'price_data': {
-                        'currency': 'usd',
+                        'currency': quote.currency,
                         'product_data': product_data,
-                        'unit_amount': int(product.price * 100),  # Convert to cents
+                        'unit_amount': line.unit_amount,  # In cents
                     },
-                    'quantity': item.quantity,
+                    'quantity': line.quantity,
                 })
 
-            # Create checkout session
-            checkout_session = stripe.checkout.Session.create(
+            session_params = dict(
                 payment_method_types=['card'],
                 line_items=line_items,
                 mode='payment',
@@ -551,6 +690,21 @@ class CartViewSet(viewsets.ModelViewSet):
                     'allowed_countries': ['US', 'CA', 'GB', 'AU'],  # Add countries you ship to
                 },
             )
+            
+            # Same cart contents as the open session: hand that one out again
+            digest = params_hash(session_params)
+            reusable = reusable_checkout_session(cart, digest)
+            if reusable:
+                session_id, checkout_url = reusable
+                return Response({
+                    'checkout_url': checkout_url,
+                    'session_id': session_id
+                })
+
+            # Create checkout session
+            with stripe_call('checkout.Session.create'):
+                checkout_session = stripe.checkout.Session.create(**session_params)
+            remember_checkout_session(cart, checkout_session, digest)
 
             # Return the checkout session URL to the frontend
             return Response({
@@ -574,13 +728,15 @@ class CartViewSet(viewsets.ModelViewSet):
             return Response({"error": f"An unexpected error occurred: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     @action(detail=False, methods=['post'])
+    @query_budget(40)
     def checkout(self, request):
         """
         Create an order from the cart.
         """
         cart, _ = self.get_cart(request)
+        quote = quote_cart(cart)
         
-        if not cart.items.exists():
+        if quote.is_empty:
             return Response(
                 {"error": "Cannot checkout an empty cart"}, 
                 status=status.HTTP_400_BAD_REQUEST
@@ -597,8 +753,8 @@ class CartViewSet(viewsets.ModelViewSet):
             )
         
         # Get or create customer
-        customer, created = Customer.objects.get_or_create(
-            email=email,
+        customer, created = Customer.objects.upsert_by_email(
+            email,
             defaults={'device': request.COOKIES.get('device_id')}
         )
         
@@ -615,8 +771,8 @@ class CartViewSet(viewsets.ModelViewSet):
                 cart.save()
         
         # Create or get the shipping address
-        shipping_address, _ = Address.objects.get_or_create(
-            customer=customer,
+        shipping_address, _ = Address.objects.upsert(
+            customer,
             street_address=shipping_address_data.get('street_address'),
             apartment_address=shipping_address_data.get('apartment_address', ''),
             city=shipping_address_data.get('city'),
@@ -626,35 +782,27 @@ class CartViewSet(viewsets.ModelViewSet):
             defaults={'default': shipping_address_data.get('default', False)}
         )
         
-        # Create order
+        # Create order, taking over the cart's PaymentIntent so the
+        # payment_intent.succeeded webhook can find it by id
         order = Order.objects.create(
             customer=customer,
             shipping_address=shipping_address,
             status='pending',
-            notes=request.data.get('notes', '')
+            notes=request.data.get('notes', ''),
+            stripe_payment_intent_id=cart.stripe_payment_intent_id,
         )
+        release_payment_intent(cart)
         
-        # Create order items from cart items
-        total_amount = 0
-        for cart_item in cart.items.all():
-            price = cart_item.product.price
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.product,
-                quantity=cart_item.quantity,
-                price=price
-            )
-            total_amount += price * cart_item.quantity
-        
-        # Update order total
-        order.total_amount = total_amount
-        order.save()
+        # Create order items from the quote and set the order total
+        create_order_items(order, quote)
         
         # Clear the cart
-        CartItem.objects.filter(cart=cart).delete()
+        with transaction.atomic():
+            CartItem.objects.filter(cart=cart).delete()
+            cart.mark_changed()
         
         # Return the order data
-        order_serializer = OrderSerializer(order)
+        order_serializer = OrderSerializer(Order.objects.with_related().get(pk=order.pk))
         response = Response(order_serializer.data)
         
         # Set cookie using the helper method
@@ -698,8 +846,8 @@ class AdminDashboardView(viewsets.ViewSet):
             orders_by_status[status] = Order.objects.filter(status=status).count()
         
         # Get recent orders
-        recent_orders = Order.objects.order_by('-order_date')[:5]
-        recent_orders_data = OrderSerializer(recent_orders, many=True).data
+        recent_orders = list(Order.objects.order_by('-order_date')[:5])
+        recent_orders_data = render_orders(recent_orders)
         
         # Count total customers
         total_customers = Customer.objects.filter(email__isnull=False).count()
@@ -737,12 +885,49 @@ class AdminDashboardView(viewsets.ViewSet):
                 'total': float(total_sales),
             }
         })
+    
+    @action(detail=False, methods=['get'])
+    def slow_queries(self, request):
+        """
+        The slow query log of the process serving the request, slowest
+        fingerprints first (`?order_by=max_ms|mean_ms|count|last_seen`).
+        """
+        order_by = request.query_params.get('order_by', 'total_ms')
+        if order_by not in SLOW_QUERY_ORDERINGS:
+            order_by = 'total_ms'
+        return Response({
+            'pid': os.getpid(),
+            'threshold_ms': SLOW_QUERY_THRESHOLD_MS,
+            'queries': slow_query_log.entries(order_by),
+        })
+
+
+# === Storefront bootstrap ===
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@renderer_classes([ORJSONRenderer])
+def bootstrap(request):
+    """
+    Everything the storefront needs on page load in one round trip: the first
+    catalog page, the current cart and the Stripe publishable key. See
+    api.bootstrap for how the fragments are cached.
+    """
+    cart, created = get_cart(request)
+    response = Response({
+        'products': catalog_fragment(request),
+        'cart': cart_fragment(cart, request),
+        'stripe_publishable_key': settings.STRIPE_PUBLISHABLE_KEY,
+    })
+    return set_cart_cookie(response, cart.cart_id)
 
 
 # === Stripe Webhook ===
 
 @csrf_exempt # Disable CSRF protection for webhook endpoint
 @api_view(['POST']) # Only allow POST requests
+@authentication_classes([])  # Stripe is authenticated by the signature check below
+@permission_classes([AllowAny])
 def stripe_webhook(request):
     """
     Listens for and processes incoming webhook events from Stripe.
@@ -770,61 +955,40 @@ def stripe_webhook(request):
         print(f"Webhook error: Generic exception - {e}")
         return HttpResponse(status=500)
 
+    # Work on plain dicts: newer stripe releases no longer make StripeObject
+    # a dict, which the .get() calls below rely on.
+    event = json.loads(payload)
+
+    with span(f"stripe_webhook {event['type']}", **{'stripe.event.id': event.get('id'), 'stripe.event.type': event['type']}) as event_span:
+        response = handle_stripe_event(event)
+        event_span.set_attribute('http.response.status_code', response.status_code)
+    return response
+
+
+def handle_stripe_event(event):
+    """
+    Apply a verified Stripe event. Returns the response for Stripe.
+    """
     # Handle the event
     if event['type'] == 'payment_intent.succeeded':
         payment_intent = event['data']['object'] # contains a stripe.PaymentIntent
         print('PaymentIntent was successful!')
-        # TODO: Implement fulfillment logic here
-        # 1. Get cart_id from metadata
-        cart_id = payment_intent.get('metadata', {}).get('cart_id')
-        if not cart_id:
-            print("Error: cart_id not found in PaymentIntent metadata")
-            # Decide how to handle this - maybe still mark payment successful?
-            return HttpResponse(status=400) # Or 200 if we just log the error?
-
-        # 2. Find the Order associated with this cart (or the cart itself)
-        #    This might depend on whether the Order is created *before* or *after* payment.
-        #    Let's assume an Order is created during checkout (as seen in CartViewSet.checkout)
-        #    and we need to find it and mark it as paid.
-        try:
-            # Option A: Find order via Cart (if cart persists after checkout - likely not ideal)
-            # cart = Cart.objects.get(cart_id=cart_id)
-            # order = Order.objects.get(cart=cart) # Requires Order model to link to Cart
-            
-            # Option B: Find order via Customer (if PI has customer info or cart has customer)
-            # This requires linking PaymentIntent metadata more robustly or querying differently
-            # For now, let's assume we need to find the Order based on something related to the cart_id
-            # Perhaps the checkout process should store the PI id on the Order? 
-            # Or maybe the cart_id is sufficient if the Order has a reference to it? 
-            
-            # Let's try finding the most recent 'pending' order associated with the customer from the cart
-            cart = Cart.objects.get(cart_id=cart_id)
-            if cart.customer:
-                order = Order.objects.filter(customer=cart.customer, status='pending').order_by('-order_date').first()
-                if order:
-                    print(f"Found pending order {order.id} for customer {cart.customer.id}")
-                    order.status = 'paid' # Or 'processing', depending on your flow
-                    order.payment_intent_id = payment_intent.id # Store the PI ID
-                    order.save()
-                    print(f"Order {order.id} marked as paid.")
-                    # Optional: Clear the cart now that the order is paid
-                    # CartItem.objects.filter(cart=cart).delete()
-                    # print(f"Cart {cart_id} cleared.")
-                else:
-                    print(f"Webhook Error: No pending order found for customer {cart.customer.id} associated with cart {cart_id}")
-                    # Potentially create the order here if it wasn't created at checkout? Risky.
-            else:
-                 print(f"Webhook Error: Cart {cart_id} has no associated customer.")
-
-        except Cart.DoesNotExist:
-            print(f"Webhook Error: Cart with ID {cart_id} not found.")
-            return HttpResponse(status=404) 
-        # except Order.DoesNotExist: # If using Order.objects.get()
-        #     print(f"Webhook Error: Order associated with cart {cart_id} not found.")
-        #     return HttpResponse(status=404)
-        except Exception as e:
-            print(f"Webhook fulfillment error: {e}")
-            return HttpResponse(status=500) # Internal server error during fulfillment
+        # checkout() stores the intent id on the order it creates
+        order = Order.objects.filter(stripe_payment_intent_id=payment_intent['id']).first()
+        if order is None:
+            cart = Cart.objects.filter(stripe_payment_intent_id=payment_intent['id']).first()
+            if cart is None:
+                # Not one of ours (e.g. a Checkout Session's intent); nothing to do.
+                print(f"Webhook: PaymentIntent {payment_intent['id']} has no order or cart.")
+                return HttpResponse(status=200)
+            # Paid before checkout created the order; a non-2xx response makes Stripe retry later.
+            finish_payment_intent(cart, succeeded=True)
+            print(f"Webhook Error: Cart {cart.cart_id} paid, but no order for PaymentIntent {payment_intent['id']} yet.")
+            return HttpResponse(status=404)
+        if order.status == 'pending':
+            order.status = 'paid' # Or 'processing', depending on your flow
+            order.save(update_fields=['status', 'updated_at'])
+            print(f"Order {order.id} marked as paid.")
 
     elif event['type'] == 'checkout.session.completed':
         session = event['data']['object']  # contains a stripe.Session
@@ -836,11 +1000,17 @@ def stripe_webhook(request):
             print("Error: cart_id not found in Checkout Session metadata")
             return HttpResponse(status=400)
         
+        # Stripe delivers events at least once; an order for this session means
+        # this is a redelivery.
+        if Order.objects.filter(stripe_checkout_session_id=session['id']).exists():
+            print(f"Checkout Session {session['id']} was already fulfilled.")
+            return HttpResponse(status=200)
+        
         try:
             cart = Cart.objects.get(cart_id=cart_id)
-            cart_items = CartItem.objects.filter(cart=cart)
+            quote = quote_cart(cart)
             
-            if not cart_items.exists():
+            if quote.is_empty:
                 print(f"Warning: Cart {cart_id} has no items")
                 return HttpResponse(status=200)
             
@@ -850,73 +1020,74 @@ def stripe_webhook(request):
                 print("Warning: No customer email in checkout session")
                 return HttpResponse(status=200)
             
-            # Get or create customer
-            customer, created = Customer.objects.get_or_create(
-                email=customer_email,
-                defaults={'device': None}
-            )
+            # One transaction, so a failure can't leave a paid order without
+            # its items for the redelivery check above to wave through.
+            try:
+                with transaction.atomic():
+                    # Get or create customer
+                    customer, created = Customer.objects.upsert_by_email(
+                        customer_email,
+                        defaults={'device': None}
+                    )
             
-            # Update cart customer if needed
-            if cart.customer and cart.customer != customer:
-                if cart.customer.email is None:
-                    cart.customer.email = customer_email
-                    cart.customer.save()
-                    customer = cart.customer
-                else:
-                    cart.customer = customer
-                    cart.save()
-            elif not cart.customer:
-                cart.customer = customer
-                cart.save()
+                    # Update cart customer if needed
+                    if cart.customer and cart.customer != customer:
+                        if cart.customer.email is None:
+                            cart.customer.email = customer_email
+                            cart.customer.save()
+                            customer = cart.customer
+                        else:
+                            cart.customer = customer
+                            cart.save()
+                    elif not cart.customer:
+                        cart.customer = customer
+                        cart.save()
             
-            # Get shipping details from the session
-            shipping_details = session.get('shipping_details', {})
-            shipping_address_data = shipping_details.get('address', {})
+                    # Get shipping details from the session
+                    shipping_details = session.get('shipping_details', {})
+                    shipping_address_data = shipping_details.get('address', {})
             
-            if shipping_address_data:
-                # Create or get shipping address
-                shipping_address, _ = Address.objects.get_or_create(
-                    customer=customer,
-                    street_address=shipping_address_data.get('line1', ''),
-                    apartment_address=shipping_address_data.get('line2', ''),
-                    city=shipping_address_data.get('city', ''),
-                    state=shipping_address_data.get('state', ''),
-                    country=shipping_address_data.get('country', ''),
-                    postal_code=shipping_address_data.get('postal_code', ''),
-                    defaults={'default': True}
-                )
+                    if shipping_address_data:
+                        # Create or get shipping address
+                        shipping_address, _ = Address.objects.upsert(
+                            customer,
+                            street_address=shipping_address_data.get('line1', ''),
+                            apartment_address=shipping_address_data.get('line2', ''),
+                            city=shipping_address_data.get('city', ''),
+                            state=shipping_address_data.get('state', ''),
+                            country=shipping_address_data.get('country', ''),
+                            postal_code=shipping_address_data.get('postal_code', ''),
+                            defaults={'default': True}
+                        )
                 
-                # Create order
-                order = Order.objects.create(
-                    customer=customer,
-                    shipping_address=shipping_address,
-                    status='paid',  # Order is already paid through Stripe Checkout
-                    payment_intent_id=session.get('payment_intent'),
-                    notes=f"Order created from Stripe Checkout session {session.id}"
-                )
-                
-                # Create order items and calculate total
-                total_amount = 0
-                for cart_item in cart_items:
-                    price = cart_item.product.price
-                    OrderItem.objects.create(
-                        order=order,
-                        product=cart_item.product,
-                        quantity=cart_item.quantity,
-                        price=price
-                    )
-                    total_amount += price * cart_item.quantity
+                        # Create order
+                        order = Order.objects.create(
+                            customer=customer,
+                            shipping_address=shipping_address,
+                            status='paid',  # Order is already paid through Stripe Checkout
+                            stripe_payment_intent_id=session.get('payment_intent'),
+                            stripe_checkout_session_id=session['id'],
+                            notes=f"Order created from Stripe Checkout session {session['id']}"
+                        )
                 
-                # Update order total
-                order.total_amount = total_amount
-                order.save()
+                        # Create order items from the quote and set the order total
+                        create_order_items(order, quote)
                 
-                # Clear the cart
-                cart_items.delete()
+                        # Clear the cart
+                        CartItem.objects.filter(cart=cart).delete()
+                        cart.mark_changed()
+                        if cart.stripe_checkout_session_id == session['id']:
+                            forget_checkout_session(cart)
                 
-                print(f"Successfully created Order {order.id} from Checkout Session {session.id}")
-            else:
-                print("Warning: No shipping address in checkout session")
+                        print(f"Successfully created Order {order.id} from Checkout Session {session['id']}")
+                    else:
+                        print("Warning: No shipping address in checkout session")
+            except IntegrityError:
+                # A concurrent delivery of the same event created the order first.
+                if Order.objects.filter(stripe_checkout_session_id=session['id']).exists():
+                    print(f"Checkout Session {session['id']} was already fulfilled.")
+                    return HttpResponse(status=200)
+                raise
         
         except Cart.DoesNotExist:
             print(f"Webhook Error: Cart with ID {cart_id} not found.")
@@ -925,6 +1096,14 @@ def stripe_webhook(request):
             print(f"Webhook error processing checkout session: {e}")
             return HttpResponse(status=500)
 
+    elif event['type'] == 'payment_intent.canceled':
+        payment_intent = event['data']['object']
+        cart = Cart.objects.filter(stripe_payment_intent_id=payment_intent['id']).first()
+        if cart is not None:
+            # The next create_payment_intent call starts a new intent.
+            finish_payment_intent(cart, succeeded=False)
+            print(f"PaymentIntent {payment_intent['id']} canceled; released from cart {cart.cart_id}.")
+
     elif event['type'] == 'payment_intent.payment_failed':
         payment_intent = event['data']['object']
         print('PaymentIntent failed.')
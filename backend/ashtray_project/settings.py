@@ -23,6 +23,8 @@ SECRET_KEY = os.getenv('SECRET_KEY', 'django-insecure-default-key-for-developmen
 STRIPE_PUBLISHABLE_KEY = os.getenv('STRIPE_PUBLISHABLE_KEY', 'pk_test_placeholder')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', 'sk_test_placeholder')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', 'whsec_placeholder')
+# Point the Stripe client somewhere else, e.g. `manage.py stripe_emulator` at http://127.0.0.1:12111
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE')
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True  # TEMPORARILY enable for production debugging
@@ -49,16 +51,22 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.TracingMiddleware',  # Only active when TRACING_EXPORTER is set
+    'api.middleware.SlowQueryMiddleware',  # Logs queries over SLOW_QUERY_THRESHOLD_MS
+    'api.middleware.SQLCommentMiddleware',  # Appends /*view=..,action=..,route=..*/ to queries
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'api.middleware.APICompressionMiddleware',  # gzip/brotli for /api/ responses
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     # 'django.middleware.csrf.CsrfViewMiddleware',  # Temporarily disabled for debugging
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.middleware.ProfilingMiddleware',  # Staff-only, per request: X-Profile header or ?_profile=
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'api.middleware.DeviceIDMiddleware',
     'api.middleware.APIMiddleware',  # Custom API middleware for better CORS handling
+    'api.middleware.NPlusOneDetectionMiddleware',  # Only active when NPLUSONE_DETECTION is on
 ]
 
 ROOT_URLCONF = 'ashtray_project.urls'
@@ -187,10 +195,12 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'x-request-id',
+    'traceparent',
 ]
 
 # Additional CORS settings for better cookie handling
-CORS_EXPOSE_HEADERS = ['content-type', 'set-cookie']
+CORS_EXPOSE_HEADERS = ['content-type', 'set-cookie', 'x-request-id', 'traceparent']
 
 # Cookie settings
 SESSION_COOKIE_SAMESITE = 'None'  # None for cross-site cookies
@@ -215,6 +225,48 @@ CSRF_TRUSTED_ORIGINS = [
 CSRF_USE_SESSIONS = False
 CSRF_COOKIE_SECURE = True
 
+# API response compression (see api.middleware.APICompressionMiddleware)
+API_COMPRESSION_MIN_SIZE = 1024  # bytes; smaller responses are sent as-is
+API_COMPRESSION_BROTLI_QUALITY = 5
+API_COMPRESSION_CACHE_TIMEOUT = 300  # seconds to keep compressed bodies by content digest
+API_COMPRESSION_CACHE_PATHS = ('/api/products/',)  # shared responses worth caching; not per-visitor ones
+
+# Admin changelists switch to planner row estimates above this many rows
+# (see api.changelist); date hierarchy rollups are cached for this long.
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+ADMIN_DATE_ROLLUP_TIMEOUT = 600  # seconds
+
+# Query budgets and N+1 detection (see api.query_budget). Over-budget views
+# only log unless QUERY_BUDGET_STRICT is set, since DEBUG is on in production.
+# N+1 detection records every query's shape, so it is opt-in for the same reason.
+QUERY_BUDGET_STRICT = os.getenv('QUERY_BUDGET_STRICT', '').lower() in ('1', 'true', 'yes')
+NPLUSONE_DETECTION = os.getenv('NPLUSONE_DETECTION', '').lower() in ('1', 'true', 'yes')
+NPLUSONE_THRESHOLD = 5  # same-shape queries per request before warning
+
+# On-demand request profiles kept per process (see api.profiling)
+PROFILING_BUFFER_SIZE = 50
+PROFILING_SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+
+# Slow query log (see api.slow_queries)
+SLOW_QUERY_LOG = True
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '100'))
+SLOW_QUERY_LOG_SIZE = 200  # fingerprints kept per process
+
+# Tag queries with the view/action/route or job that ran them (see api.sql_tags)
+SQL_COMMENTS = True
+
+# Catalog and cart fragments of /api/bootstrap/ (see api.bootstrap)
+BOOTSTRAP_CACHE_TIMEOUT = 300  # seconds; also bounds how stale image variants can be
+
+# Request tracing (see api.tracing): '' (off), 'file' or 'otlp'
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', '')
+TRACING_FILE = os.getenv('TRACING_FILE', os.path.join(BASE_DIR, 'traces.jsonl'))
+TRACING_ENDPOINT = os.getenv('TRACING_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACING_SERVICE_NAME = 'ashtray-backend'
+TRACING_QUEUE_SIZE = 2048  # spans waiting for export; more are dropped
+TRACING_BATCH_SIZE = 512
+TRACING_EXPORT_INTERVAL = 2.0  # seconds
+
 # Django URL settings
 APPEND_SLASH = True  # This ensures URLs with trailing slashes work
 
@@ -249,6 +301,12 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        # Query budget and N+1 warnings
+        'api.queries': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
         # Add detailed CORS logging
         'corsheaders': {
             'handlers': ['console'],
@@ -0,0 +1,26 @@
+import pytest
+
+from api.benchmarks import SCENARIOS, compare, measure
+
+pytestmark = [pytest.mark.benchmark, pytest.mark.django_db]
+
+
+@pytest.mark.parametrize('name', SCENARIOS)
+def test_hot_path(name, bench, bench_size, bench_baseline, bench_results, pytestconfig):
+    result = measure(bench.cases[name], pytestconfig.getoption('bench_iterations'))
+    bench_results.setdefault(str(bench_size), {})[name] = result
+    if bench_baseline is None:
+        return
+    for size, _, current, previous, regressed in compare(
+        {str(bench_size): {name: result}}, bench_baseline,
+        pytestconfig.getoption('bench_tolerance'), pytestconfig.getoption('bench_min_delta_ms'),
+    ):
+        assert not regressed, (
+            f"{name} at {size} regressed: {previous['median_ms']:.2f} -> {current['median_ms']:.2f} ms, "
+            f"queries {previous['queries']} -> {current['queries']}"
+        )
+
+
+def test_scenarios_are_listed(bench, bench_size):
+    # SCENARIOS parametrizes the suite; a scenario missing from it would never run.
+    assert set(bench.cases) == set(SCENARIOS)
@@ -0,0 +1,82 @@
+"""
+Benchmark suite configuration.
+
+    pytest -m benchmark [--bench-sizes=1k,100k] [--bench-iterations=10]
+                        [--bench-save=baseline.json] [--bench-compare=baseline.json]
+
+The dataset is seeded once into the test database and grown for each size;
+everything the benchmarks write is rolled back at the end of the run. With
+--bench-compare, a scenario that runs more queries than the baseline, or is
+slower than the tolerance allows, fails. Pass paths with "=": pytest looks
+for its rootdir among the arguments before it knows these options.
+"""
+import pytest
+from django.db import transaction
+
+from api.benchmarks import Dataset, Fixtures, load_baseline, parse_size, save_baseline, scenarios
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmark')
+    group.addoption('--bench-sizes', default='1k',
+                    help='Comma separated dataset sizes (customers/orders), e.g. 1k,100k,1m.')
+    group.addoption('--bench-iterations', type=int, default=10, help='Timed runs per scenario.')
+    group.addoption('--bench-save', metavar='PATH', help='Write the results to this baseline file.')
+    group.addoption('--bench-compare', metavar='PATH', help='Compare the results against this baseline file.')
+    group.addoption('--bench-tolerance', type=float, default=0.25,
+                    help='Allowed slowdown as a fraction of the baseline median.')
+    group.addoption('--bench-min-delta-ms', type=float, default=1.0,
+                    help='Ignore slowdowns smaller than this, which are mostly noise.')
+
+
+def pytest_generate_tests(metafunc):
+    if 'bench_size' in metafunc.fixturenames:
+        option = metafunc.config.getoption('bench_sizes')
+        try:
+            sizes = sorted({parse_size(size) for size in option.split(',') if size.strip()})
+        except ValueError:
+            raise pytest.UsageError(f"Invalid --bench-sizes {option!r}.")
+        # Session scoped, so the tests run grouped by size, smallest first.
+        metafunc.parametrize('bench_size', sizes, indirect=True, scope='session', ids=str)
+
+
+class Bench:
+    def __init__(self):
+        self.dataset = Dataset()
+        self.cases = None
+
+    def grow(self, size):
+        if size > self.dataset.size:
+            self.dataset.grow(size)
+        if self.cases is None:
+            self.cases = {case.name: case for case in scenarios(Fixtures())}
+
+
+@pytest.fixture(scope='session')
+def bench(django_db_setup, django_db_blocker):
+    with django_db_blocker.unblock(), transaction.atomic():
+        try:
+            yield Bench()
+        finally:
+            transaction.set_rollback(True)
+
+
+@pytest.fixture(scope='session')
+def bench_size(request, bench):
+    bench.grow(request.param)
+    return request.param
+
+
+@pytest.fixture(scope='session')
+def bench_baseline(pytestconfig):
+    path = pytestconfig.getoption('bench_compare')
+    return load_baseline(path) if path else None
+
+
+@pytest.fixture(scope='session')
+def bench_results(pytestconfig):
+    results = {}
+    yield results
+    path = pytestconfig.getoption('bench_save')
+    if path and results:
+        save_baseline(path, results, pytestconfig.getoption('bench_iterations'))